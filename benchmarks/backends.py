@@ -0,0 +1,110 @@
+# coding: utf-8
+""" The micro benchmarks (see bench.py) on both backends: the stack
+VM and the register VM (see nolst/register.py).
+
+Run from the repository root:
+
+    python benchmarks/backends.py [-O] [name ...]
+
+For each backend we report the number of instructions compiled, the
+number of instructions dispatched (counted by a tracer) and the best
+execution time over a few runs. -O only applies to the stack VM:
+the register compiler doesn't go through the peephole optimizer.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nolst.sourceparser import parse
+from nolst import bytecode, interpreter, register
+
+from bench import BENCHMARKS, NullWriter, REPEAT
+
+
+class DispatchCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def instruction(self, bc, pc, opcode, arg, frame, calls):
+        self.count += 1
+
+
+class StackBackend(object):
+    name = 'stack'
+
+    def __init__(self, optimize):
+        self.optimize = optimize
+
+    def compile(self, source):
+        return bytecode.compile_ast(parse(source), optimize=self.optimize)
+
+    def instructions(self, bc):
+        return bc.instructions_count()
+
+    def execute(self, bc):
+        interpreter.execute(interpreter.toplevel_frame(bc), bc)
+
+    def execute_traced(self, bc, tracer):
+        interpreter.execute_traced(interpreter.toplevel_frame(bc), bc, tracer)
+
+
+class RegisterBackend(object):
+    name = 'register'
+
+    def compile(self, source):
+        return register.compile_ast(parse(source))
+
+    def instructions(self, bc):
+        return register.instructions_count(bc)
+
+    def execute(self, bc):
+        register.execute(register.toplevel_frame(bc), bc)
+
+    def execute_traced(self, bc, tracer):
+        register.execute_traced(register.toplevel_frame(bc), bc, tracer)
+
+
+def run(backend, source):
+    bc = backend.compile(source)
+    counter = DispatchCounter()
+    backend.execute_traced(bc, counter)
+    best = float('inf')
+    for _ in range(REPEAT):
+        bc = backend.compile(source)
+        t0 = time.time()
+        backend.execute(bc)
+        best = min(best, time.time() - t0)
+    return backend.instructions(bc), counter.count, best
+
+
+def main(argv):
+    optimize = '-O' in argv[1:]
+    selected = [a for a in argv[1:] if a != '-O']
+    backends = [StackBackend(optimize), RegisterBackend()]
+    results = []
+    stdout = sys.stdout
+    for name, source in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        source = source()
+        sys.stdout = NullWriter()
+        try:
+            results.append((name, [run(backend, source) for backend in backends]))
+        finally:
+            sys.stdout = stdout
+
+    print('%-20s %-9s %8s %12s %12s %9s' % (
+        'benchmark', 'backend', 'insns', 'dispatched', 'exec(ms)', 'speedup'))
+    for name, runs in results:
+        stack_time = runs[0][2]
+        for backend, (insns, dispatched, t_exec) in zip(backends, runs):
+            print('%-20s %-9s %8d %12d %12.3f %8.2fx' % (
+                name, backend.name, insns, dispatched, t_exec * 1000,
+                stack_time / t_exec))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
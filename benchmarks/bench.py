@@ -0,0 +1,242 @@
+# coding: utf-8
+""" Micro benchmarks for the untranslated interpreter.
+
+Run from the repository root:
+
+    python benchmarks/bench.py [-O] [name ...]
+
+Every benchmark is a nolst program; we report the best
+compile time and the best execution time over a few runs.
+With -O, programs go through the peephole optimizer.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nolst.sourceparser import parse
+from nolst.bytecode import compile_ast
+from nolst.interpreter import toplevel_frame, execute
+
+REPEAT = 5
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def testscript(name):
+    path = os.path.join(os.path.dirname(__file__), '..', 'testscripts', name)
+    with open(path) as f:
+        return f.read()
+
+
+def wide_constants(n=600):
+    ''' many distinct constants and variables (wide operands) '''
+    return '\n'.join('(def v%d %d)' % (i, i * 7) for i in range(n))
+
+
+def wide_jumps(n=400):
+    ''' a branch whose body is way bigger than 255 bytes '''
+    body = ' '.join('(def w%d %d)' % (i, i) for i in range(n))
+    return '(def c 1)\n(if (< c 2) (do %s))' % body
+
+
+def repeated_literals(n=300):
+    ''' the same few literals over and over (constant pool dedup) '''
+    return '\n'.join('(def r%d (add %d 1))' % (i % 10, i % 3) for i in range(n))
+
+
+COUNT = '''
+(def count (lambda (n) (if (< 0 n) (count (add n -1)))))
+(count %d)
+'''
+
+ARITH = '''
+(def arith (lambda (n acc)
+  (if (< 0 n)
+      (arith (add n -1) (add (add acc n) (add n 1000))))))
+(arith %d 0)
+'''
+
+COMPARE = '''
+(def compare (lambda (n hits)
+  (if (< 0 n)
+      (compare (add n -1) (add hits (< (add n n) 300))))))
+(compare %d 0)
+'''
+
+# while loops: JUMP_BACKWARD closes the JIT loops
+WHILE_COUNT = '''
+(def loop (lambda (n)
+  (do
+    (def i 0)
+    (while (< i n) (def i (add i 1)))
+    i)))
+(loop %d)
+'''
+
+WHILE_ACCUMULATE = '''
+(def loop (lambda (n)
+  (do
+    (def i 0)
+    (def acc 0)
+    (while (< i n)
+      (do
+        (def acc (add acc (add i 7)))
+        (def i (add i 1))))
+    acc)))
+(loop %d)
+'''
+
+WHILE_NESTED = '''
+(def loop (lambda (n)
+  (do
+    (def acc 0)
+    (def i 0)
+    (while (< i n)
+      (do
+        (def j 0)
+        (while (< j n)
+          (do
+            (def acc (add acc j))
+            (def j (add j 1))))
+        (def i (add i 1))))
+    acc)))
+(loop %d)
+'''
+
+# higher-order code: closures created and called in a loop
+CLOSURES = '''
+(def adder (lambda (n) (lambda (x) (add x n))))
+(def apply (lambda (f n acc)
+  (if (< 0 n) (apply f (add n -1) (f acc)))))
+(def loop (lambda (n)
+  (do
+    (def i 0)
+    (while (< i n)
+      (do
+        (apply (adder i) 10 0)
+        (def i (add i 1)))))))
+(loop %d)
+'''
+
+# lists of ints (int storage strategy): build, then index
+LISTS = '''
+(def loop (lambda (n)
+  (do
+    (def l (list))
+    (def i 0)
+    (while (< i n)
+      (do
+        (push l i)
+        (def i (add i 1))))
+    (def acc 0)
+    (def i 0)
+    (while (< i (len l))
+      (do
+        (def acc (add acc (nth l i)))
+        (def i (add i 1))))
+    acc)))
+(loop %d)
+'''
+
+# strings built piece by piece
+STRINGS = '''
+(def loop (lambda (n)
+  (do
+    (def s "")
+    (def i 0)
+    (while (< i n)
+      (do
+        (def s (concat s "abc"))
+        (def i (add i 1))))
+    (strlen s))))
+(loop %d)
+'''
+
+# ints outgrowing a machine word: the loop runs on big ints
+BIGINTS = '''
+(def loop (lambda (n)
+  (do
+    (def acc 1)
+    (def i 0)
+    (while (< i n)
+      (do
+        (def acc (add (* acc 3) i))
+        (def i (add i 1))))
+    (< 0 acc))))
+(loop %d)
+'''
+
+
+BENCHMARKS = [
+    ('if', lambda: testscript('if.nls')),
+    ('subfunc', lambda: testscript('subfunc.nls')),
+    ('wide_constants', wide_constants),
+    ('wide_jumps', wide_jumps),
+    ('repeated_literals', repeated_literals),
+    # tight arithmetic loops
+    ('count', lambda: COUNT % 20000),
+    ('arith', lambda: ARITH % 20000),
+    ('compare', lambda: COMPARE % 20000),
+    # loops
+    ('while_count', lambda: WHILE_COUNT % 20000),
+    ('while_accumulate', lambda: WHILE_ACCUMULATE % 20000),
+    ('while_nested', lambda: WHILE_NESTED % 150),
+    # closures
+    ('closures', lambda: CLOSURES % 2000),
+    # lists
+    ('lists', lambda: LISTS % 10000),
+    # strings
+    ('strings', lambda: STRINGS % 20000),
+    # big ints
+    ('bigints', lambda: BIGINTS % 500),
+]
+
+
+def run(source, optimize):
+    best_compile = best_exec = float('inf')
+    for _ in range(REPEAT):
+        t0 = time.time()
+        bc = compile_ast(parse(source), optimize=optimize)
+        t1 = time.time()
+        execute(toplevel_frame(bc), bc)
+        t2 = time.time()
+        best_compile = min(best_compile, t1 - t0)
+        best_exec = min(best_exec, t2 - t1)
+    return best_compile, best_exec, bc
+
+
+def main(argv):
+    optimize = '-O' in argv[1:]
+    selected = [a for a in argv[1:] if a != '-O']
+    results = []
+    stdout = sys.stdout
+    for name, source in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        sys.stdout = NullWriter()
+        try:
+            results.append((name, run(source(), optimize)))
+        finally:
+            sys.stdout = stdout
+
+    print('%-20s %12s %12s %10s %12s %14s' % (
+        'benchmark', 'compile(ms)', 'exec(ms)', 'code(B)', 'insns(opt)',
+        'consts(dedup)'))
+    for name, (t_compile, t_exec, bc) in results:
+        insns = '%d/%d' % (bc.instructions_count(), bc.instructions_emitted)
+        consts = '%d/%d' % (len(bc.constants), bc.constants_requested)
+        print('%-20s %12.3f %12.3f %10d %12s %14s' % (
+            name, t_compile * 1000, t_exec * 1000, len(bc.code), insns, consts))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
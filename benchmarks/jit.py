@@ -0,0 +1,145 @@
+# coding: utf-8
+""" Recursive and loop workloads on a translated interpreter,
+with and without its JIT.
+
+Translate with the JIT first:
+
+    rpython --opt=jit targetnolst.py
+
+then, from the repository root:
+
+    python benchmarks/jit.py ./targetnolst-c [--backend register] [name ...]
+
+Every workload runs with the JIT enabled and with `--jit off`, on
+the stack VM or, with `--backend register`, on the register VM.
+
+Int arithmetic checks for overflow, giving a big int when the
+result doesn't fit in a machine word. In the traces of the int
+workloads, that's an `int_add_ovf` and a `guard_no_overflow`. The
+frames are plain objects (not virtualizables, see the comment on the
+driver in nolst/interpreter.py): the ints stored in their slots are
+still allocated. `benchmarks/traces.py` compares the loops compiled,
+without translating. To look at the traces:
+
+    PYPYLOG=jit-log-opt:log ./targetnolst-c while_accumulate.nls
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPEAT = 3
+
+# tail recursion: TAIL_CALL loops back to the function entry
+TAIL_COUNT = '''
+(def count (lambda (n) (if (< 0 n) (count (add n -1)))))
+(count 10000000)
+'''
+
+TAIL_ARITH = '''
+(def arith (lambda (n acc)
+  (if (< 0 n)
+      (arith (add n -1) (add (add acc n) (add n 1000))))))
+(arith 5000000 0)
+'''
+
+# plain recursion: CALL enters the function entry again and again
+DEEP = '''
+(def down (lambda (n) (do (if (< 0 n) (down (add n -1))) n)))
+(def repeat (lambda (k) (if (< 0 k) (do (down 100) (repeat (add k -1))))))
+(repeat 50000)
+'''
+
+# while loops: JUMP_BACKWARD closes the loop
+WHILE_ACCUMULATE = '''
+(def loop (lambda (n)
+  (do
+    (def i 0)
+    (def acc 0)
+    (while (< i n)
+      (do
+        (def acc (add acc (add i 7)))
+        (def i (add i 1))))
+    acc)))
+(print (loop 10000000))
+'''
+
+WHILE_NESTED = '''
+(def loop (lambda (n)
+  (do
+    (def acc 0)
+    (def i 0)
+    (while (< i n)
+      (do
+        (def j 0)
+        (while (< j n)
+          (do
+            (def acc (add acc j))
+            (def j (add j 1))))
+        (def i (add i 1))))
+    acc)))
+(print (loop 3000))
+'''
+
+# the same loop, overflowing early: big ints from there on
+BIG_ACCUMULATE = '''
+(def loop (lambda (n)
+  (do
+    (def i 0)
+    (def acc 9223372036854775000)
+    (while (< i n)
+      (do
+        (def acc (add acc (add i 7)))
+        (def i (add i 1))))
+    acc)))
+(print (loop 1000000))
+'''
+
+WORKLOADS = [
+    ('tail_count', TAIL_COUNT),
+    ('tail_arith', TAIL_ARITH),
+    ('deep', DEEP),
+    ('while_accumulate', WHILE_ACCUMULATE),
+    ('while_nested', WHILE_NESTED),
+    ('big_accumulate', BIG_ACCUMULATE),
+]
+
+
+def best_time(cmd):
+    best = float('inf')
+    for _ in range(REPEAT):
+        t0 = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, stdout=devnull)
+        best = min(best, time.time() - t0)
+    return best
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+    binary = argv[1]
+    selected = argv[2:]
+    options = []
+    if selected[:1] == ['--backend']:
+        options = selected[:2]
+        selected = selected[2:]
+    tmpdir = tempfile.mkdtemp()
+    print('%-18s %12s %12s %8s' % ('workload', 'jit(ms)', 'nojit(ms)', 'speedup'))
+    for name, source in WORKLOADS:
+        if selected and name not in selected:
+            continue
+        path = os.path.join(tmpdir, name + '.nls')
+        with open(path, 'w') as f:
+            f.write(source)
+        t_jit = best_time([binary] + options + [path])
+        t_nojit = best_time([binary, '--jit', 'off'] + options + [path])
+        print('%-18s %12.1f %12.1f %7.1fx' % (
+            name, t_jit * 1000, t_nojit * 1000, t_nojit / t_jit))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,48 @@
+# coding: utf-8
+""" Most frequent pairs of adjacent instructions executed by the
+micro benchmarks (see bench.py): candidates for superinstructions.
+
+Run from the repository root:
+
+    python benchmarks/pairs.py [-O] [name ...]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nolst.sourceparser import parse
+from nolst.bytecode import compile_ast
+from nolst.interpreter import toplevel_frame, execute_traced
+from nolst.tracing import PairProfiler
+
+from bench import BENCHMARKS, NullWriter
+
+# the tracing interpreter is way slower: smaller loops
+SIZES = {'count': 2000, 'arith': 2000, 'compare': 2000}
+
+
+def main(argv):
+    optimize = '-O' in argv[1:]
+    selected = [a for a in argv[1:] if a != '-O']
+    profiler = PairProfiler(1)
+    stdout = sys.stdout
+    for name, source in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        if name in SIZES:
+            source = source().replace('20000', str(SIZES[name]))
+        else:
+            source = source()
+        bc = compile_ast(parse(source), optimize=optimize)
+        sys.stdout = NullWriter()
+        try:
+            execute_traced(toplevel_frame(bc), bc, profiler)
+        finally:
+            sys.stdout = stdout
+    profiler.finish()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
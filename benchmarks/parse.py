@@ -0,0 +1,75 @@
+# coding: utf-8
+""" Source to AST time: the S-expression reader (`parse`)
+against the generic EBNF parser (`parse_generic`).
+
+Run from the repository root:
+
+    python benchmarks/parse.py [size_in_kb ...]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nolst.sourceparser import parse, parse_generic
+
+# the generic parser recurses once per top-level form:
+# run everything in a thread with a big stack
+sys.setrecursionlimit(10 ** 7)
+threading.stack_size(512 * 1024 * 1024)
+
+FORM = '''
+(def recfunc%d
+     (lambda (x)
+       (do
+           (print x)
+           (if (< x 10)
+               (do
+                   (def nx (add x 1))
+                   (recfunc nx))))))
+'''
+
+
+def workload(size):
+    forms = []
+    length = i = 0
+    while length < size:
+        form = FORM % i
+        forms.append(form)
+        length += len(form)
+        i += 1
+    return ''.join(forms)
+
+
+def best_time(func, source, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.time()
+        func(source)
+        best = min(best, time.time() - t0)
+    return best
+
+
+def bench(sizes, results):
+    for kb in sizes:
+        source = workload(kb * 1024)
+        results.append((kb, best_time(parse, source), best_time(parse_generic, source)))
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or [64, 1024, 2048]
+    results = []
+    t = threading.Thread(target=bench, args=(sizes, results))
+    t.start()
+    t.join()
+    print('%-10s %12s %12s %8s' % ('size(KB)', 'reader(ms)', 'ebnf(ms)', 'speedup'))
+    for kb, t_reader, t_generic in results:
+        print('%-10d %12.1f %12.1f %7.1fx' % (
+            kb, t_reader * 1000, t_generic * 1000, t_generic / t_reader))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
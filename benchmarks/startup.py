@@ -0,0 +1,45 @@
+# coding: utf-8
+""" Import time of nolst.sourceparser, with (warm) and
+without (cold) the generated parser tables.
+
+Run from the repository root:
+
+    python benchmarks/startup.py
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TABLES = os.path.join(ROOT, 'nolst', 'grammar_tables.py')
+REPEAT = 5
+
+
+def remove_tables():
+    for path in (TABLES, TABLES + 'c'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def import_time():
+    t0 = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import nolst.sourceparser'],
+                          cwd=ROOT)
+    return time.time() - t0
+
+
+def main(argv):
+    cold = warm = float('inf')
+    for _ in range(REPEAT):
+        remove_tables()
+        cold = min(cold, import_time())
+        warm = min(warm, import_time())
+    print('%-10s %10s' % ('import', 'time(ms)'))
+    print('%-10s %10.1f' % ('cold', cold * 1000))
+    print('%-10s %10.1f' % ('warm', warm * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
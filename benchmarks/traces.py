@@ -0,0 +1,120 @@
+# coding: utf-8
+""" The loops the JIT compiles for small workloads, without translating:
+the interpreter runs on the llgraph backend (rpython's JIT tests).
+For every workload, the result (it must be the same as without the
+JIT), the number of compiled loops and aborted traces, and the
+operations of the loops by kind. With `--profile`, the workloads run
+under the profiler (nolst.tracing.Profiler), as with --profile FD.
+
+Run from the repository root (each workload takes a minute or two):
+
+    python benchmarks/traces.py [--profile] [name ...]
+"""
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# every workload defines `result`
+WORKLOADS = [
+    # JUMP_BACKWARD closes the loop
+    ('while', (
+        '(def i 0) (def result 0)'
+        '(while (< i 300) (do (def result (add result i)) (def i (add i 1))))'),
+     44850),
+    ('local_while', (
+        '(def f (lambda (n) (do (def i 0) (def t 0)'
+        '  (while (< i n) (do (def t (add t i)) (def i (add i 1)))) t)))'
+        '(def result (f 300))'),
+     44850),
+    # TAIL_CALL loops back to the function entry
+    ('tail', (
+        '(def out (list))'
+        '(def count (lambda (n acc) (do (if (< n 1) (push out acc))'
+        '  (if (< 0 n) (count (add n -1) (add acc n))))))'
+        '(count 300 0) (def result (nth out 0))'),
+     45150),
+    # CALL and BACK, between frames
+    ('fib', (
+        '(def fib (lambda (n) (do (def r n)'
+        '  (if (< 1 n) (def r (add (fib (- n 1)) (fib (- n 2))))) r)))'
+        '(def result (fib 12))'),
+     144),
+]
+
+KINDS = ['guard', 'heap', 'new', 'call', 'other']
+
+
+def kind(opname):
+    if opname.startswith('guard'):
+        return 'guard'
+    elif 'arrayitem' in opname or opname.startswith(('getfield', 'setfield')):
+        return 'heap'
+    elif opname.startswith('new'):
+        return 'new'
+    elif opname.startswith('call'):
+        return 'call'
+    return 'other'
+
+
+def run_one(name, profile):
+    '''
+    run a workload with the JIT, print a line of results
+    '''
+    from rpython.jit.metainterp.test.support import LLJitMixin, get_stats
+    from nolst.interpreter import Session, W_IntObject
+    from nolst.tracing import Profiler
+
+    source = dict([(n, s) for n, s, _ in WORKLOADS])[name]
+
+    def main():
+        profiler = None
+        if profile:
+            profiler = Profiler(2)
+        session = Session(profiler=profiler)
+        session.run(source)
+        w_result = session.frame.vars[session.names.var_pos('result')]
+        assert isinstance(w_result, W_IntObject)
+        return w_result.intval
+
+    result = LLJitMixin().meta_interp(main, [], listops=True,
+                                      backendopt=True, inline=True)
+    stats = get_stats()
+    counts = dict.fromkeys(KINDS, 0)
+    loops = stats.get_all_loops()
+    for loop in loops:
+        for op in loop.operations:
+            if op.getopname() != 'debug_merge_point':
+                counts[kind(op.getopname())] += 1
+    print('RESULT %s %d %d %d %s' % (
+        name, result, len(loops), stats.aborted_count,
+        ' '.join([str(counts[k]) for k in KINDS])))
+
+
+def main(argv):
+    if argv[1:2] == ['--one']:
+        run_one(argv[2], argv[3:] == ['--profile'])
+        return 0
+    options = [a for a in argv[1:] if a == '--profile']
+    selected = [a for a in argv[1:] if a != '--profile']
+    print('%-12s %8s %6s %6s %6s  %s' % (
+        'workload', 'result', 'ok', 'loops', 'aborts',
+        'ops: total ' + ' '.join(KINDS)))
+    for name, _, expected in WORKLOADS:
+        if selected and name not in selected:
+            continue
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--one', name] + options,
+            stderr=subprocess.STDOUT)
+        line = [l for l in output.splitlines() if l.startswith('RESULT ')][-1]
+        fields = line.split()[2:]
+        ops = [int(n) for n in fields[3:]]
+        print('%-12s %8s %6s %6s %6s  %d %s' % (
+            name, fields[0], int(fields[0]) == expected, fields[1],
+            fields[2], sum(ops), ' '.join([str(n) for n in ops])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,392 @@
+""" Native builtins.
+
+Functions written in RPython, called by CALL_BUILTIN. Like
+special forms, they are resolved by name at compile time (a
+`def` of their name is an error, see sourceparser.is_reserved)
+and their number of arguments is checked by the reader (see
+sourceparser.check_count). The interpreter calls them directly:
+no frame, no return address, a single dispatch.
+
+A builtin takes wrapped objects and returns one. Register it
+with the `builtin` decorator, under one or more names; its
+arity is the number of arguments of the function. A `variadic`
+builtin takes the list of its arguments, whatever their number.
+"""
+from rpython.rlib.rarithmetic import ovfcheck
+from rpython.rlib.unroll import unrolling_iterable
+
+from nolst.interpreter import (W_IntObject, W_FloatObject, W_StringObject,
+                               W_ListObject, InterpreterError, wrap_int,
+                               wrap_bool, wrap_bigint, is_true, new_list,
+                               numeric_kind, float_value, bigint_value,
+                               NOT_NUMERIC, NUMERIC_INT, NUMERIC_BIGINT,
+                               NUMERIC_FLOAT)
+
+# biggest arity CALL_BUILTIN handles
+MAX_ARITY = 3
+# arity of the variadic builtins
+VARIADIC = -1
+
+# (name, arity, function), by index
+BUILTINS = []
+# arities, by index, for the compilers: BUILTINS mixes
+# functions of different signatures, it is only read at
+# import time (unrolling_builtins)
+ARITIES = []
+# name -> index in BUILTINS
+names_to_index = {}
+
+
+def builtin(*names):
+    def register(func):
+        arity = func.func_code.co_argcount
+        assert arity <= MAX_ARITY
+        for name in names:
+            names_to_index[name] = len(BUILTINS)
+        BUILTINS.append((names[0], arity, func))
+        ARITIES.append(arity)
+        return func
+    return register
+
+
+def variadic(*names):
+    def register(func):
+        for name in names:
+            names_to_index[name] = len(BUILTINS)
+        BUILTINS.append((names[0], VARIADIC, func))
+        ARITIES.append(VARIADIC)
+        return func
+    return register
+
+
+def lookup(name):
+    '''
+    index of builtin `name`, -1 if there is none
+    '''
+    return names_to_index.get(name, -1)
+
+
+def arity(index):
+    return ARITIES[index]
+
+
+def type_error(name, w_obj):
+    return InterpreterError("%s: wrong type %s" % (name, w_obj.str()))
+
+
+def arith_kind(name, w_x, w_y):
+    '''
+    the kind of arithmetic on `w_x` and `w_y` (see numeric_kind),
+    raising the type error if one of them is not a number
+    '''
+    kind = numeric_kind(w_x, w_y)
+    if kind == NOT_NUMERIC:
+        if w_x.numeric == NOT_NUMERIC:
+            raise type_error(name, w_x)
+        raise type_error(name, w_y)
+    return kind
+
+
+# arithmetic: ints overflowing, and big ints,
+# fall through to the rbigint operation
+
+@builtin('sub', '-')
+def sub(w_x, w_y):
+    kind = arith_kind('sub', w_x, w_y)
+    if kind == NUMERIC_INT:
+        assert isinstance(w_x, W_IntObject) and isinstance(w_y, W_IntObject)
+        try:
+            return wrap_int(ovfcheck(w_x.intval - w_y.intval))
+        except OverflowError:
+            pass
+    elif kind == NUMERIC_FLOAT:
+        return W_FloatObject(float_value(w_x) - float_value(w_y))
+    return wrap_bigint(bigint_value(w_x).sub(bigint_value(w_y)))
+
+
+@builtin('mul', '*')
+def mul(w_x, w_y):
+    kind = arith_kind('mul', w_x, w_y)
+    if kind == NUMERIC_INT:
+        assert isinstance(w_x, W_IntObject) and isinstance(w_y, W_IntObject)
+        try:
+            return wrap_int(ovfcheck(w_x.intval * w_y.intval))
+        except OverflowError:
+            pass
+    elif kind == NUMERIC_FLOAT:
+        return W_FloatObject(float_value(w_x) * float_value(w_y))
+    return wrap_bigint(bigint_value(w_x).mul(bigint_value(w_y)))
+
+
+@builtin('div', '/')
+def div(w_x, w_y):
+    '''
+    floor division on ints
+    '''
+    kind = arith_kind('div', w_x, w_y)
+    if not w_y.is_true():
+        raise InterpreterError("div: division by zero")
+    if kind == NUMERIC_INT:
+        assert isinstance(w_x, W_IntObject) and isinstance(w_y, W_IntObject)
+        try:
+            return wrap_int(ovfcheck(w_x.intval // w_y.intval))
+        except OverflowError:
+            pass
+    elif kind == NUMERIC_FLOAT:
+        return W_FloatObject(float_value(w_x) / float_value(w_y))
+    return wrap_bigint(bigint_value(w_x).floordiv(bigint_value(w_y)))
+
+
+@builtin('mod', '%')
+def mod(w_x, w_y):
+    kind = arith_kind('mod', w_x, w_y)
+    if kind == NUMERIC_FLOAT:
+        if isinstance(w_x, W_FloatObject):
+            raise type_error('mod', w_x)
+        raise type_error('mod', w_y)
+    if not w_y.is_true():
+        raise InterpreterError("mod: division by zero")
+    if kind == NUMERIC_INT:
+        assert isinstance(w_x, W_IntObject) and isinstance(w_y, W_IntObject)
+        try:
+            return wrap_int(ovfcheck(w_x.intval % w_y.intval))
+        except OverflowError:
+            pass
+    return wrap_bigint(bigint_value(w_x).mod(bigint_value(w_y)))
+
+
+# comparisons
+
+def compare(name, w_x, w_y):
+    '''
+    -1, 0 or 1 whether `w_x` is lower than,
+    equal to or greater than `w_y`
+    '''
+    if isinstance(w_x, W_StringObject) and isinstance(w_y, W_StringObject):
+        x = w_x.value()
+        y = w_y.value()
+        if x < y:
+            return -1
+        elif x == y:
+            return 0
+        return 1
+    kind = arith_kind(name, w_x, w_y)
+    if kind == NUMERIC_INT:
+        assert isinstance(w_x, W_IntObject) and isinstance(w_y, W_IntObject)
+        if w_x.intval < w_y.intval:
+            return -1
+        elif w_x.intval == w_y.intval:
+            return 0
+        return 1
+    elif kind == NUMERIC_BIGINT:
+        x = bigint_value(w_x)
+        y = bigint_value(w_y)
+        if x.lt(y):
+            return -1
+        elif x.eq(y):
+            return 0
+        return 1
+    x = float_value(w_x)
+    y = float_value(w_y)
+    if x < y:
+        return -1
+    elif x == y:
+        return 0
+    return 1
+
+
+@builtin('gt', '>')
+def gt(w_x, w_y):
+    return wrap_bool(compare('gt', w_x, w_y) > 0)
+
+
+@builtin('le', '<=')
+def le(w_x, w_y):
+    return wrap_bool(compare('le', w_x, w_y) <= 0)
+
+
+@builtin('ge', '>=')
+def ge(w_x, w_y):
+    return wrap_bool(compare('ge', w_x, w_y) >= 0)
+
+
+@builtin('eq', '=')
+def eq(w_x, w_y):
+    '''
+    numbers and strings are equal by value,
+    anything else by identity
+    '''
+    if (numeric_kind(w_x, w_y) != NOT_NUMERIC
+            or (isinstance(w_x, W_StringObject) and isinstance(w_y, W_StringObject))):
+        return wrap_bool(compare('eq', w_x, w_y) == 0)
+    return wrap_bool(w_x is w_y)
+
+
+@builtin('not')
+def not_(w_x):
+    return wrap_bool(not is_true(w_x))
+
+
+# strings
+
+def string_object_arg(name, w_obj):
+    if not isinstance(w_obj, W_StringObject):
+        raise type_error(name, w_obj)
+    return w_obj
+
+
+def string_arg(name, w_obj):
+    return string_object_arg(name, w_obj).value()
+
+
+def int_arg(name, w_obj):
+    if not isinstance(w_obj, W_IntObject):
+        raise type_error(name, w_obj)
+    return w_obj.intval
+
+
+@builtin('concat')
+def concat(w_x, w_y):
+    w_x = string_object_arg('concat', w_x)
+    return w_x.concat(string_object_arg('concat', w_y))
+
+
+@builtin('strlen')
+def strlen(w_s):
+    return wrap_int(string_object_arg('strlen', w_s).length)
+
+
+@builtin('substr')
+def substr(w_s, w_start, w_end):
+    '''
+    characters from `start` to `end` (excluded),
+    both clamped to the string
+    '''
+    s = string_arg('substr', w_s)
+    start = min(max(int_arg('substr', w_start), 0), len(s))
+    end = min(max(int_arg('substr', w_end), start), len(s))
+    assert start >= 0 and end >= 0
+    return W_StringObject(s[start:end])
+
+
+@builtin('str')
+def str_(w_x):
+    if isinstance(w_x, W_StringObject):
+        return w_x
+    return W_StringObject(w_x.str())
+
+
+# lists
+
+def list_arg(name, w_obj):
+    if not isinstance(w_obj, W_ListObject):
+        raise type_error(name, w_obj)
+    return w_obj
+
+
+@variadic('list')
+def list_(args_w):
+    return new_list(args_w)
+
+
+@builtin('len')
+def len_(w_x):
+    '''
+    length of a list or of a string
+    '''
+    if isinstance(w_x, W_StringObject):
+        return wrap_int(w_x.length)
+    return wrap_int(list_arg('len', w_x).length())
+
+
+@builtin('nth')
+def nth(w_list, w_index):
+    w_list = list_arg('nth', w_list)
+    index = int_arg('nth', w_index)
+    if index < 0 or index >= w_list.length():
+        raise InterpreterError("nth: index %d out of range" % index)
+    return w_list.getitem(index)
+
+
+@builtin('push', 'append')
+def push(w_list, w_item):
+    '''
+    append `w_item` to the list, in place
+    '''
+    w_list = list_arg('push', w_list)
+    w_list.append(w_item)
+    return w_list
+
+
+@builtin('cons')
+def cons(w_item, w_list):
+    '''
+    a new list: `w_item` followed by the items of the list
+    '''
+    w_list = list_arg('cons', w_list)
+    w_result = new_list([w_item])
+    for i in range(w_list.length()):
+        w_result.append(w_list.getitem(i))
+    return w_result
+
+
+@builtin('slice')
+def slice_(w_list, w_start, w_end):
+    '''
+    a new list, of the items from `start` to `end`
+    (excluded), both clamped to the list
+    '''
+    w_list = list_arg('slice', w_list)
+    length = w_list.length()
+    start = min(max(int_arg('slice', w_start), 0), length)
+    end = min(max(int_arg('slice', w_end), start), length)
+    return w_list.slice(start, end)
+
+
+unrolling_builtins = unrolling_iterable(
+    [(i, BUILTINS[i][1], BUILTINS[i][2]) for i in range(len(BUILTINS))])
+
+
+def call(index, argc, frame):
+    '''
+    call builtin `index`, its `argc` arguments being
+    on the top of the stack of `frame`, last on top
+    '''
+    for i, arity, func in unrolling_builtins:
+        if i == index:
+            if arity == VARIADIC:
+                return func(frame.pop_values(argc))
+            elif arity == 1:
+                return func(frame.pop())
+            elif arity == 2:
+                w_y = frame.pop()
+                w_x = frame.pop()
+                return func(w_x, w_y)
+            elif arity == 3:
+                w_z = frame.pop()
+                w_y = frame.pop()
+                w_x = frame.pop()
+                return func(w_x, w_y, w_z)
+            return func()
+    raise InterpreterError("unknown builtin %d" % index)
+
+
+def call_registers(index, argc, frame, base):
+    '''
+    call builtin `index`, its `argc` arguments being in the
+    registers of `frame` from `base` on (see nolst.register)
+    '''
+    assert base >= 0
+    for i, arity, func in unrolling_builtins:
+        if i == index:
+            if arity == VARIADIC:
+                return func(frame.values(base, argc))
+            elif arity == 1:
+                return func(frame.regs[base])
+            elif arity == 2:
+                return func(frame.regs[base], frame.regs[base + 1])
+            elif arity == 3:
+                return func(frame.regs[base], frame.regs[base + 1],
+                            frame.regs[base + 2])
+            return func()
+    raise InterpreterError("unknown builtin %d" % index)
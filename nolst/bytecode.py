@@ -1,3 +1,7 @@
+from rpython.rlib.longlong2float import float2longlong
+
+from nolst import scope
+
 bytecodes = {
     'LOAD_CONSTANT': 0x00,
     'LOAD_VAR':      0x01,
@@ -22,43 +26,320 @@ bytecodes = {
 
 
     'BINARY_ADD':    0x06,
-    'BINARY_SUB':    0x07,
-    'BINARY_EQ':     0x08,
     'RETURN':        0x09,
     'PRINT':         0x10,
     'BINARY_LT':     0x11,
     'DELETE_VAR':    0x12,
+    # call the function on the top of
+    # the stack, arg is the number of arguments
     'CALL':          0x14,
+
+    # local variables of the current frame
+    'LOAD_LOCAL':    0x18,
+    'ASSIGN_LOCAL':  0x19,
+
+    # push the top of the stack again
+    'DUP_TOP':       0x1a,
+
+    # closures (see nolst.scope): cells of the current frame,
+    # values and cells of the function's closure
+    'LOAD_CELL':     0x20,
+    'ASSIGN_CELL':   0x21,
+    'LOAD_FREE':     0x22,
+    'LOAD_FREE_CELL': 0x24,
+    # like LOAD_FUNCTION, creating a lambda object
+    # capturing the values and cells it needs
+    'MAKE_CLOSURE':  0x23,
+
+    # superinstructions (see nolst.optimizer.superinstructions)
+    # LOAD_LOCAL a; LOAD_CONSTANT b; BINARY_ADD
+    'ADD_LOCAL_CONST':   0x1b,
+    # LOAD_VAR a; LOAD_CONSTANT b; BINARY_ADD
+    'ADD_VAR_CONST':     0x1c,
+    # LOAD_LOCAL a; LOAD_LOCAL b
+    'LOAD_LOCAL2':       0x1d,
+    # BINARY_LT; JUMP_IF_FALSE arg
+    'LT_JUMP_IF_FALSE':  0x1e,
+
+    # call in tail position of a function (reusing
+    # its frame), arg is the number of arguments
+    'TAIL_CALL':     0x1f,
+
+    # call a native builtin (see nolst.builtins):
+    # CALL_BUILTIN index argc
+    'CALL_BUILTIN':  0x25,
 }
 
 bytecodes_by_value = {v:k for k, v in bytecodes.iteritems()}
 
 for bytecode, value in bytecodes.iteritems():
-    print(bytecode, value)
     globals()[bytecode] = value
 
-BINOP = {'+': BINARY_ADD, '-': BINARY_SUB, '==': BINARY_EQ, '<': BINARY_LT}
+BINOP = {'+': BINARY_ADD, '<': BINARY_LT}
+# the other binary operators (BinOp nodes) have no instruction:
+# they call the matching builtin, on both VMs
+BINOP_BUILTINS = {'-': 'sub', '==': 'eq'}
+
+# opcodes whose argument is an absolute bytecode address
+# (an instruction index until the bytecode is assembled)
+ABSOLUTE_JUMPS = [JUMP_IF_FALSE, JUMP_BACKWARD, AJUMP, LT_JUMP_IF_FALSE]
+# jumps that may also go on with the next instruction
+CONDITIONAL_JUMPS = [JUMP_IF_FALSE, LT_JUMP_IF_FALSE]
+# opcodes whose argument is relative to the next instruction
+RELATIVE_JUMPS = [RJUMP]
+# opcodes returning from a code unit
+RETURNS = [RETURN, BACK]
+# opcodes after which the code unit doesn't go on
+TERMINATORS = [RETURN, BACK, TAIL_CALL]
+
+# number of operands of the opcodes having more than one
+# (each one is a varint, the jump one comes first)
+OPERANDS = {ADD_LOCAL_CONST: 2, ADD_VAR_CONST: 2, LOAD_LOCAL2: 2,
+            CALL_BUILTIN: 2}
+
+
+def operand_count(opcode):
+    return OPERANDS.get(opcode, 1)
+
+
+def stack_effect(opcode, arg, arg2=0):
+    '''
+    number of values pushed minus values popped
+    by an instruction
+    '''
+    if opcode in (LOAD_CONSTANT, LOAD_VAR, LOAD_LOCAL, LOAD_FUNCTION, DUP_TOP,
+                  ADD_LOCAL_CONST, ADD_VAR_CONST, LOAD_CELL, LOAD_FREE,
+                  LOAD_FREE_CELL, MAKE_CLOSURE):
+        return 1
+    elif opcode in (ASSIGN, ASSIGN_LOCAL, ASSIGN_CELL, DELETE_VAR, DISCARD_TOP,
+                    JUMP_IF_FALSE, BINARY_ADD, BINARY_LT):
+        return -1
+    elif opcode == LOAD_LOCAL2:
+        return 2
+    elif opcode == LT_JUMP_IF_FALSE:
+        return -2
+    elif opcode == CALL:
+        # pops the arguments and the function,
+        # pushes the result
+        return -arg
+    elif opcode == CALL_BUILTIN:
+        return 1 - arg2
+    return 0
+
+
+# Operands are encoded as little-endian base 128 varints:
+# arguments below WIDE_FLAG fit in a single byte (the common
+# case), bigger ones set WIDE_FLAG and continue on the next bytes.
+WIDE_FLAG = 0x80
+WIDE_MASK = 0x7f
+
+
+def encode_arg(arg):
+    assert arg >= 0
+    chars = []
+    while arg >= WIDE_FLAG:
+        chars.append(chr((arg & WIDE_MASK) | WIDE_FLAG))
+        arg >>= 7
+    chars.append(chr(arg))
+    return chars
+
+
+def arg_size(arg):
+    size = 1
+    while arg >= WIDE_FLAG:
+        arg >>= 7
+        size += 1
+    return size
+
+
+def decode_wide_arg(code, pc, first):
+    '''
+    slow path of operand decoding.
+    `first` is the byte already read (with WIDE_FLAG set),
+    `pc` points right after it.
+    return (arg, pc of the next instruction)
+    '''
+    arg = first & WIDE_MASK
+    shift = 7
+    while True:
+        b = ord(code[pc])
+        pc += 1
+        arg |= (b & WIDE_MASK) << shift
+        shift += 7
+        if b < WIDE_FLAG:
+            break
+    return arg, pc
+
+
+def decode_arg(code, pc):
+    '''
+    decode the operand starting at `pc`.
+    return (arg, pc of the next operand or instruction)
+    '''
+    arg = ord(code[pc])
+    pc += 1
+    if arg >= WIDE_FLAG:
+        return decode_wide_arg(code, pc, arg)
+    return arg, pc
+
+
+def next_pc(code, pc):
+    '''
+    address of the instruction following the one at `pc`
+    '''
+    pc += 1
+    for i in range(operand_count(ord(code[pc - 1]))):
+        _, pc = decode_arg(code, pc)
+    return pc
+
+
+class Instruction(object):
+    '''
+    an instruction, before assembly.
+    Jumps arguments are instruction indexes here,
+    they are turned into addresses by `CompilerContext.create_bytecode`.
+    `arg2` is the second operand of superinstructions.
+    '''
+    def __init__(self, opcode, arg=0, arg2=0):
+        self.opcode = opcode
+        self.arg = arg
+        self.arg2 = arg2
 
 
 class CompilerContext(object):
-    def __init__(self):
+    def __init__(self, previous=None):
+        '''
+        `previous` is the context of an earlier compilation
+        unit (e.g. the previous REPL input): global variable
+        names are shared with it.
+        '''
         self.data = []
         self.constants = []
-        self.names = []
-        self.names_to_numbers = {}
+        # constant pool indexes, by type then value
+        # (floats by bit pattern: 0.0 == -0.0)
+        self.int_constants = {}
+        self.float_constants = {}
+        self.bigint_constants = {}
+        self.str_constants = {}
+        self.symbol_constants = {}
+        # number of constants asked by the compiler,
+        # before deduplication
+        self.constants_requested = 0
+        if previous is None:
+            self.names = []
+            self.names_to_numbers = {}
+        else:
+            self.names = previous.names
+            self.names_to_numbers = previous.names_to_numbers
 
         self.lambdas = []
+        self.nil_constant = -1
+        # scopes (nolst.scope) of the lambdas
+        # being compiled, innermost last
+        self.scopes = []
+
+    def enter_lambda(self, lambda_scope):
+        self.scopes.append(lambda_scope)
+
+    def leave_lambda(self):
+        self.scopes.pop()
+
+    def in_lambda(self):
+        return len(self.scopes) > 0
+
+    def current_scope(self):
+        return self.scopes[-1]
+
+    def variable_kind(self, name):
+        '''
+        scope.LOCAL, CELL, FREE, FREE_CELL or GLOBAL
+        '''
+        if not self.scopes:
+            return scope.GLOBAL
+        return self.scopes[-1].kind(name)
+
+    def variable_index(self, name):
+        '''
+        slot, cell or closure index of a non-global variable
+        '''
+        return self.scopes[-1].index(name)
 
     def register_lambda(self, item):
         self.lambdas.append(item)
         return len(self.lambdas) - 1
 
+    def register_nil_constant(self):
+        from nolst.interpreter import w_nil
+        if self.nil_constant < 0:
+            self.nil_constant = self.register_constant(w_nil)
+        else:
+            self.constants_requested += 1
+        return self.nil_constant
+
     def register_constant(self, v):
+        self.constants_requested += 1
         self.constants.append(v)
         return len(self.constants) - 1
 
+    def register_int_constant(self, intval):
+        from nolst.interpreter import wrap_int
+        try:
+            idx = self.int_constants[intval]
+        except KeyError:
+            idx = self.register_constant(wrap_int(intval))
+            self.int_constants[intval] = idx
+            return idx
+        self.constants_requested += 1
+        return idx
+
+    def register_bigint_constant(self, digits):
+        from nolst.interpreter import W_BigIntObject
+        from rpython.rlib.rbigint import rbigint
+        try:
+            idx = self.bigint_constants[digits]
+        except KeyError:
+            idx = self.register_constant(W_BigIntObject(rbigint.fromdecimalstr(digits)))
+            self.bigint_constants[digits] = idx
+            return idx
+        self.constants_requested += 1
+        return idx
+
+    def register_float_constant(self, floatval):
+        from nolst.interpreter import W_FloatObject
+        bits = float2longlong(floatval)
+        try:
+            idx = self.float_constants[bits]
+        except KeyError:
+            idx = self.register_constant(W_FloatObject(floatval))
+            self.float_constants[bits] = idx
+            return idx
+        self.constants_requested += 1
+        return idx
+
+    def register_str_constant(self, strval):
+        from nolst.interpreter import wrap_string_constant
+        try:
+            idx = self.str_constants[strval]
+        except KeyError:
+            idx = self.register_constant(wrap_string_constant(strval))
+            self.str_constants[strval] = idx
+            return idx
+        self.constants_requested += 1
+        return idx
+
+    def register_symbol_constant(self, strval):
+        from nolst.interpreter import intern_symbol
+        try:
+            idx = self.symbol_constants[strval]
+        except KeyError:
+            idx = self.register_constant(intern_symbol(strval))
+            self.symbol_constants[strval] = idx
+            return idx
+        self.constants_requested += 1
+        return idx
+
     def hotfix_inst_arg(self, offset, arg):
-        self.data[offset + 1] = chr(arg)
+        self.data[offset].arg = arg
 
 
     def merge(self, cc):
@@ -79,11 +360,9 @@ class CompilerContext(object):
             return -1
 
     def register_var(self, name):
-        print('REGISTER VAR : ', name)
         try:
             return self.names_to_numbers[name]
         except KeyError:
-            print('[*] VAR CREATED: %d' %len(self.names))
             self.names_to_numbers[name] = len(self.names)
             self.names.append(name)
             return len(self.names) - 1
@@ -95,35 +374,154 @@ class CompilerContext(object):
         #    return -1
 
 
-    def emit(self, bc, arg=0):
+    def emit(self, bc, arg=0, arg2=0):
+        '''
+        append an instruction, return its index.
+        '''
         a = len(self.data)
-        self.data.append(chr(bc))
-        self.data.append(chr(arg))
+        self.data.append(Instruction(bc, arg, arg2))
         return a
 
     def size(self):
         return len(self.data)
 
 
-    def create_bytecode(self, offset=0):
-        if offset != 0:
-            for idx, v in enumerate(self.data):
-                if idx % 2:
-                    self.data[idx] += offset
+    def layout(self, offset=0):
+        '''
+        compute the address of every instruction
+        (plus the address right after the last one).
+
+        Jump arguments depend on addresses, and the size
+        of an instruction depends on its argument:
+        start with the smallest encoding everywhere and
+        grow instructions until nothing moves anymore.
+        Sizes only grow, so this terminates.
+        '''
+        count = len(self.data)
+        sizes = [2] * count
+        addrs = [0] * (count + 1)
+        changed = True
+        while changed:
+            addr = offset
+            for i in range(count):
+                addrs[i] = addr
+                addr += sizes[i]
+            addrs[count] = addr
+
+            changed = False
+            for i in range(count):
+                size = 1 + arg_size(self.encoded_arg(i, addrs))
+                if operand_count(self.data[i].opcode) > 1:
+                    size += arg_size(self.data[i].arg2)
+                if size > sizes[i]:
+                    sizes[i] = size
+                    changed = True
+        return addrs
+
+    def encoded_arg(self, i, addrs):
+        inst = self.data[i]
+        if inst.opcode in ABSOLUTE_JUMPS:
+            return addrs[inst.arg]
+        elif inst.opcode in RELATIVE_JUMPS:
+            return addrs[inst.arg] - addrs[i + 1]
+        return inst.arg
+
+    def max_stack_depth(self, entry, depth):
+        '''
+        maximum size of the value stack needed by the code unit
+        starting at instruction `entry`, with `depth` values
+        already on the stack (like CPython's co_stacksize).
 
-        return ByteCode("".join(self.data), self.constants[:], len(self.names), self.lambdas)
+        Follows every path until RETURN/BACK; lambdas nested
+        in the unit are jumped over, they are units on their own.
+        '''
+        depths = [-1] * (len(self.data) + 1)
+        max_depth = depth
+        todo = [entry, depth]
+        while todo:
+            d = todo.pop()
+            i = todo.pop()
+            while i < len(self.data):
+                if depths[i] >= 0:
+                    if depths[i] != d:
+                        raise Exception("inconsistent stack depth at %d" %i)
+                    break
+                depths[i] = d
+                inst = self.data[i]
+                op = inst.opcode
+                if op in TERMINATORS:
+                    break
+                d += stack_effect(op, inst.arg, inst.arg2)
+                assert d >= 0
+                if d > max_depth:
+                    max_depth = d
+                if op in CONDITIONAL_JUMPS:
+                    todo.append(inst.arg)
+                    todo.append(d)
+                    i += 1
+                elif op in ABSOLUTE_JUMPS or op in RELATIVE_JUMPS:
+                    i = inst.arg
+                else:
+                    i += 1
+        return max_depth
+
+    def create_bytecode(self, offset=0):
+        # value stack sizes, computed on instructions indexes
+        stacksize = self.max_stack_depth(0, 0)
+        for w_lambda in self.lambdas:
+            # arguments are locals: the stack starts empty
+            w_lambda.stacksize = self.max_stack_depth(w_lambda.args, 0)
+
+        addrs = self.layout(offset)
+        code = []
+        for i in range(len(self.data)):
+            inst = self.data[i]
+            code.append(chr(inst.opcode))
+            code += encode_arg(self.encoded_arg(i, addrs))
+            if operand_count(inst.opcode) > 1:
+                code += encode_arg(inst.arg2)
+
+        # `names` only grows, and is shared by the following inputs
+        # of a REPL: no copy, compiling a form is O(size of the form)
+        bc = ByteCode("".join(code), self.constants[:], len(self.names), self.lambdas[:],
+                      stacksize, self.constants_requested, names=self.names)
+
+        # lambdas know their entry points by instruction index
+        for w_lambda in self.lambdas:
+            w_lambda.args = addrs[w_lambda.args]
+            w_lambda.body = addrs[w_lambda.body]
+            w_lambda.bc = bc
+
+        return bc
 
 
 class ByteCode(object):
     '''
     '''
-    _immutable_fields_ = ['code', 'constants[*]', 'numvars']
+    _immutable_fields_ = ['code', 'constants[*]', 'numvars', 'lambdas[*]', 'stacksize',
+                          'profile?']
 
-    def __init__(self, code, constants, numvars, lambda_list):
+    def __init__(self, code, constants, numvars, lambda_list, stacksize,
+                 constants_requested=0, instructions_emitted=0, names=None):
         self.code = code
         self.constants = constants
         self.numvars = numvars
+        # global variable names, by index, for errors
+        # (maybe more than `numvars`, see create_bytecode)
+        if names is None:
+            names = []
+        self.names = names
         self.lambdas = lambda_list
+        # maximum depth of the value stack of the top-level code
+        self.stacksize = stacksize
+        # constant pool size before deduplication
+        self.constants_requested = constants_requested
+        # instructions count before optimization
+        self.instructions_emitted = instructions_emitted
+        # counters of --profile (a nolst.tracing.UnitProfile),
+        # set before the bytecode runs: quasi-immutable, the
+        # bytecode may have been traced by then
+        self.profile = None
 
 
     def merge(self, cc):
@@ -138,17 +536,40 @@ class ByteCode(object):
         return a
 
 
+    def instructions_count(self):
+        count = 0
+        i = 0
+        while i < len(self.code):
+            i = next_pc(self.code, i)
+            count += 1
+        return count
+
+    def stats(self):
+        '''
+        (debug) instructions count, before and after optimization,
+        constant pool size, before and after deduplication
+        '''
+        return ('instructions: %d (%d before optimization), '
+                'constants: %d (%d before dedup), stack size: %d' %(
+                    self.instructions_count(), self.instructions_emitted,
+                    len(self.constants), self.constants_requested,
+                    self.stacksize))
+
     def dump(self):
         '''
         (debug)
         '''
         lines = []
         i = 0
-        for i in range(0, len(self.code), 2):
-            c = self.code[i]
-            c2 = self.code[i + 1]
-            l = str(i) + "\t| " + bytecodes_by_value[ord(c)] + " " + str(ord(c2))
+        while i < len(self.code):
+            c = ord(self.code[i])
+            l = str(i) + "\t| " + bytecodes_by_value[c]
+            pc = i + 1
+            for _ in range(operand_count(c)):
+                arg, pc = decode_arg(self.code, pc)
+                l += " " + str(arg)
             lines.append(l)
+            i = pc
         return '\n'.join(lines)
 
 
@@ -158,8 +579,16 @@ def compile_partial(astnode, cctx=None):
     astnode.compile(cctx)
     return cctx
 
-def compile_ast(astnode, offset=0):
-    c = CompilerContext()
+def compile_ast(astnode, offset=0, previous=None, optimize=False):
+    c = CompilerContext(previous)
+    scope.analyze(astnode)
     astnode.compile(c)
     c.emit(bytecodes['RETURN'], 0)
-    return c.create_bytecode(offset=offset)
+    emitted = c.size()
+    from nolst import optimizer
+    if optimize:
+        optimizer.optimize(c)
+    optimizer.superinstructions(c)
+    bc = c.create_bytecode(offset=offset)
+    bc.instructions_emitted = emitted
+    return bc
@@ -0,0 +1,401 @@
+""" Compiled bytecode cache (.nlc files).
+
+A script `foo.nls` is compiled once into `foo.nlc`, next to it.
+The cache is used as long as it was produced from the same
+source (sha1) by the same bytecode format, with the same
+optimization setting.
+
+Layout, integers being zigzag varints:
+
+    MAGIC
+    FORMAT_VERSION
+    optimized (0 or 1)
+    source hash
+    payload hash (of everything below)
+    global names (count, then each name)
+    constants (count, then a tag and a payload for each)
+    lambdas (count, then args/body addresses, nlocals, stacksize,
+             ncells, captures, arity, name and variable
+             names for each)
+    stacksize
+    constants_requested
+    instructions_emitted
+    code
+
+The payload hash catches a corrupted or truncated file, which
+would otherwise crash the interpreter; the code is checked to
+be made of complete, known instructions. A file is written
+under a temporary name, then renamed: a killed process doesn't
+leave half of a cache behind.
+"""
+import hashlib
+import os
+import sys
+from rpython.rlib import rsha
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rfloat import formatd, string_to_float
+from rpython.rlib.rstring import ParseStringError
+from rpython.rlib.streamio import open_file_as_stream
+
+from nolst import bytecode
+from nolst.bytecode import ByteCode, encode_arg, WIDE_FLAG, WIDE_MASK
+
+MAGIC = 'NLC\x00'
+# bump whenever the bytecode (opcodes, operands encoding,
+# builtins indexes) or this layout changes
+FORMAT_VERSION = 15
+
+# biggest int the zigzag encoding holds
+MAX_VARINT = sys.maxint >> 1
+# bits of the longest varint written (see Writer.write_int)
+VARINT_BITS = 63
+
+TAG_INT = 'i'
+TAG_BIGINT = 'b'
+TAG_FLOAT = 'f'
+TAG_STR = 's'
+TAG_SYMBOL = 'y'
+TAG_NIL = 'n'
+
+
+def fits_varint(i):
+    '''
+    whether write_int can write `i`: zigzag
+    takes one bit, bigger ints go as strings
+    '''
+    return -MAX_VARINT <= i <= MAX_VARINT
+
+
+class CacheError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class CacheEntry(object):
+    '''
+    bytecode of a script, with the global variable
+    names its instructions refer to by index
+    '''
+    def __init__(self, bc, names):
+        self.bc = bc
+        self.names = names
+
+
+def digest(data):
+    if not we_are_translated():
+        # way faster than rsha, untranslated
+        return hashlib.sha1(data).hexdigest()
+    return rsha.RSHA(data).hexdigest()
+
+
+def source_hash(source):
+    return digest(source)
+
+
+def cache_path(path):
+    if path.endswith('.nls'):
+        end = len(path) - len('.nls')
+        assert end >= 0
+        return path[:end] + '.nlc'
+    return path + '.nlc'
+
+
+class Writer(object):
+    def __init__(self):
+        self.parts = []
+
+    def write_int(self, i):
+        # zigzag: small negative numbers stay short
+        assert fits_varint(i)
+        if i < 0:
+            self.parts += encode_arg(((-i) << 1) - 1)
+        else:
+            self.parts += encode_arg(i << 1)
+
+    def write_str(self, s):
+        self.write_int(len(s))
+        self.parts.append(s)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+class Loader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read_arg(self):
+        '''
+        an unsigned varint (see bytecode.encode_arg)
+        '''
+        data = self.data
+        pos = self.pos
+        arg = 0
+        shift = 0
+        while True:
+            if pos >= len(data):
+                raise CacheError('truncated')
+            if shift >= VARINT_BITS:
+                raise CacheError('varint too long')
+            b = ord(data[pos])
+            pos += 1
+            arg |= (b & WIDE_MASK) << shift
+            shift += 7
+            if b < WIDE_FLAG:
+                break
+        self.pos = pos
+        return arg
+
+    def read_int(self):
+        i = self.read_arg()
+        if i & 1:
+            return -((i + 1) >> 1)
+        return i >> 1
+
+    def read_str(self):
+        length = self.read_int()
+        start = self.pos
+        end = start + length
+        if length < 0 or end > len(self.data):
+            raise CacheError('truncated')
+        assert start >= 0 and end >= 0
+        self.pos = end
+        return self.data[start:end]
+
+    def rest(self):
+        start = self.pos
+        assert start >= 0
+        return self.data[start:]
+
+
+def check_code(code, lambdas):
+    '''
+    raise CacheError unless `code` is made of complete
+    instructions with known opcodes, its jumps and the
+    entry points of `lambdas` being instruction addresses
+    '''
+    r = Loader(code)
+    starts = {}
+    targets = []
+    while r.pos < len(code):
+        pc = r.pos
+        starts[pc] = None
+        opcode = ord(code[pc])
+        if opcode not in bytecode.bytecodes_by_value:
+            raise CacheError('unknown opcode')
+        r.pos += 1
+        arg = r.read_arg()
+        for i in range(bytecode.operand_count(opcode) - 1):
+            r.read_arg()
+        if opcode in bytecode.ABSOLUTE_JUMPS:
+            targets.append(arg)
+        elif opcode in bytecode.RELATIVE_JUMPS:
+            targets.append(r.pos + arg)
+    for w_lambda in lambdas:
+        targets.append(w_lambda.args)
+        targets.append(w_lambda.body)
+    for target in targets:
+        if target not in starts:
+            raise CacheError('bad address')
+
+
+def dump_bytecode(bc, names, source_hash, optimized=False):
+    '''
+    serialize `bc`, return None if one of its
+    constants can't be serialized.
+    '''
+    from nolst.interpreter import (W_IntObject, W_BigIntObject, W_FloatObject,
+                                   W_StringObject, W_SymbolObject, w_nil)
+    w = Writer()
+    w.write_int(len(names))
+    for name in names:
+        w.write_str(name)
+
+    w.write_int(len(bc.constants))
+    for w_const in bc.constants:
+        if isinstance(w_const, W_IntObject) and fits_varint(w_const.intval):
+            w.write_str(TAG_INT)
+            w.write_int(w_const.intval)
+        elif isinstance(w_const, W_IntObject) or isinstance(w_const, W_BigIntObject):
+            w.write_str(TAG_BIGINT)
+            w.write_str(w_const.str())
+        elif isinstance(w_const, W_FloatObject):
+            w.write_str(TAG_FLOAT)
+            w.write_str(formatd(w_const.floatval, 'r', 0))
+        elif isinstance(w_const, W_StringObject):
+            w.write_str(TAG_STR)
+            w.write_str(w_const.value())
+        elif isinstance(w_const, W_SymbolObject):
+            w.write_str(TAG_SYMBOL)
+            w.write_str(w_const.strval)
+        elif w_const is w_nil:
+            w.write_str(TAG_NIL)
+        else:
+            # e.g. quoted lists, holding AST nodes
+            return None
+
+    w.write_int(len(bc.lambdas))
+    for w_lambda in bc.lambdas:
+        w.write_int(w_lambda.args)
+        w.write_int(w_lambda.body)
+        w.write_int(w_lambda.nlocals)
+        w.write_int(w_lambda.stacksize)
+        w.write_int(w_lambda.ncells)
+        w.write_int(len(w_lambda.captures))
+        for index in w_lambda.captures:
+            w.write_int(index)
+        w.write_int(w_lambda.arity)
+        w.write_str(w_lambda.name)
+        w.write_int(len(w_lambda.varnames))
+        for name in w_lambda.varnames:
+            w.write_str(name)
+
+    w.write_int(bc.stacksize)
+    w.write_int(bc.constants_requested)
+    w.write_int(bc.instructions_emitted)
+    w.write_str(bc.code)
+    payload = w.getvalue()
+
+    header = Writer()
+    header.parts.append(MAGIC)
+    header.write_int(FORMAT_VERSION)
+    header.write_int(1 if optimized else 0)
+    header.write_str(source_hash)
+    header.write_str(digest(payload))
+    return header.getvalue() + payload
+
+
+def load_bytecode(data, expected_hash, optimized=False):
+    '''
+    return a CacheEntry, or raise CacheError
+    if `data` is not a valid cache for this source.
+    '''
+    from nolst.interpreter import (wrap_int, wrap_string_constant,
+                                   wrap_bigint, W_FloatObject, intern_symbol,
+                                   W_LambdaObject, w_nil)
+    if not data.startswith(MAGIC):
+        raise CacheError('not a nolst cache')
+    r = Loader(data)
+    r.pos = len(MAGIC)
+    if r.read_int() != FORMAT_VERSION:
+        raise CacheError('outdated format')
+    if r.read_int() != (1 if optimized else 0):
+        raise CacheError('other optimization setting')
+    if r.read_str() != expected_hash:
+        raise CacheError('outdated source')
+    if r.read_str() != digest(r.rest()):
+        raise CacheError('corrupted')
+
+    names = []
+    for i in range(r.read_int()):
+        names.append(r.read_str())
+
+    constants = []
+    for i in range(r.read_int()):
+        tag = r.read_str()
+        if tag == TAG_INT:
+            constants.append(wrap_int(r.read_int()))
+        elif tag == TAG_BIGINT:
+            constants.append(wrap_bigint(rbigint.fromdecimalstr(r.read_str())))
+        elif tag == TAG_FLOAT:
+            try:
+                constants.append(W_FloatObject(string_to_float(r.read_str())))
+            except ParseStringError:
+                raise CacheError('bad float')
+        elif tag == TAG_STR:
+            constants.append(wrap_string_constant(r.read_str()))
+        elif tag == TAG_SYMBOL:
+            constants.append(intern_symbol(r.read_str()))
+        elif tag == TAG_NIL:
+            constants.append(w_nil)
+        else:
+            raise CacheError('unknown constant')
+
+    lambdas = []
+    for i in range(r.read_int()):
+        args = r.read_int()
+        body = r.read_int()
+        nlocals = r.read_int()
+        stacksize = r.read_int()
+        ncells = r.read_int()
+        captures = []
+        for j in range(r.read_int()):
+            captures.append(r.read_int())
+        arity = r.read_int()
+        name = r.read_str()
+        varnames = []
+        for j in range(r.read_int()):
+            varnames.append(r.read_str())
+        lambdas.append(W_LambdaObject(args, body, nlocals, stacksize,
+                                      ncells, captures, arity, name,
+                                      varnames))
+
+    stacksize = r.read_int()
+    constants_requested = r.read_int()
+    instructions_emitted = r.read_int()
+    code = r.read_str()
+    if r.pos != len(data):
+        raise CacheError('trailing data')
+    check_code(code, lambdas)
+    bc = ByteCode(code, constants[:], len(names), lambdas[:], stacksize,
+                  constants_requested, instructions_emitted, names[:])
+    for w_lambda in lambdas:
+        w_lambda.bc = bc
+    return CacheEntry(bc, names)
+
+
+def read_file(path):
+    f = open_file_as_stream(path)
+    try:
+        return f.readall()
+    finally:
+        f.close()
+
+
+def write_file(path, data):
+    '''
+    write `path` at once: written to a temporary file
+    first, renamed when it is complete
+    '''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        f = open_file_as_stream(tmp, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def load(path, source, optimized=False):
+    '''
+    return the CacheEntry of script `path`,
+    or None if there is no valid cache
+    '''
+    try:
+        data = read_file(cache_path(path))
+    except (IOError, OSError):
+        return None
+    try:
+        return load_bytecode(data, source_hash(source), optimized)
+    except CacheError:
+        return None
+
+
+def store(path, source, bc, names, optimized=False):
+    data = dump_bytecode(bc, names, source_hash(source), optimized)
+    if data is None:
+        return
+    try:
+        write_file(cache_path(path), data)
+    except (IOError, OSError):
+        # e.g. read-only directory: run without cache
+        pass
@@ -1,37 +1,97 @@
 from nolst.sourceparser import parse
-from nolst.bytecode import compile_ast
+from nolst.bytecode import compile_ast, CompilerContext
 from nolst import bytecode
+from nolst import cache
+from nolst import scope
 from rpython.rlib import jit
-import os
+from rpython.rlib.debug import make_sure_not_resized
+from rpython.rlib.objectmodel import specialize
+from rpython.rlib.rarithmetic import ovfcheck
+from rpython.rlib.rbigint import rbigint
 
 def printable_loc(pc, code, bc):
-    return str(pc) + " " + bytecode.bytecodes_by_value[ord(code[pc])]
-
+    arg, _ = bytecode.decode_arg(code, pc + 1)
+    loc = str(pc) + " " + bytecode.bytecodes_by_value[ord(code[pc])] + " " + str(arg)
+    for w_lambda in bc.lambdas:
+        if w_lambda.args == pc:
+            return loc + " (function entry)"
+    return loc
+
+# Loops are closed at a (pc, code) location: JUMP_BACKWARD targets
+# (while loops) and function entry points, where (tail) recursive
+# calls go back to. `code` tells apart the same pc in different
+# compilation units; `bc` always comes with its `code`.
+# The frame is not a virtualizable, even though its value stack
+# is sized exactly by the compiler: a trace follows calls and
+# returns, and may close its loop in another frame than the one
+# it started in, while a virtualizable is bound to a single one.
+# With it, tracing a tail call aborts (the frame escapes into
+# FrameStack.reenter) and recursive calls are miscompiled. The
+# price is paid by loops staying in one frame: their stack and
+# locals are written to the frame at every iteration, e.g. 77
+# operations instead of 59 for a while loop in a lambda (see
+# benchmarks/traces.py).
 driver = jit.JitDriver(greens = ['pc', 'code', 'bc'],
-                       reds = ['frame'],
-                       virtualizables=['frame'],
+                       reds = ['frame', 'frames'],
                        get_printable_location=printable_loc)
+# the loop counting for --profile (see dispatch): the same
+# locations, compiled apart from the production loop
+profiled_driver = jit.JitDriver(greens = ['pc', 'code', 'bc'],
+                                reds = ['frame', 'frames'],
+                                get_printable_location=printable_loc,
+                                is_recursive=True,
+                                name='profiled')
+
+class InterpreterError(Exception):
+    '''
+    error of the running program (bad call...)
+    '''
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# numeric tags of the values (their class's `numeric`):
+# arithmetic dispatches on them. An int and a float
+# give a float, an int and a big int a big int: the kind
+# of a result is the biggest tag.
+NOT_NUMERIC = 0
+NUMERIC_INT = 1
+NUMERIC_BIGINT = 2
+NUMERIC_FLOAT = 3
+
 
 class W_Root(object):
-    pass
+    '''
+    base of the values. Value classes declare their __slots__
+    (no instance dict untranslated, checked attributes once
+    translated), and the fields never changing once the value
+    is in use in _immutable_fields_, for the JIT.
+    '''
+    __slots__ = ()
+    numeric = NOT_NUMERIC
+
+    def add(self, other):
+        raise InterpreterError("can't add %s and %s" % (self.str(), other.str()))
+
+    def lt(self, other):
+        raise InterpreterError("can't compare %s and %s" % (self.str(), other.str()))
+
+    def is_true(self):
+        return True
+
+    def str(self):
+        return '<object>'
 
-DEBUG = os.environ.get('NDBG')
 
 class W_IntObject(W_Root):
+    __slots__ = ('intval',)
+    _immutable_fields_ = ['intval']
+    numeric = NUMERIC_INT
+
     def __init__(self, intval):
         assert(isinstance(intval, int))
         self.intval = intval
 
-    def add(self, other):
-        if not isinstance(other, W_IntObject):
-            raise Exception("wrong type: %s" %str(other))
-        return W_IntObject(self.intval + other.intval)
-
-    def lt(self, other):
-        if not isinstance(other, W_IntObject):
-            raise Exception("wrong type")
-        return W_IntObject(self.intval < other.intval)
-
     def is_true(self):
         return self.intval != 0
 
@@ -39,134 +99,436 @@ class W_IntObject(W_Root):
         return str(self.intval)
 
 
+# preallocated small integers, shared by every compilation
+# and by arithmetic results
+SMALL_INT_MIN = -5
+SMALL_INT_MAX = 1024
+small_ints = [W_IntObject(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+
+def wrap_int(intval):
+    '''
+    return a W_IntObject, reusing preallocated small integers
+    '''
+    if SMALL_INT_MIN <= intval <= SMALL_INT_MAX:
+        return small_ints[intval - SMALL_INT_MIN]
+    return W_IntObject(intval)
+
+# results of comparisons
+w_true = wrap_int(1)
+w_false = wrap_int(0)
+
+
+def wrap_bool(boolval):
+    if boolval:
+        return w_true
+    return w_false
+
+
+class W_BigIntObject(W_Root):
+    '''
+    an int not fitting in a machine word: arithmetic on
+    W_IntObjects gives one when it overflows. Never holds
+    a value a W_IntObject could (see wrap_bigint).
+    '''
+    __slots__ = ('bigval',)
+    _immutable_fields_ = ['bigval']
+    numeric = NUMERIC_BIGINT
+
+    def __init__(self, bigval):
+        assert(isinstance(bigval, rbigint))
+        self.bigval = bigval
+
+    def is_true(self):
+        return self.bigval.tobool()
+
+    def str(self):
+        return self.bigval.str()
+
+
+def wrap_bigint(bigval):
+    '''
+    return a W_IntObject if `bigval` fits
+    in a machine word, a W_BigIntObject otherwise
+    '''
+    try:
+        return wrap_int(bigval.toint())
+    except OverflowError:
+        return W_BigIntObject(bigval)
+
+
+def bigint_value(w_number):
+    '''
+    the value of an int or big int, as an rbigint
+    '''
+    if isinstance(w_number, W_IntObject):
+        return rbigint.fromint(w_number.intval)
+    assert isinstance(w_number, W_BigIntObject)
+    return w_number.bigval
+
+
+class StringBuffer(object):
+    '''
+    strings concatenated one after the other, shared
+    by the W_StringObjects made of its first pieces
+    '''
+    def __init__(self, first):
+        self.pieces = [first]
+
+
 class W_StringObject(W_Root):
-    def __init__(self, strval):
-        assert(isinstance(strval, str))
+    '''
+    a string. Concatenating appends the right operand to a
+    StringBuffer shared with the left one, when the left one
+    ends the buffer: building a string piece by piece is
+    linear, not quadratic. The flat string is joined when
+    first needed (see `value`).
+    '''
+    __slots__ = ('strval', 'length', 'buffer', 'npieces')
+    _immutable_fields_ = ['length', 'buffer', 'npieces']
+    def __init__(self, strval, buffer=None, npieces=0, length=0):
+        # flat value, None until needed
         self.strval = strval
+        if strval is not None:
+            length = len(strval)
+        self.length = length
+        # a concatenation result: the `npieces`
+        # first pieces of `buffer`
+        self.buffer = buffer
+        self.npieces = npieces
+
+    def value(self):
+        if self.strval is None:
+            buffer = self.buffer
+            assert buffer is not None
+            self.strval = ''.join(buffer.pieces[:self.npieces])
+        return self.strval
+
+    def concat(self, other):
+        right = other.value()
+        buffer = self.buffer
+        if buffer is not None and self.npieces == len(buffer.pieces):
+            # nobody extended the buffer after us: in place
+            buffer.pieces.append(right)
+        else:
+            buffer = StringBuffer(self.value())
+            buffer.pieces.append(right)
+        return W_StringObject(None, buffer, len(buffer.pieces),
+                              self.length + other.length)
 
     def add(self, other):
         if not isinstance(other, W_StringObject):
-            raise Exception("wrong type")
-        return W_StringObject(self.strval + other.strval)
+            return W_Root.add(self, other)
+        return self.concat(other)
 
     def lt(self, other):
         if not isinstance(other, W_StringObject):
-            raise Exception("wrong type")
-        return W_IntObject(self.strval < other.strval)
-
-    def is_true(self):
-        return True
+            return W_Root.lt(self, other)
+        return wrap_bool(self.value() < other.value())
 
     def str(self):
-        return self.strval
+        return self.value()
+
+
+# string constants are immutable: a literal is wrapped only once,
+# and shared by every compilation
+string_constants = {}
+
+
+def wrap_string_constant(strval):
+    try:
+        return string_constants[strval]
+    except KeyError:
+        w = W_StringObject(strval)
+        string_constants[strval] = w
+        return w
+
+wrap_string_constant('')
+
+
+class W_Cell(W_Root):
+    '''
+    a variable captured by a lambda (see nolst.scope),
+    shared by the frame defining it and the closures.
+    Programs never see cells, only their values.
+    '''
+    __slots__ = ('w_value',)
+
+    def __init__(self, w_value=None):
+        self.w_value = w_value
+
+
+no_closure = []
 
 
 class W_LambdaObject(W_Root):
     '''
     used for lambda.
+    (code addresses, sizes and bytecode are
+    set by the compiler, before any call)
     '''
-    def __init__(self, args, body):
+    __slots__ = ('args', 'body', 'nlocals', 'stacksize', 'bc', 'ncells',
+                 'captures', 'closure', 'arity', 'name', 'varnames')
+    _immutable_fields_ = ['args', 'body', 'nlocals', 'stacksize', 'bc',
+                          'ncells', 'captures', 'closure', 'arity', 'name',
+                          'varnames[*]']
+    def __init__(self, args, body, nlocals=0, stacksize=0, ncells=0,
+                 captures=None, arity=0, name='lambda', varnames=None):
         #assert(isinstance(strval, str))
         self.args = args
         self.body = body
+        # number of local variables, arguments included
+        self.nlocals = nlocals
+        # maximum depth of the value stack,
+        # computed once the bytecode is assembled
+        self.stacksize = stacksize
+        # bytecode holding the function,
+        # set once the bytecode is assembled
+        self.bc = None
+        # number of cells of a call
+        self.ncells = ncells
+        # where MAKE_CLOSURE finds each closure entry
+        # in the creating frame (scope.encode_capture)
+        if captures is None:
+            captures = []
+        self.captures = captures
+        # captured values and cells
+        self.closure = no_closure
+        # number of arguments
+        self.arity = arity
+        # the variable it was defined as, for profiles
+        self.name = name
+        # names of the slots, the cells, then the closure
+        # entries (Scope.variable_names), for errors
+        if varnames is None:
+            varnames = []
+        self.varnames = varnames
+
+    def with_closure(self, closure):
+        '''
+        a lambda object sharing our code
+        '''
+        w_closure = W_LambdaObject(self.args, self.body, self.nlocals,
+                                   self.stacksize, self.ncells, self.captures,
+                                   self.arity, self.name, self.varnames)
+        w_closure.bc = self.bc
+        w_closure.closure = closure
+        return w_closure
+
+    def cell_name(self, index):
+        return self.varnames[self.nlocals + index]
+
+    def free_name(self, index):
+        return self.varnames[self.nlocals + self.ncells + index]
 
-    def add(self, other):
-        raise NotImplementedError('Invalid operation')
+    def str(self):
+        return "Lambda(args:%s body:%s)" %(self.args, self.body)
 
-    def lt(self, other):
-        raise NotImplementedError('Invalid operation')
+
+class W_NilObject(W_Root):
+    '''
+    the value of expressions producing nothing
+    (e.g. the result of a function returning nothing)
+    '''
+    __slots__ = ()
 
     def is_true(self):
-        return True
+        return False
 
     def str(self):
-        return "Lambda(args:%s body:%s)" %(self.args, self.body)
+        return 'nil'
+
+w_nil = W_NilObject()
 
 
 class W_SymbolObject(W_Root):
     '''
-    used for unevaluated stuff
+    used for unevaluated stuff.
+    Interned (see intern_symbol): compared by identity.
     '''
+    __slots__ = ('strval',)
+    _immutable_fields_ = ['strval']
+
     def __init__(self, strval):
         assert(isinstance(strval, str))
         self.strval = strval
 
-    def add(self, other):
-        raise NotImplementedError('Invalid operation')
-
     def lt(self, other):
         if not isinstance(other, W_SymbolObject):
-            raise Exception("wrong type")
-        return W_IntObject(self.strval < other.strval)
-
-    def is_true(self):
-        return True
+            return W_Root.lt(self, other)
+        return wrap_bool(self.strval < other.strval)
 
     def str(self):
         return self.strval
 
 
+# symbols by name: a symbol is wrapped only once
+symbols = {}
+
+
+def intern_symbol(strval):
+    try:
+        return symbols[strval]
+    except KeyError:
+        w = W_SymbolObject(strval)
+        symbols[strval] = w
+        return w
+
+
 
 class W_FloatObject(W_Root):
+    __slots__ = ('floatval',)
+    _immutable_fields_ = ['floatval']
+    numeric = NUMERIC_FLOAT
+
     def __init__(self, floatval):
         assert(isinstance(floatval, float))
         self.floatval = floatval
 
-    def add(self, other):
-        if not isinstance(other, W_FloatObject):
-            raise Exception("wrong type")
-        return W_FloatObject(self.floatval + other.floatval)
-
-    def lt(self, other):
-        if not isinstance(other, W_FloatObject):
-            raise Exception("wrong type")
-        return W_IntObject(self.floatval < other.floatval)
+    def is_true(self):
+        return self.floatval != 0.0
 
     def str(self):
         return str(self.floatval)
 
+
+def numeric_kind(w_left, w_right):
+    '''
+    NUMERIC_INT, NUMERIC_BIGINT or NUMERIC_FLOAT: the kind of the result of
+    arithmetic on `w_left` and `w_right`, NOT_NUMERIC if one
+    of them is not a number
+    '''
+    left = w_left.numeric
+    right = w_right.numeric
+    if left == NOT_NUMERIC or right == NOT_NUMERIC:
+        return NOT_NUMERIC
+    return max(left, right)
+
+
+def float_value(w_number):
+    '''
+    the value of a number, as a float
+    '''
+    if isinstance(w_number, W_IntObject):
+        return float(w_number.intval)
+    elif isinstance(w_number, W_BigIntObject):
+        try:
+            return w_number.bigval.tofloat()
+        except OverflowError:
+            raise InterpreterError("int too large for a float: %s" % w_number.str())
+    assert isinstance(w_number, W_FloatObject)
+    return w_number.floatval
+
+
 class W_ListObject(W_Root):
-    def __init__(self, content):
-        assert(isinstance(content, list))
-        self.content = content
+    '''
+    a list, built at runtime (see the list builtins).
+
+    Storage strategies: as long as the list only holds ints,
+    they are stored unboxed in `ints`. The first other object
+    moves them, wrapped, to `items`, for good. Exactly one of
+    them is not None; both are resizable arrays (appending
+    is amortized O(1)).
+    '''
+    __slots__ = ('items', 'ints')
+
+    def __init__(self, items=None, ints=None):
+        if items is None and ints is None:
+            ints = []
+        self.items = items
+        self.ints = ints
+
+    def length(self):
+        if self.ints is not None:
+            return len(self.ints)
+        return len(self.items)
+
+    def getitem(self, i):
+        '''
+        item `i`, which must be in range
+        '''
+        if self.ints is not None:
+            return wrap_int(self.ints[i])
+        return self.items[i]
+
+    def switch_to_objects(self):
+        ints = self.ints
+        assert ints is not None
+        self.items = [wrap_int(i) for i in ints]
+        self.ints = None
+
+    def append(self, w_item):
+        if self.ints is not None:
+            if isinstance(w_item, W_IntObject):
+                self.ints.append(w_item.intval)
+                return
+            self.switch_to_objects()
+        self.items.append(w_item)
+
+    def slice(self, start, end):
+        '''
+        a new list, of the items from `start` to `end` (excluded)
+        '''
+        assert start >= 0 and end >= 0 and start <= end
+        if self.ints is not None:
+            return W_ListObject(ints=self.ints[start:end])
+        return W_ListObject(items=self.items[start:end])
 
     def add(self, other):
         if not isinstance(other, W_ListObject):
-            raise Exception("wrong type")
-        return W_ListObject(self.content + other.content)
+            return W_Root.add(self, other)
+        if self.ints is not None and other.ints is not None:
+            return W_ListObject(ints=self.ints + other.ints)
+        w_list = self.slice(0, self.length())
+        for i in range(other.length()):
+            w_list.append(other.getitem(i))
+        return w_list
 
     def lt(self, other):
         if not isinstance(other, W_ListObject):
-            raise Exception("wrong type")
-        return W_IntObject(len(self.content) < len(other.content))
-
-    def is_true(self):
-        return True
+            return W_Root.lt(self, other)
+        return wrap_bool(self.length() < other.length())
 
     def str(self):
-        return '[%s]' %', '.join([str(i) for i in self.content])
+        parts = []
+        for i in range(self.length()):
+            parts.append(self.getitem(i).str())
+        return '[' + ', '.join(parts) + ']'
+
+
+def new_list(items_w):
+    '''
+    a W_ListObject holding `items_w`, with
+    the int strategy if they all are ints
+    '''
+    ints = []
+    for w_item in items_w:
+        if not isinstance(w_item, W_IntObject):
+            return W_ListObject(items=items_w)
+        ints.append(w_item.intval)
+    return W_ListObject(ints=ints)
 
 
 class W_QuotedListObject(W_Root):
     '''
     KInda list, but for quoted code
     '''
+    __slots__ = ('content',)
+    _immutable_fields_ = ['content']
+
     def __init__(self, content):
         assert(isinstance(content, list))
         self.content = content
 
     def add(self, other):
         if not isinstance(other, W_QuotedListObject):
-            raise Exception("wrong type")
+            return W_Root.add(self, other)
         return W_QuotedListObject(self.content + other.content)
 
     def lt(self, other):
         if not isinstance(other, W_QuotedListObject):
-            raise Exception("wrong type")
-        return W_IntObject(len(self.content) < len(other.content))
-
-    def is_true(self):
-        return True
+            return W_Root.lt(self, other)
+        return wrap_bool(len(self.content) < len(other.content))
 
     def str(self):
         s = '('
@@ -180,53 +542,72 @@ class W_QuotedListObject(W_Root):
         return '(%s)' %', '.join([str(i) for i in self.content])
 
 
-class Locals(object):
-    '''
-    '''
-    _virtualizable_ = ['valuestack[*]', 'valuestack_pos', 'vars[*]']
-
-    def __init__(self, entry_addr, return_addr):
-        self = jit.hint(self, fresh_virtualizable=True, access_directly=True)
-        self.entry_addr = entry_addr
-        self.return_addr = return_addr
-        self.valuestack = [None] * 5
-        # safe estimate! no more 5 arguments to a local
-        # context
-        self.vars = [None] * bc.numvars
-        self.valuestack_pos = 0
-        self.vars = []
-
-
-    def get_var(self, idx):
-        pos = jit.hint(self.valuestack_pos, promote=True)
-        new_pos = pos - 1
-        assert new_pos >= 0
-        v = self.valuestack[new_pos]
-        self.valuestack_pos = new_pos
-        return v
+# initial capacity of the frame stack
+FRAMESTACK_SIZE = 64
 
+no_cells = []
 
-    def dump(self):
-        b = ''
-        for i, v in enumerate(self.vars):
-            if v:
-                b += '%s: %s\n' %(hex(i), v.str())
-        return b
 
+def new_cells(ncells):
+    if ncells == 0:
+        return no_cells
+    return [W_Cell() for i in range(ncells)]
 
 
 class Frame(object):
-    _virtualizable_ = ['valuestack[*]', 'valuestack_pos', 'vars[*]']
-
-    def __init__(self, bc):
-        self = jit.hint(self, fresh_virtualizable=True, access_directly=True)
-        self.valuestack = [None] * 10 # safe estimate!
-        self.vars = [None] * bc.numvars
+    '''
+    an activation record: the top-level code, or a function call.
+    '''
+    def __init__(self, w_vars, size):
+        # global variables, shared by every frame
+        self.vars = w_vars
+        # local variables (arguments first),
+        # followed by the value stack.
+        # Sized by the compiler, never resized.
+        self.stack = [None] * size
+        make_sure_not_resized(self.stack)
+        self.nlocals = 0
+        self.valuestack_pos = 0
+        # calling frame, and where to resume its execution
+        self.back = None
+        self.return_pc = 0
+        self.return_bc = None
+        # cells of the captured local variables,
+        # and the closure of the running function
+        self.cells = no_cells
+        self.closure = no_closure
+        # the running function, None at top-level
+        self.function = None
+
+    def reset(self, nlocals):
+        '''
+        prepare a (maybe reused) frame for a new call
+        '''
+        for i in range(nlocals):
+            self.stack[i] = None
+        self.nlocals = nlocals
+        self.valuestack_pos = nlocals
+
+    def resize_vars(self, numvars):
+        '''
+        make room for variables registered by
+        a later compilation unit. The list grows in place
+        (every frame shares it), doubling its capacity:
+        amortized O(1) per variable over a REPL session.
+        '''
+        size = len(self.vars)
+        if numvars > size:
+            self.vars.extend([None] * (max(numvars, 2 * size) - size))
+
+    def prepare_toplevel(self, bc):
+        '''
+        reuse the top-level frame of a session for
+        the next input: globals and value stack big enough
+        '''
+        self.resize_vars(bc.numvars)
+        if len(self.stack) < bc.stacksize:
+            self.stack = [None] * bc.stacksize
         self.valuestack_pos = 0
-        self.lambdas = bc.lambdas
-
-    def load_lambda(self, name):
-        return self.lambdas[name]
 
 
     def dump_vars(self):
@@ -234,90 +615,364 @@ class Frame(object):
         for i, v in enumerate(self.vars):
             if v:
                 b += '%s: %s\n' %(hex(i), v.str())
+        for i in range(self.nlocals):
+            v = self.stack[i]
+            if v:
+                b += 'local %s: %s\n' %(hex(i), v.str())
         return b
 
     def dump_stack(self):
         b = ''
 
-        for i, _ in enumerate(self.valuestack):
-            if self.valuestack[i] or i == self.valuestack_pos:
-                b += "%s:\t%s" %(hex(i), self.valuestack[i])
+        for i in range(self.nlocals, len(self.stack)):
+            if self.stack[i] or i == self.valuestack_pos:
+                b += "%s:\t%s" %(hex(i), self.stack[i])
                 if i == self.valuestack_pos - 1:
                     b += ' <---'
                 b += '\n'
 
         return  b
 
+    def local(self, index):
+        '''
+        local variable `index`: an InterpreterError
+        if it isn't defined yet
+        '''
+        w_value = self.stack[index]
+        if w_value is None:
+            raise undefined_variable(self.function.varnames[index])
+        return w_value
+
+    def var(self, bc, index):
+        w_value = self.vars[index]
+        if w_value is None:
+            raise undefined_variable(bc.names[index])
+        return w_value
+
+    def cell(self, index):
+        w_value = self.cells[index].w_value
+        if w_value is None:
+            raise undefined_variable(self.function.cell_name(index))
+        return w_value
+
+    def free_cell(self, index):
+        w_cell = self.closure[index]
+        assert isinstance(w_cell, W_Cell)
+        if w_cell.w_value is None:
+            raise undefined_variable(self.function.free_name(index))
+        return w_cell.w_value
+
     def push(self, v):
         pos = jit.hint(self.valuestack_pos, promote=True)
         assert pos >= 0
-        self.valuestack[pos] = v
+        self.stack[pos] = v
         self.valuestack_pos = pos + 1
 
     def pop(self):
         pos = jit.hint(self.valuestack_pos, promote=True)
         new_pos = pos - 1
+        assert new_pos >= self.nlocals
         assert new_pos >= 0
-        v = self.valuestack[new_pos]
+        v = self.stack[new_pos]
         self.valuestack_pos = new_pos
         return v
 
+    @jit.unroll_safe
+    def pop_values(self, count):
+        '''
+        pop `count` values, returned in push order
+        (`count` comes from the bytecode: constant
+        for the JIT, which unrolls the loop)
+        '''
+        values = [None] * count
+        for i in range(count - 1, -1, -1):
+            values[i] = self.pop()
+        return values
+
+
+def toplevel_frame(bc, w_vars=None):
+    '''
+    frame running `bc`'s top-level code, with
+    the given (or brand new) global variables
+    '''
+    if w_vars is None:
+        w_vars = [None] * bc.numvars
+    return Frame(w_vars, bc.stacksize)
+
+
+class FrameStack(object):
+    '''
+    frames of the ongoing calls, indexed by call depth.
+    A frame is kept once its call returns, and reused
+    by the next call at the same depth.
+    '''
+    def __init__(self):
+        self.frames = [None] * FRAMESTACK_SIZE
+        self.depth = 0
+
+    def enter(self, w_function, caller, argc):
+        '''
+        return the frame of a call to `w_function`,
+        with the `argc` arguments moved from the caller
+        '''
+        depth = self.depth
+        if depth == len(self.frames):
+            self.frames = self.frames + [None] * len(self.frames)
+        size = w_function.nlocals + w_function.stacksize
+        frame = self.frames[depth]
+        if frame is None or len(frame.stack) < size:
+            frame = Frame(caller.vars, size)
+            self.frames[depth] = frame
+        else:
+            frame.vars = caller.vars
+        frame.reset(w_function.nlocals)
+        frame.cells = new_cells(w_function.ncells)
+        frame.closure = w_function.closure
+        frame.function = w_function
+        self.depth = depth + 1
+
+        # arguments are the first local variables:
+        # copied there at once, nothing to bind
+        base = caller.valuestack_pos - argc
+        assert base >= caller.nlocals
+        for i in range(argc):
+            frame.stack[i] = caller.stack[base + i]
+        caller.valuestack_pos = base
+        frame.back = caller
+        return frame
+
+    def reenter(self, w_function, frame, argc):
+        '''
+        return the frame of a tail call to `w_function` from
+        `frame`: `frame` itself, or a new one taking its place
+        if it is too small. The `argc` arguments are moved
+        where a call would have put them: the first locals.
+        '''
+        size = w_function.nlocals + w_function.stacksize
+        nlocals = w_function.nlocals
+        base = frame.valuestack_pos - argc
+        assert base >= frame.nlocals
+        if len(frame.stack) < size:
+            callee = Frame(frame.vars, size)
+            callee.reset(nlocals)
+            for i in range(argc):
+                callee.stack[i] = frame.stack[base + i]
+            callee.back = frame.back
+            callee.return_pc = frame.return_pc
+            callee.return_bc = frame.return_bc
+            callee.cells = new_cells(w_function.ncells)
+            callee.closure = w_function.closure
+            callee.function = w_function
+            self.frames[self.depth - 1] = callee
+            return callee
+
+        # arguments move down, maybe overlapping their
+        # destination: copying forward never overwrites
+        # one not copied yet
+        for i in range(argc):
+            frame.stack[i] = frame.stack[base + i]
+        for i in range(argc, nlocals):
+            frame.stack[i] = None
+        frame.nlocals = nlocals
+        frame.valuestack_pos = nlocals
+        frame.cells = new_cells(w_function.ncells)
+        frame.closure = w_function.closure
+        frame.function = w_function
+        return frame
+
+    def leave(self, frame):
+        self.depth -= 1
+        frame.back = None
+
+
+def undefined_variable(name):
+    '''
+    the error of reading a variable before its `def`
+    '''
+    return InterpreterError("undefined variable %s" % name)
+
+
+def check_call(w_function, argc):
+    '''
+    raise an InterpreterError, unless `w_function`
+    is a lambda taking `argc` arguments
+    '''
+    if w_function is None:
+        raise InterpreterError("not a function: <undefined>")
+    if not isinstance(w_function, W_LambdaObject):
+        raise InterpreterError("not a function: %s" % w_function.str())
+    if argc != w_function.arity:
+        raise InterpreterError("function expects %d arguments, got %d"
+                               % (w_function.arity, argc))
+
+
 def add(left, right):
     return left + right
 
 
+def binary_add(left, right):
+    # numbers: no method call
+    kind = numeric_kind(left, right)
+    if kind == NUMERIC_INT:
+        assert isinstance(left, W_IntObject) and isinstance(right, W_IntObject)
+        try:
+            return wrap_int(ovfcheck(left.intval + right.intval))
+        except OverflowError:
+            return W_BigIntObject(bigint_value(left).add(bigint_value(right)))
+    elif kind == NUMERIC_BIGINT:
+        return wrap_bigint(bigint_value(left).add(bigint_value(right)))
+    elif kind == NUMERIC_FLOAT:
+        return W_FloatObject(float_value(left) + float_value(right))
+    return left.add(right)
+
+
+def binary_lt(left, right):
+    kind = numeric_kind(left, right)
+    if kind == NUMERIC_INT:
+        assert isinstance(left, W_IntObject) and isinstance(right, W_IntObject)
+        return wrap_bool(left.intval < right.intval)
+    elif kind == NUMERIC_BIGINT:
+        return wrap_bool(bigint_value(left).lt(bigint_value(right)))
+    elif kind == NUMERIC_FLOAT:
+        return wrap_bool(float_value(left) < float_value(right))
+    return left.lt(right)
+
+
+def is_true(w_cond):
+    if w_cond is w_false:
+        return False
+    return w_cond is w_true or w_cond.is_true()
+
+
 
 def execute(frame, bc):
     '''
     execute bytecode `bc.code`.
     `frame` represents the stack
     '''
+    dispatch(frame, bc, None, False, False)
+
+
+def execute_profiled(frame, bc):
+    '''
+    execute bytecode `bc.code`, counting in the
+    UnitProfile of every bytecode run (see nolst.tracing)
+    '''
+    dispatch(frame, bc, None, False, True)
+
 
-    # rec is used for function call return addr
-    rec = []
+def execute_traced(frame, bc, tracer):
+    '''
+    execute bytecode `bc.code`, reporting every
+    instruction to `tracer` (see nolst.tracing)
+    '''
+    dispatch(frame, bc, tracer, True, True)
+
+
+@specialize.arg(3, 4)
+def dispatch(frame, bc, tracer, traced, profiled):
+    '''
+    the interpreter loop. It is specialized on the constants
+    `traced` and `profiled`: without them, every tracing and
+    profiling test is folded away and we get the production
+    loop. The profiling loop has its own driver (a driver has
+    a single merge point), the tracing loop no JIT hints; it
+    counts too when a profile is attached.
+    '''
+    from nolst import builtins
+    # frames of the ongoing function calls
+    frames = FrameStack()
     code = bc.code
     pc = 0
     while True:
-        # required hint indicating this is the top of the opcode dispatch
-        driver.jit_merge_point(pc=pc, code=code, bc=bc, frame=frame)
+        if traced:
+            pass
+        elif profiled:
+            profiled_driver.jit_merge_point(pc=pc, code=code, bc=bc, frame=frame,
+                                            frames=frames)
+        else:
+            # required hint indicating this is the top of the opcode dispatch
+            driver.jit_merge_point(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+        opcode_pc = pc
         c = ord(code[pc])
         arg = ord(code[pc + 1])
         pc += 2
-
-        if DEBUG:
-            # DEBUG, dump everyting for each opcodes
-            print(
-                'INSTRUCTION: %s(ARG:%s) @%d\n'
-                %(bytecode.bytecodes_by_value[c], hex(arg) if arg else 'NO_ARG', pc)
-            )
+        if arg >= bytecode.WIDE_FLAG:
+            # wide operand, encoded on several bytes
+            arg, pc = bytecode.decode_wide_arg(code, pc, arg)
+        # operands index the frame's stack
+        assert arg >= 0
+
+        if traced:
+            tracer.instruction(bc, opcode_pc, c, arg, frame, frames.depth)
+        if profiled:
+            profile = bc.profile
+            if profile is not None and profile.blocks[opcode_pc] > 0:
+                # once per basic block (bc and pc are greens:
+                # the JIT folds this test away inside a block)
+                profile.count(opcode_pc, frame)
 
         if c == bytecode.LOAD_CONSTANT:
             w_constant = bc.constants[arg]
             frame.push(w_constant)
         elif c == bytecode.DISCARD_TOP:
             frame.pop()
+        elif c == bytecode.DUP_TOP:
+            w_top = frame.pop()
+            frame.push(w_top)
+            frame.push(w_top)
         elif c == bytecode.RETURN:
             return
         elif c == bytecode.BINARY_ADD:
             right = frame.pop()
             left = frame.pop()
-            w_res = left.add(right)
-            frame.push(w_res)
+            frame.push(binary_add(left, right))
 
         elif c == bytecode.BINARY_LT:
             right = frame.pop()
             left = frame.pop()
-            frame.push(left.lt(right))
+            frame.push(binary_lt(left, right))
         elif c == bytecode.JUMP_IF_FALSE:
-            if not frame.pop().is_true():
+            if not is_true(frame.pop()):
+                pc = arg
+
+        # superinstructions
+        elif c == bytecode.ADD_LOCAL_CONST:
+            arg2, pc = bytecode.decode_arg(code, pc)
+            assert arg2 >= 0
+            frame.push(binary_add(frame.local(arg), bc.constants[arg2]))
+        elif c == bytecode.ADD_VAR_CONST:
+            arg2, pc = bytecode.decode_arg(code, pc)
+            assert arg2 >= 0
+            frame.push(binary_add(frame.var(bc, arg), bc.constants[arg2]))
+        elif c == bytecode.LOAD_LOCAL2:
+            arg2, pc = bytecode.decode_arg(code, pc)
+            assert arg2 >= 0
+            frame.push(frame.local(arg))
+            frame.push(frame.local(arg2))
+        elif c == bytecode.LT_JUMP_IF_FALSE:
+            right = frame.pop()
+            left = frame.pop()
+            if isinstance(left, W_IntObject) and isinstance(right, W_IntObject):
+                # no boolean object at all
+                if not left.intval < right.intval:
+                    pc = arg
+            elif not is_true(binary_lt(left, right)):
                 pc = arg
         elif c == bytecode.JUMP_BACKWARD:
             pc = arg
-            # required hint indicating this is the end of a loop
-            driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame)
+            if traced:
+                pass
+            elif profiled:
+                profiled_driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame,
+                                              frames=frames)
+            else:
+                # required hint indicating this is the end of a loop
+                driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
         elif c == bytecode.PRINT:
             item = frame.pop()
             print('(nolst) ' + item.str())
+            frame.push(w_nil)
         elif c == bytecode.ASSIGN:
             # assign the top of the stack
             # to the next free variable slot
@@ -326,7 +981,19 @@ def execute(frame, bc):
             frame.vars[arg] = frame.pop()
         elif c == bytecode.LOAD_VAR:
             # load variable TOS
-            frame.push(frame.vars[arg])
+            frame.push(frame.var(bc, arg))
+        elif c == bytecode.ASSIGN_LOCAL:
+            frame.stack[arg] = frame.pop()
+        elif c == bytecode.LOAD_LOCAL:
+            frame.push(frame.local(arg))
+        elif c == bytecode.LOAD_CELL:
+            frame.push(frame.cell(arg))
+        elif c == bytecode.ASSIGN_CELL:
+            frame.cells[arg].w_value = frame.pop()
+        elif c == bytecode.LOAD_FREE:
+            frame.push(frame.closure[arg])
+        elif c == bytecode.LOAD_FREE_CELL:
+            frame.push(frame.free_cell(arg))
 
         elif c== bytecode.AJUMP:
             # takes absolute adress as arg.
@@ -339,56 +1006,192 @@ def execute(frame, bc):
 
         elif c == bytecode.LOAD_FUNCTION:
             # load function/lambda object on the stack
-            l = frame.load_lambda(arg)
+            l = bc.lambdas[arg]
             frame.push(l)
+        elif c == bytecode.MAKE_CLOSURE:
+            template = bc.lambdas[arg]
+            closure = [None] * len(template.captures)
+            for i in range(len(template.captures)):
+                capture = template.captures[i]
+                index = capture >> 2
+                source = capture & 3
+                assert index >= 0
+                if source == scope.CAPTURE_LOCAL:
+                    closure[i] = frame.stack[index]
+                elif source == scope.CAPTURE_CELL:
+                    closure[i] = frame.cells[index]
+                else:
+                    closure[i] = frame.closure[index]
+            frame.push(template.with_closure(closure))
 
         # play with pc
         elif c == bytecode.CALL:
-            # save return address then
-            # call a function.
+            # call a function, with `arg` arguments.
             #
             # The function is on the top of
-            # the stack, followed by its arguments.
-            # The function's bytecode is responsible
-            # for popin' out these arguments
-            # and bind them to variables.
+            # the stack, after its arguments.
+            # They are moved to the first local
+            # variables of a new frame.
             #  :stack:
-            # [function]
             # [arg0..]
             # [..argN]
-
-            rec.append(pc)
+            # [function]
+            function = frame.pop()
+            check_call(function, arg)
+            assert isinstance(function, W_LambdaObject)
+            callee = frames.enter(function, frame, arg)
+            callee.return_pc = pc
+            callee.return_bc = bc
+            frame = callee
+            bc = jit.promote(function.bc)
+            code = bc.code
+            pc = function.args
+            if profiled and bc.profile is not None:
+                bc.profile.calls[pc] += 1
+            if traced:
+                pass
+            elif profiled:
+                profiled_driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame,
+                                              frames=frames)
+            else:
+                # function entry: recursion loops back here
+                driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+
+        elif c == bytecode.TAIL_CALL:
+            # a call whose result is ours: the callee
+            # takes over the frame, and will BACK
+            # directly to our caller
             function = frame.pop()
+            check_call(function, arg)
+            assert isinstance(function, W_LambdaObject)
+            frame = frames.reenter(function, frame, arg)
+            bc = jit.promote(function.bc)
+            code = bc.code
             pc = function.args
+            if profiled and bc.profile is not None:
+                bc.profile.calls[pc] += 1
+            if traced:
+                pass
+            elif profiled:
+                profiled_driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame,
+                                              frames=frames)
+            else:
+                # function entry: recursion loops back here
+                driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+
+        elif c == bytecode.CALL_BUILTIN:
+            # a native function: no frame, no return address.
+            # The argument count was checked by the compiler.
+            argc, pc = bytecode.decode_arg(code, pc)
+            frame.push(builtins.call(arg, argc, frame))
 
         elif c == bytecode.BACK:
-            # BACK is a special instruction
-            # that allow an arbitrary jump
-            # after a function call.
-            #
-            # When a CALL is encountered, the bytecode return
-            # address is stored into a list, named `rec`.
-            #
-            # TODO: replace this list by a set
-            # to ignore recursions
-            #frame.vars[arg] = frame.pop()
-
-            pc = rec.pop()
+            # return from a function call,
+            # with the top of the stack (or nil).
+            if frame.valuestack_pos > frame.nlocals:
+                w_result = frame.pop()
+            else:
+                w_result = w_nil
+            pc = frame.return_pc
+            bc = frame.return_bc
+            code = bc.code
+            caller = frame.back
+            frames.leave(frame)
+            frame = caller
+            frame.push(w_result)
 
         else:
             assert False
 
-        if DEBUG:
-            print('=== STACK DUMP ===\n%s' %frame.dump_stack())
-            print('=== VARS DUMP ===\n%s' %frame.dump_vars())
+
+class Session(object):
+    '''
+    state kept between sequential executions (REPL):
+    global variable names and the frame holding their values.
+    Every input is compiled to its own bytecode.
+    '''
+    def __init__(self, tracer=None, optimize=False, registers=False,
+                 profiler=None):
+        # only holds global variable names
+        self.names = CompilerContext()
+        self.frame = None
+        # a nolst.tracing.Tracer, to trace execution
+        self.tracer = tracer
+        # a nolst.tracing.Profiler, counting from
+        # the production loop (stack VM only)
+        self.profiler = profiler
+        # run the peephole optimizer (nolst.optimizer)
+        self.optimize = optimize
+        # compile for the register VM (nolst.register)
+        # instead, no tracing nor optimizer there
+        self.registers = registers
+        self.register_frame = None
+
+    def compile(self, source):
+        parsed = parse(source)
+        if self.registers:
+            from nolst import register
+            return register.compile_ast(parsed, previous=self.names)
+        bc = compile_ast(parsed, previous=self.names, optimize=self.optimize)
+        if self.tracer is not None:
+            self.tracer.bytecode(bc)
+        return bc
+
+    def execute(self, bc):
+        if self.registers:
+            self.execute_registers(bc)
+            return
+        if self.frame is None:
+            self.frame = toplevel_frame(bc)
+        else:
+            # every input runs in the same top-level frame
+            self.frame.prepare_toplevel(bc)
+        if self.profiler is not None:
+            self.profiler.attach(bc)
+        if self.tracer is not None:
+            execute_traced(self.frame, bc, self.tracer)
+        elif self.profiler is not None:
+            execute_profiled(self.frame, bc)
+        else:
+            execute(self.frame, bc)
+
+    def execute_registers(self, bc):
+        from nolst import register
+        if self.register_frame is None:
+            self.register_frame = register.toplevel_frame(bc)
+        else:
+            self.register_frame.prepare_toplevel(bc)
+        register.execute(self.register_frame, bc)
+
+    def run(self, source):
+        self.execute(self.compile(source))
+
+    def run_file(self, path, source):
+        '''
+        run a whole script, from its bytecode cache when
+        it is up to date. Cached bytecode refers to global
+        variables by index: only a fresh session can use it.
+        It holds stack VM bytecode only.
+        '''
+        fresh = len(self.names.names) == 0 and not self.registers
+        cached = None
+        if fresh:
+            cached = cache.load(path, source, self.optimize)
+        if cached is not None:
+            bc = cached.bc
+            for name in cached.names:
+                self.names.register_var(name)
+            if self.tracer is not None:
+                self.tracer.bytecode(bc)
+        else:
+            bc = self.compile(source)
+            if fresh:
+                cache.store(path, source, bc, self.names.names, self.optimize)
+        self.execute(bc)
 
 
-def interpret(source, frame=None):
-    parsed = parse(source)
-    bc = compile_ast(parsed)
-    print('\n[*] bytecode produced: ')
-    print(bc.dump())
-    if not frame:
-        frame = Frame(bc)
-    execute(frame, bc)
-    return frame # for tests and later introspection
+def interpret(source, session=None):
+    if session is None:
+        session = Session()
+    session.run(source)
+    return session # for tests and later introspection
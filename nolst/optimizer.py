@@ -0,0 +1,359 @@
+""" Peephole optimizer.
+
+Runs on the instructions of a CompilerContext (`ctx.data`) before
+`create_bytecode` assembles them: jump arguments and lambda entry
+points are still instruction indexes.
+
+    - constant folding: `LOAD_CONSTANT a; LOAD_CONSTANT b; BINARY_ADD`
+      (and BINARY_LT) on ints, conditional jumps on a constant
+    - useless pushes: `LOAD_VAR x; DISCARD_TOP` vanish
+    - store/load fusion: `ASSIGN x; LOAD_VAR x` -> `DUP_TOP; ASSIGN x`
+    - jump threading: jumps to jumps go to the final target,
+      jumps to the next instruction vanish
+    - dead code: instructions no path reaches (e.g. after BACK/AJUMP)
+
+A rewrite never spans a jump target, and passes are
+repeated until nothing changes.
+
+`superinstructions` then fuses frequent sequences into single
+opcodes; unlike the passes above, it always runs. Candidates
+for new fusions are given by `nolst.tracing.PairProfiler`.
+"""
+from rpython.rlib.rarithmetic import ovfcheck
+
+from nolst.bytecode import (LOAD_CONSTANT, LOAD_VAR, LOAD_LOCAL,
+                            LOAD_FUNCTION, DUP_TOP, DISCARD_TOP, ASSIGN,
+                            ASSIGN_LOCAL, BINARY_ADD, BINARY_LT, AJUMP, RJUMP,
+                            JUMP_IF_FALSE, ABSOLUTE_JUMPS, RELATIVE_JUMPS,
+                            CONDITIONAL_JUMPS, RETURNS, TERMINATORS, ADD_LOCAL_CONST,
+                            ADD_VAR_CONST, LOAD_LOCAL2, LT_JUMP_IF_FALSE,
+                            LOAD_CELL, ASSIGN_CELL, LOAD_FREE)
+
+# instructions only pushing a value, without side effects. Not
+# the reads of variables, cells included: they raise "undefined
+# variable" when there is no value yet
+PURE_PUSHES = [LOAD_CONSTANT, LOAD_FUNCTION, DUP_TOP, LOAD_FREE]
+# the load matching each store
+STORE_LOADS = {ASSIGN: LOAD_VAR, ASSIGN_LOCAL: LOAD_LOCAL, ASSIGN_CELL: LOAD_CELL}
+
+
+def is_jump(opcode):
+    return opcode in ABSOLUTE_JUMPS or opcode in RELATIVE_JUMPS
+
+
+def jump_targets(ctx):
+    '''
+    for each instruction index, whether control
+    can get there other than from the previous instruction
+    '''
+    targets = [False] * (len(ctx.data) + 1)
+    targets[0] = True
+    for inst in ctx.data:
+        if is_jump(inst.opcode):
+            targets[inst.arg] = True
+    for w_lambda in ctx.lambdas:
+        targets[w_lambda.args] = True
+    return targets
+
+
+def compact(ctx, dead):
+    '''
+    drop dead instructions, and remap jumps and lambda
+    entry points: an index of a dropped instruction
+    becomes the index of the next one kept
+    '''
+    remap = [0] * (len(ctx.data) + 1)
+    data = []
+    for i in range(len(ctx.data)):
+        remap[i] = len(data)
+        if not dead[i]:
+            data.append(ctx.data[i])
+    remap[len(ctx.data)] = len(data)
+
+    for inst in data:
+        if is_jump(inst.opcode):
+            inst.arg = remap[inst.arg]
+    for w_lambda in ctx.lambdas:
+        w_lambda.args = remap[w_lambda.args]
+        w_lambda.body = remap[w_lambda.body]
+    ctx.data = data
+
+
+def fold_binop(ctx, opcode, w_left, w_right):
+    '''
+    constant pool index of `w_left <opcode> w_right`,
+    -1 if it can't be computed at compile time
+    '''
+    from nolst.interpreter import W_IntObject
+    if not (isinstance(w_left, W_IntObject) and isinstance(w_right, W_IntObject)):
+        return -1
+    if opcode == BINARY_ADD:
+        try:
+            res = ovfcheck(w_left.intval + w_right.intval)
+        except OverflowError:
+            return -1
+        return ctx.register_int_constant(res)
+    elif opcode == BINARY_LT:
+        if w_left.intval < w_right.intval:
+            return ctx.register_int_constant(1)
+        return ctx.register_int_constant(0)
+    return -1
+
+
+def constant_truth(ctx, idx):
+    '''
+    1 if constant `idx` is true, 0 if it is false,
+    -1 if we don't know at compile time
+    '''
+    from nolst.interpreter import W_IntObject, w_nil
+    w_const = ctx.constants[idx]
+    if isinstance(w_const, W_IntObject) or w_const is w_nil:
+        if w_const.is_true():
+            return 1
+        return 0
+    return -1
+
+
+def fold_constants(ctx):
+    data = ctx.data
+    targets = jump_targets(ctx)
+    dead = [False] * len(data)
+    changed = False
+    i = 0
+    while i < len(data) - 1:
+        inst = data[i]
+        following = data[i + 1]
+        if inst.opcode != LOAD_CONSTANT or targets[i + 1]:
+            i += 1
+            continue
+        if (following.opcode == LOAD_CONSTANT and i + 2 < len(data)
+                and not targets[i + 2]):
+            op = data[i + 2]
+            idx = fold_binop(ctx, op.opcode, ctx.constants[inst.arg],
+                             ctx.constants[following.arg])
+            if idx >= 0:
+                inst.arg = idx
+                dead[i + 1] = dead[i + 2] = True
+                changed = True
+                i += 3
+                continue
+        elif following.opcode == JUMP_IF_FALSE:
+            truth = constant_truth(ctx, inst.arg)
+            if truth == 1:
+                dead[i] = dead[i + 1] = True
+                changed = True
+                i += 2
+                continue
+            elif truth == 0:
+                inst.opcode = AJUMP
+                inst.arg = following.arg
+                dead[i + 1] = True
+                changed = True
+                i += 2
+                continue
+        i += 1
+    if changed:
+        compact(ctx, dead)
+    return changed
+
+
+def remove_useless_pushes(ctx):
+    '''
+    a value pushed then discarded right away, and
+    a value duplicated, stored, then discarded
+    '''
+    data = ctx.data
+    targets = jump_targets(ctx)
+    dead = [False] * len(data)
+    changed = False
+    i = 0
+    while i < len(data) - 1:
+        op = data[i].opcode
+        if (op in PURE_PUSHES and data[i + 1].opcode == DISCARD_TOP
+                and not targets[i + 1]):
+            dead[i] = dead[i + 1] = True
+            changed = True
+            i += 2
+        elif (op == DUP_TOP and i + 2 < len(data)
+                and data[i + 1].opcode in STORE_LOADS
+                and data[i + 2].opcode == DISCARD_TOP
+                and not targets[i + 1] and not targets[i + 2]):
+            dead[i] = dead[i + 2] = True
+            changed = True
+            i += 3
+        else:
+            i += 1
+    if changed:
+        compact(ctx, dead)
+    return changed
+
+
+def fuse_store_load(ctx):
+    '''
+    `ASSIGN x; LOAD_VAR x` -> `DUP_TOP; ASSIGN x`:
+    the value is still on the stack, don't read it back
+    '''
+    data = ctx.data
+    targets = jump_targets(ctx)
+    changed = False
+    for i in range(len(data) - 1):
+        store = data[i]
+        load = data[i + 1]
+        if (store.opcode in STORE_LOADS and not targets[i + 1]
+                and load.opcode == STORE_LOADS[store.opcode]
+                and load.arg == store.arg):
+            load.opcode = store.opcode
+            store.opcode = DUP_TOP
+            store.arg = 0
+            changed = True
+    return changed
+
+
+def final_target(ctx, idx):
+    '''
+    follow unconditional forward jumps from instruction `idx`
+    '''
+    data = ctx.data
+    # bounded: jumps may form a cycle
+    for _ in range(len(data)):
+        if idx >= len(data):
+            break
+        inst = data[idx]
+        if inst.opcode != AJUMP and inst.opcode != RJUMP:
+            break
+        idx = inst.arg
+    return idx
+
+
+def thread_jumps(ctx):
+    '''
+    JUMP_BACKWARD is left alone: it marks the loops for the JIT
+    '''
+    data = ctx.data
+    dead = [False] * len(data)
+    removed = False
+    changed = False
+    for i in range(len(data)):
+        inst = data[i]
+        op = inst.opcode
+        if op != AJUMP and op != RJUMP and op != JUMP_IF_FALSE:
+            continue
+        target = final_target(ctx, inst.arg)
+        if target != inst.arg:
+            inst.arg = target
+            changed = True
+        if op == JUMP_IF_FALSE:
+            if target == i + 1:
+                # both ways lead to the next instruction
+                inst.opcode = DISCARD_TOP
+                inst.arg = 0
+                changed = True
+        elif target == i + 1:
+            dead[i] = True
+            removed = True
+        elif target < len(data) and data[target].opcode in RETURNS:
+            inst.opcode = data[target].opcode
+            inst.arg = data[target].arg
+            changed = True
+    if removed:
+        compact(ctx, dead)
+    return changed or removed
+
+
+def remove_dead_code(ctx):
+    '''
+    drop instructions not reachable from the top-level
+    entry point nor from a lambda's
+    '''
+    data = ctx.data
+    reached = [False] * (len(data) + 1)
+    todo = [0]
+    for w_lambda in ctx.lambdas:
+        todo.append(w_lambda.args)
+    while todo:
+        i = todo.pop()
+        while i < len(data) and not reached[i]:
+            reached[i] = True
+            op = data[i].opcode
+            if op in TERMINATORS:
+                break
+            elif op in CONDITIONAL_JUMPS:
+                todo.append(data[i].arg)
+                i += 1
+            elif is_jump(op):
+                i = data[i].arg
+            else:
+                i += 1
+
+    dead = [False] * len(data)
+    changed = False
+    for i in range(len(data)):
+        if not reached[i]:
+            dead[i] = True
+            changed = True
+    if changed:
+        compact(ctx, dead)
+    return changed
+
+
+def superinstructions(ctx):
+    '''
+    fuse sequences of instructions into superinstructions:
+
+        LOAD_LOCAL a; LOAD_CONSTANT b; BINARY_ADD -> ADD_LOCAL_CONST a b
+        LOAD_VAR a; LOAD_CONSTANT b; BINARY_ADD   -> ADD_VAR_CONST a b
+        BINARY_LT; JUMP_IF_FALSE t                -> LT_JUMP_IF_FALSE t
+        LOAD_LOCAL a; LOAD_LOCAL b                -> LOAD_LOCAL2 a b
+    '''
+    data = ctx.data
+    targets = jump_targets(ctx)
+    dead = [False] * len(data)
+    changed = False
+    i = 0
+    while i < len(data) - 1:
+        inst = data[i]
+        following = data[i + 1]
+        if targets[i + 1]:
+            i += 1
+            continue
+        if ((inst.opcode == LOAD_LOCAL or inst.opcode == LOAD_VAR)
+                and following.opcode == LOAD_CONSTANT
+                and i + 2 < len(data) and not targets[i + 2]
+                and data[i + 2].opcode == BINARY_ADD):
+            if inst.opcode == LOAD_LOCAL:
+                inst.opcode = ADD_LOCAL_CONST
+            else:
+                inst.opcode = ADD_VAR_CONST
+            inst.arg2 = following.arg
+            dead[i + 1] = dead[i + 2] = True
+            i += 3
+        elif inst.opcode == BINARY_LT and following.opcode == JUMP_IF_FALSE:
+            inst.opcode = LT_JUMP_IF_FALSE
+            inst.arg = following.arg
+            dead[i + 1] = True
+            i += 2
+        elif inst.opcode == LOAD_LOCAL and following.opcode == LOAD_LOCAL:
+            inst.opcode = LOAD_LOCAL2
+            inst.arg2 = following.arg
+            dead[i + 1] = True
+            i += 2
+        else:
+            i += 1
+            continue
+        changed = True
+    if changed:
+        compact(ctx, dead)
+    return changed
+
+
+def optimize(ctx):
+    '''
+    optimize the instructions of `ctx` in place
+    '''
+    changed = True
+    while changed:
+        changed = fold_constants(ctx)
+        changed = remove_useless_pushes(ctx) or changed
+        changed = fuse_store_load(ctx) or changed
+        changed = thread_jumps(ctx) or changed
+        changed = remove_dead_code(ctx) or changed
@@ -0,0 +1,116 @@
+""" Parser tables generation.
+
+Building the lexer's automaton and the ToAST transformer out of
+`grammar.txt` dominates the import time of `nolst.sourceparser`.
+They are generated once into `grammar_tables.py`, which is reused
+as long as the hash of the grammar did not change.
+
+Regenerate explicitly with:
+
+    python -m nolst.parsergen
+"""
+import os
+import hashlib
+from rpython.rlib.parsing.ebnfparse import parse_ebnf
+from rpython.rlib.parsing.lexer import Lexer
+from rpython.rlib.parsing.parsing import PackratParser
+
+GRAMMAR_PATH = os.path.join(os.path.dirname(__file__), 'grammar.txt')
+TABLES_PATH = os.path.join(os.path.dirname(__file__), 'grammar_tables.py')
+
+# bump when the layout of the generated module changes
+TABLES_VERSION = 1
+
+TABLES_HEADER = '''\
+# auto-generated by nolst/parsergen.py from grammar.txt, don't edit
+# (ToAST.transform reads py.test.config when untranslated)
+import py
+from rpython.rlib.parsing.deterministic import DFA
+from rpython.rlib.parsing.lexer import DummyLexer
+from rpython.rlib.parsing.parsing import Rule
+from rpython.rlib.parsing.tree import RPythonVisitor, Nonterminal
+from rpython.rlib.objectmodel import we_are_translated
+
+GRAMMAR_HASH = %r
+
+'''
+
+
+def read_grammar():
+    with open(GRAMMAR_PATH) as f:
+        return f.read()
+
+
+def grammar_hash(grammar):
+    return hashlib.sha1('%d:%s' % (TABLES_VERSION, grammar)).hexdigest()
+
+
+def build_tables(grammar):
+    '''
+    the slow path: build lexer, rules and ToAST from the grammar
+    '''
+    regexs, rules, ToAST = parse_ebnf(grammar)
+    names, regexs = zip(*regexs)
+    ignore = ['IGNORE'] if 'IGNORE' in names else []
+    lexer = Lexer(list(regexs), list(names), ignore=ignore)
+    return lexer, rules, ToAST
+
+
+def generate_tables(grammar, tables):
+    '''
+    return the source of the tables module, for the
+    (lexer, rules, ToAST) built from `grammar`
+    '''
+    lexer, rules, ToAST = tables
+    return '%s%s\n\nrules = %r\n\n%s\n' % (
+        TABLES_HEADER % grammar_hash(grammar),
+        lexer.get_dummy_repr(),
+        rules,
+        ToAST.source,
+    )
+
+
+def write_tables(grammar, tables):
+    source = generate_tables(grammar, tables)
+    tmp = TABLES_PATH + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(source)
+    os.rename(tmp, TABLES_PATH)
+
+
+def load_tables():
+    '''
+    return (lexer, rules, ToAST), from the generated
+    module when it is up to date with the grammar.
+    '''
+    grammar = read_grammar()
+    try:
+        from nolst import grammar_tables
+    except ImportError:
+        grammar_tables = None
+
+    if (grammar_tables is not None and
+            grammar_tables.GRAMMAR_HASH == grammar_hash(grammar)):
+        return grammar_tables.lexer, grammar_tables.rules, grammar_tables.ToAST
+
+    tables = build_tables(grammar)
+    try:
+        write_tables(grammar, tables)
+    except (IOError, OSError):
+        # read-only install: keep the slow path
+        pass
+    return tables
+
+
+def make_parse_function(lexer, rules):
+    parser = PackratParser(rules, rules[0].nonterminal)
+
+    def parse(s):
+        tokens = lexer.tokenize(s, eof=True)
+        return parser.parse(tokens)
+    return parse
+
+
+if __name__ == '__main__':
+    grammar = read_grammar()
+    write_tables(grammar, build_tables(grammar))
@@ -0,0 +1,976 @@
+""" Register VM backend.
+
+A second compiler from the same AST (after nolst.scope), and a second
+interpreter loop. Instructions are three-address: they name the
+registers they read and write, instead of going through a value stack.
+`(def i (add i 1))` in a lambda is a single `ADD i i K1` where the
+stack VM runs `LOAD_LOCAL; LOAD_CONSTANT; BINARY_ADD; DUP_TOP;
+ASSIGN_LOCAL` (ADD_LOCAL_CONST, DUP_TOP, ASSIGN_LOCAL once fused).
+
+Registers are the frame's slots: locals first (the slots given by
+nolst.scope, arguments first), then the temporaries of the code unit,
+allocated like a stack by the compiler. Operands read by an
+instruction are either a register or a constant: `reg << 1`, or
+`(index << 1) | 1` for constant `index` of the pool. Destinations are
+plain register numbers.
+
+Operands are varints (see nolst.bytecode), the jump target first.
+Lambda bodies follow the top-level code, which ends with HALT. The
+bytecode is a nolst.bytecode.ByteCode like the stack VM's, only the
+instruction set differs: the two don't mix, and it isn't cached.
+"""
+from rpython.rlib import jit
+from rpython.rlib.debug import make_sure_not_resized
+from rpython.rlib.objectmodel import specialize
+
+from nolst import scope
+from nolst.bytecode import (ByteCode, CompilerContext, BINOP_BUILTINS, encode_arg,
+                            arg_size, decode_arg)
+from nolst.interpreter import (W_LambdaObject, W_IntObject, W_Cell, binary_add,
+                               binary_lt, is_true, check_call, new_cells,
+                               no_cells, no_closure, undefined_variable,
+                               InterpreterError)
+
+regcodes = {
+    # MOVE dst src
+    'MOVE':             0x00,
+    # LOAD_GLOBAL dst name, STORE_GLOBAL name src
+    'LOAD_GLOBAL':      0x01,
+    'STORE_GLOBAL':     0x02,
+    # closures (see nolst.scope): LOAD_CELL dst cell,
+    # STORE_CELL cell src, LOAD_FREE(_CELL) dst index
+    'LOAD_CELL':        0x03,
+    'STORE_CELL':       0x04,
+    'LOAD_FREE':        0x05,
+    'LOAD_FREE_CELL':   0x06,
+    # ADD dst a b, LT dst a b
+    'ADD':              0x07,
+    'LT':               0x08,
+    # JUMP target, JUMP_IF_FALSE target src,
+    # JUMP_IF_NOT_LT target a b
+    'JUMP':             0x09,
+    'JUMP_IF_FALSE':    0x0a,
+    'JUMP_IF_NOT_LT':   0x0b,
+    # LOOP target: backward jump closing a while loop
+    'LOOP':             0x0c,
+    # PRINT src
+    'PRINT':            0x0d,
+    # LOAD_FUNCTION dst lambda, MAKE_CLOSURE dst lambda
+    'LOAD_FUNCTION':    0x0e,
+    'MAKE_CLOSURE':     0x0f,
+    # CALL dst function argc base: the arguments are
+    # in the registers from `base` on
+    'CALL':             0x10,
+    # TAIL_CALL function argc base
+    'TAIL_CALL':        0x11,
+    # CALL_BUILTIN dst builtin argc base
+    'CALL_BUILTIN':     0x12,
+    # RETURN src, from a lambda
+    'RETURN':           0x13,
+    # end of the top-level code
+    'HALT':             0x14,
+}
+
+regcodes_by_value = {v: k for k, v in regcodes.iteritems()}
+
+for regcode, value in regcodes.iteritems():
+    globals()[regcode] = value
+
+OPERANDS = {
+    MOVE: 2, LOAD_GLOBAL: 2, STORE_GLOBAL: 2, LOAD_CELL: 2, STORE_CELL: 2,
+    LOAD_FREE: 2, LOAD_FREE_CELL: 2, ADD: 3, LT: 3, JUMP: 1,
+    JUMP_IF_FALSE: 2, JUMP_IF_NOT_LT: 3, LOOP: 1, PRINT: 1,
+    LOAD_FUNCTION: 2, MAKE_CLOSURE: 2, CALL: 4, TAIL_CALL: 3,
+    CALL_BUILTIN: 4, RETURN: 1, HALT: 0,
+}
+# opcodes whose first operand is an absolute address
+# (an instruction index until the bytecode is assembled)
+JUMPS = [JUMP, JUMP_IF_FALSE, JUMP_IF_NOT_LT, LOOP]
+
+
+class CompileError(InterpreterError):
+    '''
+    a node the register compiler can't compile
+    '''
+
+
+def register(reg):
+    '''
+    operand reading register `reg`
+    '''
+    return reg << 1
+
+
+def constant(index):
+    '''
+    operand reading constant `index`
+    '''
+    return (index << 1) | 1
+
+
+def is_register(operand):
+    return operand & 1 == 0
+
+
+class Instruction(object):
+    def __init__(self, opcode, operands):
+        self.opcode = opcode
+        self.operands = operands
+
+
+class Unit(object):
+    '''
+    registers of the code unit being compiled:
+    the top-level code, or a lambda
+    '''
+    def __init__(self, nlocals):
+        self.nlocals = nlocals
+        # temporaries in use, and the most in use at once
+        self.ntemps = 0
+        self.maxtemps = 0
+
+
+class RegisterCompiler(object):
+    def __init__(self, previous=None):
+        # constant pool, global names, lambdas and
+        # scopes, shared with the stack compiler
+        self.ctx = CompilerContext(previous)
+        self.data = []
+        self.unit = Unit(0)
+        # lambdas whose body is still to compile,
+        # with their lambda object
+        self.pending = []
+
+    def emit(self, opcode, operands):
+        '''
+        append an instruction, return its index.
+        '''
+        assert len(operands) == OPERANDS[opcode]
+        self.data.append(Instruction(opcode, operands))
+        return len(self.data) - 1
+
+    def size(self):
+        return len(self.data)
+
+    def patch_target(self, index, target):
+        self.data[index].operands[0] = target
+
+    # registers
+
+    def new_temp(self):
+        unit = self.unit
+        reg = unit.nlocals + unit.ntemps
+        unit.ntemps += 1
+        if unit.ntemps > unit.maxtemps:
+            unit.maxtemps = unit.ntemps
+        return reg
+
+    def mark(self):
+        return self.unit.ntemps
+
+    def release(self, mark):
+        '''
+        free the temporaries allocated since `mark`
+        '''
+        self.unit.ntemps = mark
+
+    def destination(self, target):
+        if target >= 0:
+            return target
+        return self.new_temp()
+
+    def nil(self):
+        return constant(self.ctx.register_nil_constant())
+
+    # expressions
+
+    def expr(self, node, target):
+        '''
+        compile `node`, return the operand holding its value.
+        `target` is a register the value can be computed in
+        (-1: a new temporary), the operand may be another one.
+        '''
+        from nolst.sourceparser import (ConstantInt, ConstantBigInt, ConstantFloat,
+                                        ConstantString, UnevaluatedSymbol, QuotedExpr,
+                                        BaseList, Variable, Assignment, BinOp, FuncCall,
+                                        BuiltinCall, Sexpr, Do, If, While, Print, Lambda)
+        from nolst.interpreter import W_QuotedListObject
+        ctx = self.ctx
+        if isinstance(node, ConstantInt):
+            return constant(ctx.register_int_constant(node.intval))
+        elif isinstance(node, ConstantBigInt):
+            return constant(ctx.register_bigint_constant(node.digits))
+        elif isinstance(node, ConstantFloat):
+            return constant(ctx.register_float_constant(node.floatval))
+        elif isinstance(node, ConstantString):
+            return constant(ctx.register_str_constant(node.strval))
+        elif isinstance(node, UnevaluatedSymbol):
+            return constant(ctx.register_symbol_constant(node.strval))
+        elif isinstance(node, QuotedExpr):
+            return constant(ctx.register_constant(W_QuotedListObject(node.content)))
+        elif isinstance(node, BaseList):
+            from nolst import builtins
+            return self.builtin_call(builtins.lookup('list'), node.content, target)
+        elif isinstance(node, Variable):
+            return self.variable(node.varname, target)
+        elif isinstance(node, Assignment):
+            return self.assignment(node, target)
+        elif isinstance(node, BinOp):
+            return self.binop(node, target)
+        elif isinstance(node, FuncCall):
+            return self.call(node, target)
+        elif isinstance(node, BuiltinCall):
+            return self.builtin_call(node.index, node.args, target)
+        elif isinstance(node, Sexpr) or isinstance(node, Do):
+            return self.sequence(node.stmts, target)
+        elif isinstance(node, If):
+            return self.if_(node, target)
+        elif isinstance(node, While):
+            return self.while_(node)
+        elif isinstance(node, Print):
+            self.emit(PRINT, [self.expr(node.expr, -1)])
+            return self.nil()
+        elif isinstance(node, Lambda):
+            return self.lambda_(node, target)
+        raise CompileError("can't compile %s" % node.__class__.__name__)
+
+    def expr_to(self, node, reg):
+        '''
+        compile `node`, its value ending up in register `reg`
+        '''
+        from nolst.sourceparser import Variable
+        operand = self.expr(node, reg)
+        if operand != register(reg) or isinstance(node, Variable):
+            # (def x x): still a read, checked by MOVE
+            self.emit(MOVE, [reg, operand])
+
+    def statement(self, node):
+        from nolst.sourceparser import Variable, Sexpr, Do
+        mark = self.mark()
+        operand = self.expr(node, -1)
+        last = node
+        while (isinstance(last, Sexpr) or isinstance(last, Do)) and last.stmts:
+            last = last.stmts[-1]
+        if (isinstance(last, Variable) and is_register(operand)
+                and (operand >> 1) < self.unit.nlocals):
+            # a local read for nothing: nothing would read its
+            # register, move it to a scratch one to raise
+            # "undefined variable" as the stack VM does
+            self.emit(MOVE, [self.new_temp(), operand])
+        self.release(mark)
+
+    def sequence(self, stmts, target):
+        if not stmts:
+            return self.nil()
+        for i in range(len(stmts) - 1):
+            self.statement(stmts[i])
+        return self.expr(stmts[-1], target)
+
+    def variable(self, name, target):
+        ctx = self.ctx
+        kind = ctx.variable_kind(name)
+        if kind == scope.LOCAL:
+            # already in a register
+            return register(ctx.variable_index(name))
+        dst = self.destination(target)
+        if kind == scope.CELL:
+            self.emit(LOAD_CELL, [dst, ctx.variable_index(name)])
+        elif kind == scope.FREE:
+            self.emit(LOAD_FREE, [dst, ctx.variable_index(name)])
+        elif kind == scope.FREE_CELL:
+            self.emit(LOAD_FREE_CELL, [dst, ctx.variable_index(name)])
+        else:
+            self.emit(LOAD_GLOBAL, [dst, ctx.register_var(name)])
+        return register(dst)
+
+    def assignment(self, node, target):
+        # a definition is worth the assigned value
+        ctx = self.ctx
+        kind = ctx.variable_kind(node.varname)
+        if kind == scope.LOCAL:
+            # computed right in the variable's register
+            reg = ctx.variable_index(node.varname)
+            self.expr_to(node.expr, reg)
+            return register(reg)
+        value = self.expr(node.expr, target)
+        if kind == scope.CELL:
+            self.emit(STORE_CELL, [ctx.variable_index(node.varname), value])
+        else:
+            self.emit(STORE_GLOBAL, [ctx.register_var(node.varname), value])
+        return value
+
+    def assigns(self, node, reg):
+        '''
+        whether `node` assigns the local in register `reg`
+        (nested lambdas only assign their own locals)
+        '''
+        from nolst.sourceparser import Assignment, Lambda
+        if isinstance(node, Lambda):
+            return False
+        if (isinstance(node, Assignment)
+                and self.ctx.variable_kind(node.varname) == scope.LOCAL
+                and self.ctx.variable_index(node.varname) == reg):
+            return True
+        for child in node.children():
+            if self.assigns(child, reg):
+                return True
+        return False
+
+    def operands(self, left, right):
+        '''
+        compile the operands of a binary operation. The left
+        one is read after the right one is computed: copy it,
+        if it is a local the right one changes.
+        '''
+        a = self.expr(left, -1)
+        if (is_register(a) and (a >> 1) < self.unit.nlocals
+                and self.assigns(right, a >> 1)):
+            tmp = self.new_temp()
+            self.emit(MOVE, [tmp, a])
+            a = register(tmp)
+        b = self.expr(right, -1)
+        return a, b
+
+    def binop(self, node, target):
+        from nolst import builtins
+        if node.op == '+':
+            opcode = ADD
+        elif node.op == '<':
+            opcode = LT
+        elif node.op in BINOP_BUILTINS:
+            # no instruction of their own
+            index = builtins.lookup(BINOP_BUILTINS[node.op])
+            return self.builtin_call(index, [node.left, node.right], target)
+        else:
+            raise CompileError("can't compile operator %s" % node.op)
+        mark = self.mark()
+        a, b = self.operands(node.left, node.right)
+        self.release(mark)
+        # operands are read before the destination is written
+        dst = self.destination(target)
+        self.emit(opcode, [dst, a, b])
+        return register(dst)
+
+    def arguments(self, args):
+        '''
+        compile `args` into consecutive temporaries,
+        return the first one
+        '''
+        base = self.unit.nlocals + self.unit.ntemps
+        for i in range(len(args)):
+            self.new_temp()
+        for i in range(len(args)):
+            mark = self.mark()
+            self.expr_to(args[i], base + i)
+            self.release(mark)
+        return base
+
+    def call(self, node, target):
+        mark = self.mark()
+        base = self.arguments(node.args)
+        function = self.expr(node.function_name, -1)
+        self.release(mark)
+        dst = self.destination(target)
+        self.emit(CALL, [dst, function, len(node.args), base])
+        return register(dst)
+
+    def builtin_call(self, index, args, target):
+        mark = self.mark()
+        base = self.arguments(args)
+        self.release(mark)
+        dst = self.destination(target)
+        self.emit(CALL_BUILTIN, [dst, index, len(args), base])
+        return register(dst)
+
+    def branch_if_false(self, cond):
+        '''
+        compile `cond` and a jump taken when it is false,
+        return the jump's index. A comparison and its
+        jump are a single instruction.
+        '''
+        from nolst.sourceparser import BinOp
+        mark = self.mark()
+        if isinstance(cond, BinOp) and cond.op == '<':
+            a, b = self.operands(cond.left, cond.right)
+            jump = self.emit(JUMP_IF_NOT_LT, [0, a, b])
+        else:
+            jump = self.emit(JUMP_IF_FALSE, [0, self.expr(cond, -1)])
+        self.release(mark)
+        return jump
+
+    def if_(self, node, target):
+        dst = self.destination(target)
+        jump = self.branch_if_false(node.cond)
+        mark = self.mark()
+        self.expr_to(node.body, dst)
+        self.release(mark)
+        end = self.emit(JUMP, [0])
+        # no else branch: nil
+        self.patch_target(jump, self.size())
+        self.emit(MOVE, [dst, self.nil()])
+        self.patch_target(end, self.size())
+        return register(dst)
+
+    def while_(self, node):
+        top = self.size()
+        jump = self.branch_if_false(node.cond)
+        self.statement(node.body)
+        self.emit(LOOP, [top])
+        self.patch_target(jump, self.size())
+        # a loop is worth nil
+        return self.nil()
+
+    def lambda_(self, node, target):
+        lambda_scope = node.scope
+        captures = []
+        if lambda_scope.freevars:
+            captures = lambda_scope.captures()
+        # entry point and frame size are known
+        # once the body is compiled
+        w_lambda = W_LambdaObject(0, 0, lambda_scope.nlocals, 0, lambda_scope.ncells,
+                                  captures, len(node.args.stmts), node.name,
+                                  lambda_scope.variable_names())
+        index = self.ctx.register_lambda(w_lambda)
+        self.pending.append((node, w_lambda))
+        dst = self.destination(target)
+        if captures:
+            self.emit(MAKE_CLOSURE, [dst, index])
+        else:
+            self.emit(LOAD_FUNCTION, [dst, index])
+        return register(dst)
+
+    # tail position of a lambda
+
+    def tail(self, node):
+        from nolst.sourceparser import FuncCall, If, Sexpr, Do
+        if isinstance(node, FuncCall):
+            # the callee takes over the frame, and
+            # returns directly to our caller
+            mark = self.mark()
+            base = self.arguments(node.args)
+            function = self.expr(node.function_name, -1)
+            self.emit(TAIL_CALL, [function, len(node.args), base])
+            self.release(mark)
+        elif isinstance(node, If):
+            jump = self.branch_if_false(node.cond)
+            self.tail(node.body)
+            self.patch_target(jump, self.size())
+            self.emit(RETURN, [self.nil()])
+        elif isinstance(node, Sexpr) or isinstance(node, Do):
+            if not node.stmts:
+                self.emit(RETURN, [self.nil()])
+                return
+            for i in range(len(node.stmts) - 1):
+                self.statement(node.stmts[i])
+            self.tail(node.stmts[-1])
+        else:
+            mark = self.mark()
+            self.emit(RETURN, [self.expr(node, -1)])
+            self.release(mark)
+
+    def function(self, node, w_lambda):
+        lambda_scope = node.scope
+        self.unit = Unit(lambda_scope.nlocals)
+        self.ctx.enter_lambda(lambda_scope)
+        w_lambda.args = self.size()
+        # arguments are the first registers, where CALL
+        # copies them. Captured ones live in cells.
+        for slot, cell in lambda_scope.captured_args():
+            self.emit(STORE_CELL, [cell, register(slot)])
+        w_lambda.body = self.size()
+        self.tail(node.body)
+        self.ctx.leave_lambda()
+        w_lambda.stacksize = self.unit.maxtemps
+
+    def compile_toplevel(self, astnode):
+        self.statement(astnode)
+        self.emit(HALT, [])
+        stacksize = self.unit.maxtemps
+        # lambdas get compiled after the code creating
+        # them, nested ones last
+        i = 0
+        while i < len(self.pending):
+            node, w_lambda = self.pending[i]
+            self.function(node, w_lambda)
+            i += 1
+        return stacksize
+
+    # assembly
+
+    def layout(self):
+        '''
+        address of every instruction, plus the address right
+        after the last one. Like CompilerContext.layout: grow
+        instructions until their jump targets fit.
+        '''
+        count = len(self.data)
+        sizes = [1] * count
+        addrs = [0] * (count + 1)
+        for i in range(count):
+            sizes[i] += len(self.data[i].operands)
+        changed = True
+        while changed:
+            addr = 0
+            for i in range(count):
+                addrs[i] = addr
+                addr += sizes[i]
+            addrs[count] = addr
+
+            changed = False
+            for i in range(count):
+                size = 1
+                operands = self.operands_at(i, addrs)
+                for operand in operands:
+                    size += arg_size(operand)
+                if size > sizes[i]:
+                    sizes[i] = size
+                    changed = True
+        return addrs
+
+    def operands_at(self, i, addrs):
+        inst = self.data[i]
+        if inst.opcode in JUMPS:
+            operands = inst.operands[:]
+            operands[0] = addrs[operands[0]]
+            return operands
+        return inst.operands
+
+    def create_bytecode(self, stacksize):
+        addrs = self.layout()
+        code = []
+        for i in range(len(self.data)):
+            code.append(chr(self.data[i].opcode))
+            for operand in self.operands_at(i, addrs):
+                code += encode_arg(operand)
+        ctx = self.ctx
+        bc = ByteCode("".join(code), ctx.constants[:], len(ctx.names), ctx.lambdas[:],
+                      stacksize, ctx.constants_requested, len(self.data),
+                      ctx.names)
+        for w_lambda in ctx.lambdas:
+            w_lambda.args = addrs[w_lambda.args]
+            w_lambda.body = addrs[w_lambda.body]
+            w_lambda.bc = bc
+        return bc
+
+
+def compile_ast(astnode, previous=None):
+    compiler = RegisterCompiler(previous)
+    scope.analyze(astnode)
+    stacksize = compiler.compile_toplevel(astnode)
+    return compiler.create_bytecode(stacksize)
+
+
+def next_pc(code, pc):
+    '''
+    address of the instruction following the one at `pc`
+    '''
+    opcode = ord(code[pc])
+    pc += 1
+    for i in range(OPERANDS[opcode]):
+        _, pc = decode_arg(code, pc)
+    return pc
+
+
+def instructions_count(bc):
+    count = 0
+    pc = 0
+    while pc < len(bc.code):
+        pc = next_pc(bc.code, pc)
+        count += 1
+    return count
+
+
+def operand_str(operand):
+    if is_register(operand):
+        return 'r' + str(operand >> 1)
+    return 'k' + str(operand >> 1)
+
+
+# operands being read (registers or constants), by opcode
+SOURCES = {MOVE: [1], STORE_GLOBAL: [1], STORE_CELL: [1], ADD: [1, 2],
+           LT: [1, 2], JUMP_IF_FALSE: [1], JUMP_IF_NOT_LT: [1, 2],
+           PRINT: [0], CALL: [1], TAIL_CALL: [0], RETURN: [0]}
+
+
+def dump(bc):
+    '''
+    (debug) the instructions of register bytecode `bc`
+    '''
+    lines = []
+    pc = 0
+    code = bc.code
+    while pc < len(code):
+        opcode = ord(code[pc])
+        line = str(pc) + "\t| " + regcodes_by_value[opcode]
+        sources = SOURCES.get(opcode, [])
+        next = pc + 1
+        for i in range(OPERANDS[opcode]):
+            operand, next = decode_arg(code, next)
+            if i in sources:
+                line += " " + operand_str(operand)
+            else:
+                line += " " + str(operand)
+        lines.append(line)
+        pc = next
+    return '\n'.join(lines)
+
+
+def printable_loc(pc, code, bc):
+    return str(pc) + " " + regcodes_by_value[ord(code[pc])]
+
+# same green variables as the stack VM's driver: loops
+# are closed at LOOP targets and function entry points.
+# No virtualizable either (see nolst.interpreter.driver).
+# (Neither loop calls itself, but with two drivers
+# RPython wants one of them flagged recursive.)
+driver = jit.JitDriver(greens=['pc', 'code', 'bc'],
+                       reds=['frame', 'frames'],
+                       get_printable_location=printable_loc,
+                       is_recursive=True,
+                       name='registers')
+
+
+class RegisterFrame(object):
+    '''
+    an activation record of the register VM
+    '''
+    def __init__(self, w_vars, size):
+        # global variables, shared by every frame
+        self.vars = w_vars
+        # locals (arguments first), then temporaries.
+        # Sized by the compiler, never resized.
+        self.regs = [None] * size
+        make_sure_not_resized(self.regs)
+        self.nlocals = 0
+        # calling frame, where to resume its execution,
+        # and the register getting our result
+        self.back = None
+        self.return_pc = 0
+        self.return_bc = None
+        self.return_dst = 0
+        self.cells = no_cells
+        self.closure = no_closure
+        # the running function, None at top-level
+        self.function = None
+
+    def reset(self, nlocals):
+        for i in range(nlocals):
+            self.regs[i] = None
+        self.nlocals = nlocals
+
+    def resize_vars(self, numvars):
+        # in place, doubling (see Frame.resize_vars)
+        size = len(self.vars)
+        if numvars > size:
+            self.vars.extend([None] * (max(numvars, 2 * size) - size))
+
+    def prepare_toplevel(self, bc):
+        self.resize_vars(bc.numvars)
+        if len(self.regs) < bc.stacksize:
+            self.regs = [None] * bc.stacksize
+
+    def store(self, reg, w_value):
+        assert reg >= 0
+        self.regs[reg] = w_value
+
+    def value(self, bc, operand):
+        '''
+        the value of a source operand: a register or a constant
+        '''
+        index = operand >> 1
+        assert index >= 0
+        if operand & 1:
+            return bc.constants[index]
+        w_value = self.regs[index]
+        if w_value is None:
+            # only a local isn't set before it is read
+            raise undefined_variable(self.function.varnames[index])
+        return w_value
+
+    def var(self, bc, index):
+        w_value = self.vars[index]
+        if w_value is None:
+            raise undefined_variable(bc.names[index])
+        return w_value
+
+    def cell(self, index):
+        w_value = self.cells[index].w_value
+        if w_value is None:
+            raise undefined_variable(self.function.cell_name(index))
+        return w_value
+
+    def free_cell(self, index):
+        w_cell = self.closure[index]
+        assert isinstance(w_cell, W_Cell)
+        if w_cell.w_value is None:
+            raise undefined_variable(self.function.free_name(index))
+        return w_cell.w_value
+
+    @jit.unroll_safe
+    def values(self, base, count):
+        '''
+        registers `base` to `base + count` (excluded)
+        '''
+        assert base >= 0
+        values = [None] * count
+        for i in range(count):
+            values[i] = self.regs[base + i]
+        return values
+
+
+def toplevel_frame(bc, w_vars=None):
+    if w_vars is None:
+        w_vars = [None] * bc.numvars
+    return RegisterFrame(w_vars, bc.stacksize)
+
+
+class RegisterFrameStack(object):
+    '''
+    frames of the ongoing calls, reused call
+    after call (see nolst.interpreter.FrameStack)
+    '''
+    def __init__(self):
+        self.frames = [None] * 64
+        self.depth = 0
+
+    def enter(self, w_function, caller, argc, base):
+        '''
+        return the frame of a call to `w_function`, the
+        `argc` arguments copied from the caller's registers
+        '''
+        depth = self.depth
+        if depth == len(self.frames):
+            self.frames = self.frames + [None] * len(self.frames)
+        size = w_function.nlocals + w_function.stacksize
+        frame = self.frames[depth]
+        if frame is None or len(frame.regs) < size:
+            frame = RegisterFrame(caller.vars, size)
+            self.frames[depth] = frame
+        else:
+            frame.vars = caller.vars
+        frame.reset(w_function.nlocals)
+        frame.cells = new_cells(w_function.ncells)
+        frame.closure = w_function.closure
+        frame.function = w_function
+        self.depth = depth + 1
+        assert base >= 0
+        for i in range(argc):
+            frame.regs[i] = caller.regs[base + i]
+        frame.back = caller
+        return frame
+
+    def reenter(self, w_function, frame, argc, base):
+        '''
+        return the frame of a tail call to `w_function`
+        from `frame`: `frame` itself, or a bigger one
+        taking its place
+        '''
+        size = w_function.nlocals + w_function.stacksize
+        nlocals = w_function.nlocals
+        assert base >= 0
+        if len(frame.regs) < size:
+            callee = RegisterFrame(frame.vars, size)
+            callee.reset(nlocals)
+            for i in range(argc):
+                callee.regs[i] = frame.regs[base + i]
+            callee.back = frame.back
+            callee.return_pc = frame.return_pc
+            callee.return_bc = frame.return_bc
+            callee.return_dst = frame.return_dst
+            callee.cells = new_cells(w_function.ncells)
+            callee.closure = w_function.closure
+            callee.function = w_function
+            self.frames[self.depth - 1] = callee
+            return callee
+
+        # the arguments are above the locals: copying
+        # forward never overwrites one not copied yet
+        for i in range(argc):
+            frame.regs[i] = frame.regs[base + i]
+        for i in range(argc, nlocals):
+            frame.regs[i] = None
+        frame.nlocals = nlocals
+        frame.cells = new_cells(w_function.ncells)
+        frame.closure = w_function.closure
+        frame.function = w_function
+        return frame
+
+    def leave(self, frame):
+        self.depth -= 1
+        frame.back = None
+
+
+def execute(frame, bc):
+    '''
+    execute register bytecode `bc` in `frame`
+    '''
+    dispatch(frame, bc, None, False)
+
+
+def execute_traced(frame, bc, tracer):
+    '''
+    execute register bytecode `bc`, reporting every
+    instruction to `tracer`, with its first operand
+    '''
+    dispatch(frame, bc, tracer, True)
+
+
+@specialize.arg(3)
+def dispatch(frame, bc, tracer, traced):
+    '''
+    the register VM loop, specialized on `traced`
+    like nolst.interpreter.dispatch
+    '''
+    from nolst import builtins
+    frames = RegisterFrameStack()
+    code = bc.code
+    pc = 0
+    while True:
+        if not traced:
+            driver.jit_merge_point(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+        c = ord(code[pc])
+        if traced:
+            arg = 0
+            if OPERANDS[c] > 0:
+                arg, _ = decode_arg(code, pc + 1)
+            tracer.instruction(bc, pc, c, arg, frame, frames.depth)
+        pc += 1
+
+        if c == MOVE:
+            dst, pc = decode_arg(code, pc)
+            src, pc = decode_arg(code, pc)
+            frame.store(dst, frame.value(bc, src))
+        elif c == ADD:
+            dst, pc = decode_arg(code, pc)
+            a, pc = decode_arg(code, pc)
+            b, pc = decode_arg(code, pc)
+            frame.store(dst, binary_add(frame.value(bc, a), frame.value(bc, b)))
+        elif c == LT:
+            dst, pc = decode_arg(code, pc)
+            a, pc = decode_arg(code, pc)
+            b, pc = decode_arg(code, pc)
+            frame.store(dst, binary_lt(frame.value(bc, a), frame.value(bc, b)))
+        elif c == JUMP_IF_NOT_LT:
+            target, pc = decode_arg(code, pc)
+            a, pc = decode_arg(code, pc)
+            b, pc = decode_arg(code, pc)
+            left = frame.value(bc, a)
+            right = frame.value(bc, b)
+            if isinstance(left, W_IntObject) and isinstance(right, W_IntObject):
+                # no boolean object at all
+                if not left.intval < right.intval:
+                    pc = target
+            elif not is_true(binary_lt(left, right)):
+                pc = target
+        elif c == JUMP_IF_FALSE:
+            target, pc = decode_arg(code, pc)
+            src, pc = decode_arg(code, pc)
+            if not is_true(frame.value(bc, src)):
+                pc = target
+        elif c == JUMP:
+            pc, _ = decode_arg(code, pc)
+        elif c == LOOP:
+            pc, _ = decode_arg(code, pc)
+            if not traced:
+                driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+        elif c == LOAD_GLOBAL:
+            dst, pc = decode_arg(code, pc)
+            name, pc = decode_arg(code, pc)
+            frame.store(dst, frame.var(bc, name))
+        elif c == STORE_GLOBAL:
+            name, pc = decode_arg(code, pc)
+            src, pc = decode_arg(code, pc)
+            frame.vars[name] = frame.value(bc, src)
+        elif c == LOAD_CELL:
+            dst, pc = decode_arg(code, pc)
+            cell, pc = decode_arg(code, pc)
+            frame.store(dst, frame.cell(cell))
+        elif c == STORE_CELL:
+            cell, pc = decode_arg(code, pc)
+            src, pc = decode_arg(code, pc)
+            frame.cells[cell].w_value = frame.value(bc, src)
+        elif c == LOAD_FREE:
+            dst, pc = decode_arg(code, pc)
+            index, pc = decode_arg(code, pc)
+            frame.store(dst, frame.closure[index])
+        elif c == LOAD_FREE_CELL:
+            dst, pc = decode_arg(code, pc)
+            index, pc = decode_arg(code, pc)
+            frame.store(dst, frame.free_cell(index))
+        elif c == PRINT:
+            src, pc = decode_arg(code, pc)
+            print('(nolst) ' + frame.value(bc, src).str())
+        elif c == LOAD_FUNCTION:
+            dst, pc = decode_arg(code, pc)
+            index, pc = decode_arg(code, pc)
+            frame.store(dst, bc.lambdas[index])
+        elif c == MAKE_CLOSURE:
+            dst, pc = decode_arg(code, pc)
+            index, pc = decode_arg(code, pc)
+            template = bc.lambdas[index]
+            closure = [None] * len(template.captures)
+            for i in range(len(template.captures)):
+                capture = template.captures[i]
+                source = capture & 3
+                slot = capture >> 2
+                assert slot >= 0
+                if source == scope.CAPTURE_LOCAL:
+                    closure[i] = frame.regs[slot]
+                elif source == scope.CAPTURE_CELL:
+                    closure[i] = frame.cells[slot]
+                else:
+                    closure[i] = frame.closure[slot]
+            frame.store(dst, template.with_closure(closure))
+        elif c == CALL:
+            dst, pc = decode_arg(code, pc)
+            f, pc = decode_arg(code, pc)
+            argc, pc = decode_arg(code, pc)
+            base, pc = decode_arg(code, pc)
+            function = frame.value(bc, f)
+            check_call(function, argc)
+            assert isinstance(function, W_LambdaObject)
+            callee = frames.enter(function, frame, argc, base)
+            callee.return_pc = pc
+            callee.return_bc = bc
+            callee.return_dst = dst
+            frame = callee
+            bc = function.bc
+            code = bc.code
+            pc = function.args
+            if not traced:
+                # function entry: recursion loops back here
+                driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+        elif c == TAIL_CALL:
+            f, pc = decode_arg(code, pc)
+            argc, pc = decode_arg(code, pc)
+            base, pc = decode_arg(code, pc)
+            function = frame.value(bc, f)
+            check_call(function, argc)
+            assert isinstance(function, W_LambdaObject)
+            frame = frames.reenter(function, frame, argc, base)
+            bc = function.bc
+            code = bc.code
+            pc = function.args
+            if not traced:
+                driver.can_enter_jit(pc=pc, code=code, bc=bc, frame=frame, frames=frames)
+        elif c == CALL_BUILTIN:
+            dst, pc = decode_arg(code, pc)
+            index, pc = decode_arg(code, pc)
+            argc, pc = decode_arg(code, pc)
+            base, pc = decode_arg(code, pc)
+            frame.store(dst, builtins.call_registers(index, argc, frame, base))
+        elif c == RETURN:
+            src, pc = decode_arg(code, pc)
+            w_result = frame.value(bc, src)
+            pc = frame.return_pc
+            bc = frame.return_bc
+            code = bc.code
+            dst = frame.return_dst
+            caller = frame.back
+            frames.leave(frame)
+            frame = caller
+            frame.store(dst, w_result)
+        elif c == HALT:
+            return
+        else:
+            assert False
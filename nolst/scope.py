@@ -0,0 +1,276 @@
+""" Scope analysis.
+
+A pass over the AST, before compilation, resolving every variable
+of a lambda at compile time:
+
+    - LOCAL: arguments and variables defined (`def`) in the lambda,
+      in a slot of its frame
+    - CELL: a local captured by a nested lambda and possibly
+      changed after its capture, in a cell of its frame
+      (cells outlive the call)
+    - FREE: a local of an enclosing lambda, its value copied in
+      the lambda's closure when the lambda is created
+    - FREE_CELL: same, the closure holding the cell of the
+      variable instead of its value
+    - GLOBAL: anything else, in the global variables table
+
+Closures are flat: a captured variable that can't change once
+captured is copied in the closure, and stays a plain local of the
+lambda defining it. Only the others need a cell, allocated at
+each call. A variable can't change once captured when it is:
+
+    - an argument never redefined
+    - defined once, by a statement of the lambda's body (not
+      nested in a while or an if) preceding the statement
+      creating the capturing lambda
+
+A `def` always defines a variable of the lambda it is in; outside
+of lambdas, variables are global. Every `Lambda` node gets its
+`Scope`, used by the compiler.
+"""
+
+LOCAL = 0
+CELL = 1
+FREE = 2
+FREE_CELL = 3
+GLOBAL = 4
+
+# where MAKE_CLOSURE finds a captured variable
+# in the frame creating the lambda
+CAPTURE_LOCAL = 0
+CAPTURE_CELL = 1
+CAPTURE_FREE = 2
+
+
+def encode_capture(source, index):
+    return (index << 2) | source
+
+
+class Scope(object):
+    '''
+    variables of a lambda
+    '''
+    def __init__(self, parent):
+        # scope of the enclosing lambda, None at top-level
+        self.parent = parent
+        # statement of the parent's body creating the lambda
+        self.created_at = 0
+        if parent is not None:
+            self.created_at = parent.position
+        # statement of the body being analyzed
+        self.position = 0
+        # arguments then defined variables, in order
+        self.names = []
+        self.nargs = 0
+        self.declared = {}
+        # name -> number of `def`, and statement of
+        # the last one (-1 if it isn't a body statement)
+        self.defs = {}
+        self.defined_at = {}
+        # variables captured by nested lambdas, in order,
+        # and the first statement capturing each
+        self.captured = []
+        self.captured_at = {}
+        # name -> frame slot (arguments first)
+        self.slots = {}
+        self.nlocals = 0
+        # name -> cell index, for captured locals
+        self.cells = {}
+        self.ncells = 0
+        # name -> closure index, and names in closure order
+        self.free = {}
+        self.freevars = []
+
+    def declare_arg(self, name):
+        self.declare(name)
+        self.nargs += 1
+
+    def declare(self, name):
+        if name not in self.declared:
+            self.declared[name] = len(self.names)
+            self.names.append(name)
+
+    def define(self, name, position):
+        self.declare(name)
+        self.defs[name] = self.defs.get(name, 0) + 1
+        self.defined_at[name] = position
+
+    def owner(self, name):
+        '''
+        the scope defining `name`, None if it is global
+        '''
+        owner = self
+        while owner is not None and name not in owner.declared:
+            owner = owner.parent
+        return owner
+
+    def reference(self, name):
+        '''
+        `name` is used in this lambda: if it is
+        a local of an enclosing lambda, capture it
+        '''
+        if name in self.declared or name in self.free:
+            return
+        owner = self.owner(name)
+        if owner is None:
+            return
+        # every lambda in between gets it in its closure,
+        # to pass it on
+        scope = self
+        while scope.parent is not owner:
+            scope.add_free(name)
+            scope = scope.parent
+        scope.add_free(name)
+        owner.capture(name, scope.created_at)
+
+    def capture(self, name, position):
+        if name not in self.captured_at:
+            self.captured.append(name)
+            self.captured_at[name] = position
+        elif position < self.captured_at[name]:
+            self.captured_at[name] = position
+
+    def is_constant_capture(self, name):
+        '''
+        whether captured `name` can't change once captured
+        '''
+        if self.declared[name] < self.nargs:
+            return name not in self.defs
+        return (self.defs[name] == 1 and self.defined_at[name] >= 0
+                and self.defined_at[name] < self.captured_at[name])
+
+    def allocate_cells(self):
+        for name in self.captured:
+            if not self.is_constant_capture(name):
+                self.cells[name] = self.ncells
+                self.ncells += 1
+
+    def add_free(self, name):
+        if name not in self.free:
+            self.free[name] = len(self.freevars)
+            self.freevars.append(name)
+
+    def allocate_slots(self):
+        '''
+        once the whole lambda was analyzed: arguments get the
+        first slots (where CALL leaves them), then locals that
+        are not in cells
+        '''
+        for i in range(len(self.names)):
+            name = self.names[i]
+            if i < self.nargs or name not in self.cells:
+                self.slots[name] = self.nlocals
+                self.nlocals += 1
+
+    def kind(self, name):
+        if name in self.cells:
+            return CELL
+        elif name in self.slots:
+            return LOCAL
+        elif name in self.free:
+            if name in self.owner(name).cells:
+                return FREE_CELL
+            return FREE
+        return GLOBAL
+
+    def index(self, name):
+        '''
+        slot, cell or closure index of `name`,
+        depending on its kind
+        '''
+        if name in self.cells:
+            return self.cells[name]
+        elif name in self.slots:
+            return self.slots[name]
+        return self.free[name]
+
+    def variable_names(self):
+        '''
+        names of the slots, then of the cells, then of
+        the closure entries (for error messages)
+        '''
+        names = [''] * (self.nlocals + self.ncells)
+        for name, slot in self.slots.items():
+            names[slot] = name
+        for name, cell in self.cells.items():
+            names[self.nlocals + cell] = name
+        return names + self.freevars
+
+    def captured_args(self):
+        '''
+        (slot, cell) of the arguments living in cells:
+        they are moved there once bound
+        '''
+        moves = []
+        for i in range(self.nargs):
+            name = self.names[i]
+            if name in self.cells:
+                moves.append((self.slots[name], self.cells[name]))
+        return moves
+
+    def captures(self):
+        '''
+        where the lambda creation finds each closure entry in
+        the frame of the enclosing lambda (see encode_capture)
+        '''
+        parent = self.parent
+        captures = []
+        for name in self.freevars:
+            if name in parent.cells:
+                captures.append(encode_capture(CAPTURE_CELL, parent.cells[name]))
+            elif name in parent.slots:
+                captures.append(encode_capture(CAPTURE_LOCAL, parent.slots[name]))
+            else:
+                captures.append(encode_capture(CAPTURE_FREE, parent.free[name]))
+        return captures
+
+
+def body_statements(body):
+    from nolst.sourceparser import Sexpr, Do
+    if isinstance(body, Sexpr) or isinstance(body, Do):
+        return body.stmts
+    return [body]
+
+
+def declare(node, scope, position=-1):
+    '''
+    declare the variables defined by `node` in `scope`,
+    not looking into nested lambdas. `position` is the
+    statement `node` is, -1 if it is nested in one.
+    '''
+    from nolst.sourceparser import Assignment, Lambda
+    if isinstance(node, Lambda):
+        return
+    if isinstance(node, Assignment):
+        scope.define(node.varname, position)
+    for child in node.children():
+        declare(child, scope)
+
+
+def visit(node, scope):
+    from nolst.sourceparser import Lambda, Variable
+    if isinstance(node, Lambda):
+        inner = Scope(scope)
+        for arg in node.args.stmts:
+            inner.declare_arg(arg.varname)
+        stmts = body_statements(node.body)
+        for i in range(len(stmts)):
+            declare(stmts[i], inner, i)
+        for i in range(len(stmts)):
+            inner.position = i
+            visit(stmts[i], inner)
+        inner.allocate_cells()
+        inner.allocate_slots()
+        node.scope = inner
+        return
+    if isinstance(node, Variable) and scope is not None:
+        scope.reference(node.varname)
+    for child in node.children():
+        visit(child, scope)
+
+
+def analyze(astnode):
+    '''
+    give its Scope to every lambda of `astnode`
+    '''
+    visit(astnode, None)
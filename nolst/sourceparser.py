@@ -1,12 +1,24 @@
-import py
-from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
 from nolst import bytecode
+from nolst import parsergen
+from nolst import scope
+from rpython.rlib.rarithmetic import string_to_int
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rstring import ParseStringError, ParseStringOverflowError
 import os
 VIEW = os.environ.get('NVIEW')
 
-grammar = py.path.local("./nolst/").join('grammar.txt').read("rt")
-regexs, rules, ToAST = parse_ebnf(grammar)
-_parse = make_parse_function(regexs, rules, eof=True)
+# (parse function, ToAST) of the generic parser, built on the
+# first parse_generic call: loading the lexer/parser tables (cached
+# in nolst/grammar_tables.py) is not part of the startup anymore
+_generic_parser = []
+
+
+def generic_parser():
+    if not _generic_parser:
+        lexer, rules, ToAST = parsergen.load_tables()
+        _generic_parser.append((parsergen.make_parse_function(lexer, rules),
+                                ToAST))
+    return _generic_parser[0]
 
 class Node(object):
     """ The abstract AST node
@@ -18,6 +30,33 @@ class Node(object):
     def __ne__(self, other):
         return not self == other
 
+    def compile_tail(self, ctx):
+        """ Compile the node in tail position of a lambda:
+        its value is the result of the function.
+        """
+        self.compile(ctx)
+
+    def children(self):
+        """ The nodes this node is made of (see nolst.scope)
+        """
+        return []
+
+def compile_sequence(ctx, stmts, tail=False):
+    """ Every expression leaves exactly one value on the stack:
+    the value of a sequence is the value of its last statement,
+    the others are discarded. An empty sequence is nil.
+    """
+    if not stmts:
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_nil_constant())
+        return
+    for i in range(len(stmts) - 1):
+        Stmt(stmts[i]).compile(ctx)
+    if tail:
+        stmts[-1].compile_tail(ctx)
+    else:
+        stmts[-1].compile(ctx)
+
+
 class Sexpr(Node):
     """ A list of statements
     """
@@ -25,8 +64,13 @@ class Sexpr(Node):
         self.stmts = stmts
 
     def compile(self, ctx):
-        for stmt in self.stmts:
-            stmt.compile(ctx)
+        compile_sequence(ctx, self.stmts)
+
+    def compile_tail(self, ctx):
+        compile_sequence(ctx, self.stmts, tail=True)
+
+    def children(self):
+        return self.stmts
 
 
 class Do(Node):
@@ -36,8 +80,13 @@ class Do(Node):
         self.stmts = stmts
 
     def compile(self, ctx):
-        for stmt in self.stmts:
-            stmt.compile(ctx)
+        compile_sequence(ctx, self.stmts)
+
+    def compile_tail(self, ctx):
+        compile_sequence(ctx, self.stmts, tail=True)
+
+    def children(self):
+        return self.stmts
 
 
         #for i in range(len(self.stmts) - 1):
@@ -50,6 +99,13 @@ class Lambda(Node):
     def __init__(self, args, body):
         self.args = args
         self.body = body
+        # variables resolution, by nolst.scope
+        self.scope = None
+        # set by the assignment defining it, if any
+        self.name = 'lambda'
+
+    def children(self):
+        return [self.args, self.body]
 
     def compile(self, ctx):
         from nolst.interpreter import W_LambdaObject
@@ -71,19 +127,41 @@ class Lambda(Node):
         )
 
 
-        a_unit = bytecode.compile_partial(self.args, ctx)
-        b_unit = bytecode.compile_partial(self.body, ctx)
-
-        # compile the lambda object
+        lambda_scope = self.scope
+        ctx.enter_lambda(lambda_scope)
+        # arguments are the first local variables, in
+        # order: CALL copies them there, nothing to bind.
+        # Captured arguments live in cells, though.
+        for slot, cell in lambda_scope.captured_args():
+            ctx.emit(bytecode.LOAD_LOCAL, slot)
+            ctx.emit(bytecode.ASSIGN_CELL, cell)
+        body_addr = ctx.size()
+        # calls ending the body are tail calls
+        self.body.compile_tail(ctx)
+        ctx.leave_lambda()
+
+        # compile the lambda object.
+        # addresses are instruction indexes until
+        # the bytecode is assembled.
+        captures = []
+        if lambda_scope.freevars:
+            captures = lambda_scope.captures()
         w = W_LambdaObject(
-            rjm_addr + 2 ,
-            rjm_addr + 2 + a_unit.size()
+            rjm_addr + 1,
+            body_addr,
+            lambda_scope.nlocals,
+            0,
+            lambda_scope.ncells,
+            captures,
+            len(self.args.stmts),
+            self.name,
+            lambda_scope.variable_names()
         )
 
-        # change the BACK argument (addr),
+        # change the AJUMP argument (addr),
         # here we can compute properly
-        # the return offset
-        ctx.hotfix_inst_arg(rjm_addr, ctx.size() + 2)
+        # the return offset: right after the BACK instruction
+        ctx.hotfix_inst_arg(rjm_addr, ctx.size() + 1)
 
         # FIXME cleanup code
         # for item in self.args.stmts:
@@ -96,7 +174,11 @@ class Lambda(Node):
         # following the function bytecode and the BACK instruction.
         # We'll jump on it when the function bytecode is encountered,
         # handling function like a variable.
-        ctx.emit(bytecode.LOAD_FUNCTION, ctx.register_lambda(w))
+        if captures:
+            # a new lambda object, capturing cells
+            ctx.emit(bytecode.MAKE_CLOSURE, ctx.register_lambda(w))
+        else:
+            ctx.emit(bytecode.LOAD_FUNCTION, ctx.register_lambda(w))
 
     #def __init__(self, varname):
     #    self.varname = varname
@@ -115,6 +197,9 @@ class Stmt(Node):
         self.expr.compile(ctx)
         ctx.emit(bytecode.DISCARD_TOP)
 
+    def children(self):
+        return [self.expr]
+
 class ConstantInt(Node):
     """ Represent a constant
     """
@@ -122,10 +207,30 @@ class ConstantInt(Node):
         self.intval = intval
 
     def compile(self, ctx):
-        # convert the integer to W_IntObject already here
-        from nolst.interpreter import W_IntObject
-        w = W_IntObject(self.intval)
-        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_constant(w))
+        # the context converts the integer to a
+        # (shared) W_IntObject already here
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_int_constant(self.intval))
+
+class ConstantBigInt(Node):
+    """ Represent a constant too big for a machine word,
+    by its digits
+    """
+    def __init__(self, digits):
+        self.digits = digits
+
+    def compile(self, ctx):
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_bigint_constant(self.digits))
+
+
+def int_constant(text):
+    """ A ConstantInt, or a ConstantBigInt if `text`
+    doesn't fit in a machine word
+    """
+    try:
+        return ConstantInt(string_to_int(text))
+    except ParseStringOverflowError:
+        # fromstr checks the rest of the digits
+        return ConstantBigInt(rbigint.fromstr(text, 10).str())
 
 class ConstantString(Node):
     """ Represent a constant
@@ -134,10 +239,9 @@ class ConstantString(Node):
         self.strval = strval
 
     def compile(self, ctx):
-        # convert the integer to W_IntObject already here
-        from nolst.interpreter import W_StringObject
-        w = W_StringObject(self.strval)
-        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_constant(w))
+        # the context converts the string to a
+        # (shared) W_StringObject already here
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_str_constant(self.strval))
 
 class UnevaluatedSymbol(Node):
     """ Represent anything unevaluated
@@ -146,10 +250,8 @@ class UnevaluatedSymbol(Node):
         self.strval = strval
 
     def compile(self, ctx):
-        # convert the integer to W_IntObject already here
-        from nolst.interpreter import W_SymbolObject
-        w = W_SymbolObject(self.strval)
-        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_constant(w))
+        # the context converts the symbol to W_SymbolObject already here
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_symbol_constant(self.strval))
 
 
 class ConstantFloat(Node):
@@ -159,18 +261,14 @@ class ConstantFloat(Node):
         self.floatval = floatval
 
     def compile(self, ctx):
-        # convert the integer to W_FloatObject already here
-        from nolst.interpreter import W_FloatObject
-        w = W_FloatObject(self.floatval)
-        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_constant(w))
+        # the context converts the float to W_FloatObject already here
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_float_constant(self.floatval))
 
 
 class FuncCall(Node):
     """ A function call
     """
     def __init__(self, fname, arguments=[]):
-        print(fname)
-        #exit(0)
         self.function_name = fname
         self.args = arguments
 
@@ -182,9 +280,35 @@ class FuncCall(Node):
 
         # load function var
         self.function_name.compile(ctx)
-        ctx.emit(bytecode.CALL)
+        ctx.emit(bytecode.CALL, len(self.args))
+
+    def children(self):
+        return self.args + [self.function_name]
+
+    def compile_tail(self, ctx):
+        for a in self.args:
+            a.compile(ctx)
+        self.function_name.compile(ctx)
+        # the callee takes over the frame, and
+        # returns directly to our caller
+        ctx.emit(bytecode.TAIL_CALL, len(self.args))
+
+
+
+class BuiltinCall(Node):
+    """ Call of a native builtin (see nolst.builtins)
+    """
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
 
+    def compile(self, ctx):
+        for a in self.args:
+            a.compile(ctx)
+        ctx.emit(bytecode.CALL_BUILTIN, self.index, len(self.args))
 
+    def children(self):
+        return self.args
 
 
 class BinOp(Node):
@@ -196,9 +320,17 @@ class BinOp(Node):
         self.right = right
 
     def compile(self, ctx):
+        from nolst import builtins
         self.left.compile(ctx)
         self.right.compile(ctx)
-        ctx.emit(bytecode.BINOP[self.op])
+        if self.op in bytecode.BINOP_BUILTINS:
+            index = builtins.lookup(bytecode.BINOP_BUILTINS[self.op])
+            ctx.emit(bytecode.CALL_BUILTIN, index, 2)
+        else:
+            ctx.emit(bytecode.BINOP[self.op])
+
+    def children(self):
+        return [self.left, self.right]
 
 class BaseList(Node):
     """ Base class for list related
@@ -207,10 +339,15 @@ class BaseList(Node):
         self.content = content
 
     def compile(self, ctx):
-        from nolst.interpreter import W_ListObject
+        # built at runtime, like (list ...)
+        from nolst import builtins
+        for item in self.content:
+            item.compile(ctx)
+        ctx.emit(bytecode.CALL_BUILTIN, builtins.lookup('list'),
+                 len(self.content))
 
-        obj = W_ListObject(self.content)
-        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_constant(obj))
+    def children(self):
+        return self.content
 
 class QuotedExpr(BaseList):
 
@@ -219,6 +356,9 @@ class QuotedExpr(BaseList):
     def __init__(self, content):
         self.content = content
 
+    def children(self):
+        return []
+
 
 
     def compile(self, ctx):
@@ -254,7 +394,17 @@ class Variable(Node):
         self.varname = varname
 
     def compile(self, ctx):
-        ctx.emit(bytecode.LOAD_VAR, ctx.register_var(self.varname))
+        kind = ctx.variable_kind(self.varname)
+        if kind == scope.LOCAL:
+            ctx.emit(bytecode.LOAD_LOCAL, ctx.variable_index(self.varname))
+        elif kind == scope.CELL:
+            ctx.emit(bytecode.LOAD_CELL, ctx.variable_index(self.varname))
+        elif kind == scope.FREE:
+            ctx.emit(bytecode.LOAD_FREE, ctx.variable_index(self.varname))
+        elif kind == scope.FREE_CELL:
+            ctx.emit(bytecode.LOAD_FREE_CELL, ctx.variable_index(self.varname))
+        else:
+            ctx.emit(bytecode.LOAD_VAR, ctx.register_var(self.varname))
 
 class Assignment(Node):
     """ Assign to a variable
@@ -262,14 +412,38 @@ class Assignment(Node):
     def __init__(self, varname, expr):
         self.varname = varname
         self.expr = expr
+        if isinstance(expr, Lambda):
+            expr.name = varname
 
     def compile_cleanup(self, ctx):
         ctx.emit(bytecode.DELETE_VAR, ctx.var_pos(self.varname))
 
+    def children(self):
+        if self.expr is None:
+            return []
+        return [self.expr]
+
     def compile(self, ctx):
-        if self.expr is not None:
-            self.expr.compile(ctx)
-        ctx.emit(bytecode.ASSIGN, ctx.register_var(self.varname))
+        # (without expression, an assignment is a lambda
+        # argument: CALL binds it, it is never compiled)
+        self.expr.compile(ctx)
+        kind = ctx.variable_kind(self.varname)
+        if kind == scope.LOCAL:
+            # defined in a function: local variable
+            slot = ctx.variable_index(self.varname)
+            ctx.emit(bytecode.ASSIGN_LOCAL, slot)
+            load = bytecode.LOAD_LOCAL
+        elif kind == scope.CELL:
+            # local variable captured by a nested lambda
+            slot = ctx.variable_index(self.varname)
+            ctx.emit(bytecode.ASSIGN_CELL, slot)
+            load = bytecode.LOAD_CELL
+        else:
+            slot = ctx.register_var(self.varname)
+            ctx.emit(bytecode.ASSIGN, slot)
+            load = bytecode.LOAD_VAR
+        # a definition is worth the assigned value
+        ctx.emit(load, slot)
 
 
 class While(Node):
@@ -279,14 +453,18 @@ class While(Node):
         self.cond = cond
         self.body = body
 
+    def children(self):
+        return [self.cond, self.body]
+
     def compile(self, ctx):
-        pos = len(ctx.data)
+        pos = ctx.size()
         self.cond.compile(ctx)
-        ctx.emit(bytecode.JUMP_IF_FALSE, 0)
-        jmp_pos = len(ctx.data) - 1
-        self.body.compile(ctx)
+        jmp_pos = ctx.emit(bytecode.JUMP_IF_FALSE, 0)
+        Stmt(self.body).compile(ctx)
         ctx.emit(bytecode.JUMP_BACKWARD, pos)
-        ctx.data[jmp_pos] = chr(len(ctx.data))
+        ctx.hotfix_inst_arg(jmp_pos, ctx.size())
+        # a loop is worth nil
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_nil_constant())
 
 class If(Node):
     """ A very simple if
@@ -295,18 +473,37 @@ class If(Node):
         self.cond = cond
         self.body = body
 
+    def children(self):
+        return [self.cond, self.body]
+
     def compile(self, ctx):
+        self.compile_branches(ctx, False)
+
+    def compile_tail(self, ctx):
+        self.compile_branches(ctx, True)
+
+    def compile_branches(self, ctx, tail):
         self.cond.compile(ctx)
-        ctx.emit(bytecode.JUMP_IF_FALSE, 0)
-        jmp_pos = len(ctx.data) - 1
-        self.body.compile(ctx)
-        ctx.data[jmp_pos] = chr(len(ctx.data))
+        jmp_pos = ctx.emit(bytecode.JUMP_IF_FALSE, 0)
+        if tail:
+            self.body.compile_tail(ctx)
+        else:
+            self.body.compile(ctx)
+        end_pos = ctx.emit(bytecode.AJUMP, 0)
+        # no else branch: nil
+        ctx.hotfix_inst_arg(jmp_pos, ctx.size())
+        ctx.emit(bytecode.LOAD_CONSTANT, ctx.register_nil_constant())
+        ctx.hotfix_inst_arg(end_pos, ctx.size())
 
 class Print(Node):
     def __init__(self, expr):
         self.expr = expr
 
+    def children(self):
+        return [self.expr]
+
     def compile(self, ctx):
+        # PRINT replaces the value by nil
         self.expr.compile(ctx)
         ctx.emit(bytecode.PRINT, 0)
 
@@ -317,7 +514,7 @@ class Transformer(object):
 
     def visit_atom(self, node):
         if node.children[0].symbol == 'DECIMAL':
-            return ConstantInt(int(node.children[0].token.source))
+            return int_constant(node.children[0].token.source)
         elif node.children[0].symbol == 'SYMBOL':
             return Variable(node.children[0].token.source)
         elif node.children[0].symbol == 'STRING':
@@ -338,7 +535,7 @@ class Transformer(object):
 
         # terminals
         elif node.symbol == 'DECIMAL':
-            return ConstantInt(int(node.token.source))
+            return int_constant(node.token.source)
 
         elif node.symbol == 'SYMBOL':
             return Variable(node.token.source)
@@ -375,6 +572,7 @@ class Transformer(object):
 
 
     def visit_sexpr(self, node):
+        from nolst import builtins
 
         expr = []
         # node.children contains nor atoms
@@ -428,8 +626,23 @@ class Transformer(object):
                         self.dispatch(node.children[2])
                     )
                 )
+            elif c.children[0].token.source == 'while':
+                expr.append(
+                    While(
+                        self.dispatch(node.children[1]),
+                        self.dispatch(node.children[2])
+                    )
+                )
             elif c.children[0].token.source == 'print':
                 expr.append(Print(self.dispatch(node.children[1])))
+            elif builtins.lookup(c.children[0].token.source) >= 0:
+                # arguments counted as by the Reader
+                index = builtins.lookup(c.children[0].token.source)
+                args = [self.dispatch(i.children[0]) for i in node.children[1:]]
+                if builtins.arity(index) != builtins.VARIADIC:
+                    check_count(c.children[0].token.source, args,
+                                builtins.arity(index), c.children[0].token.source_pos.i)
+                expr.append(BuiltinCall(index, args))
             else:
                 # this is a function call
                 expr.append(
@@ -465,9 +678,384 @@ class Transformer(object):
 
 transformer = Transformer()
 
+
+class ReaderError(Exception):
+    def __init__(self, msg, pos):
+        self.msg = msg
+        self.pos = pos
+
+    def __str__(self):
+        return '%s (at offset %d)' %(self.msg, self.pos)
+
+
+# kinds of lists handled by the reader
+LIST_ROOT = 0
+# an evaluated form: special form or function call
+LIST_FORM = 1
+# lambda's argument names
+LIST_ARGS = 2
+# quoted data
+LIST_QUOTED = 3
+
+DELIMITERS = ' \t\r\n()";\''
+
+# lists nested deeper are rejected: the scope analysis and the
+# compilers recurse on the AST (as CPython's parser, 200 levels)
+MAX_NESTING = 200
+
+# heads of the forms built by the reader itself
+SPECIAL_FORMS = ['def', 'do', 'lambda', 'add', 'lt', '<', 'if', 'while', 'print']
+
+
+def is_reserved(name):
+    ''' whether `name` is a special form or a builtin: a form
+    with this head resolves to it at compile time, whatever
+    a variable of that name would hold
+    '''
+    from nolst import builtins
+    return name in SPECIAL_FORMS or builtins.lookup(name) >= 0
+
+
+class ReaderFrame(object):
+    """ A list being read
+    """
+    def __init__(self, kind, pos):
+        self.kind = kind
+        self.pos = pos
+        # head symbol of a form, '' if the head is not a symbol
+        self.head = ''
+        self.count = 0
+        self.items = []
+
+
+class Reader(object):
+    """ Single pass S-expression reader.
+
+    Produces the AST straight from the source text. Nesting is
+    handled with an explicit stack of ReaderFrame, not with python
+    recursion. The passes after it recurse: lists are nested at
+    most MAX_NESTING deep.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+        self.stack = [ReaderFrame(LIST_ROOT, 0)]
+        # a quote is waiting for its datum
+        self.quote = False
+
+    def read(self):
+        source = self.source
+        end = len(source)
+        while self.pos < end:
+            ch = source[self.pos]
+            if ch == ' ' or ch == '\n' or ch == '\t' or ch == '\r':
+                self.pos += 1
+            elif ch == ';':
+                # comment, up to the end of the line
+                while self.pos < end and source[self.pos] != '\n':
+                    self.pos += 1
+            elif ch == '(':
+                self.open_list()
+                self.pos += 1
+            elif ch == ')':
+                self.close_list()
+                self.pos += 1
+            elif ch == "'":
+                if self.quote:
+                    raise ReaderError("unexpected quote", self.pos)
+                self.quote = True
+                self.pos += 1
+            elif ch == '"':
+                self.read_string()
+            else:
+                self.read_atom()
+
+        if len(self.stack) > 1:
+            raise ReaderError("missing ')'", self.stack[-1].pos)
+        if self.quote:
+            raise ReaderError("nothing to quote", self.pos)
+        return Sexpr(self.stack[0].items)
+
+    def is_blank(self):
+        """ true if the source holds no datum
+        (only blanks and comments) """
+        source = self.source
+        i = 0
+        while i < len(source):
+            ch = source[i]
+            if ch == ';':
+                while i < len(source) and source[i] != '\n':
+                    i += 1
+            elif ch not in ' \t\r\n':
+                return False
+            i += 1
+        return True
+
+    def open_list(self):
+        parent = self.stack[-1]
+        if self.quote or parent.kind == LIST_QUOTED:
+            kind = LIST_QUOTED
+            self.quote = False
+        elif parent.kind == LIST_FORM and parent.head == 'lambda' and parent.count == 1:
+            kind = LIST_ARGS
+        else:
+            kind = LIST_FORM
+        if len(self.stack) > MAX_NESTING:
+            raise ReaderError("too deeply nested", self.pos)
+        self.stack.append(ReaderFrame(kind, self.pos))
+
+    def close_list(self):
+        if len(self.stack) == 1:
+            raise ReaderError("unexpected ')'", self.pos)
+        if self.quote:
+            raise ReaderError("nothing to quote", self.pos)
+        frame = self.stack.pop()
+        self.add_item(self.build(frame))
+
+    def read_string(self):
+        source = self.source
+        start = self.pos
+        self.pos += 1
+        chars = []
+        while True:
+            if self.pos >= len(source):
+                raise ReaderError("unterminated string", start)
+            ch = source[self.pos]
+            self.pos += 1
+            if ch == '"':
+                break
+            if ch == '\\' and self.pos < len(source):
+                ch = source[self.pos]
+                self.pos += 1
+                if ch == 'n':
+                    ch = '\n'
+                elif ch == 't':
+                    ch = '\t'
+            chars.append(ch)
+        self.add_atom(ConstantString(''.join(chars)))
+
+    def read_atom(self):
+        source = self.source
+        start = self.pos
+        while self.pos < len(source) and source[self.pos] not in DELIMITERS:
+            self.pos += 1
+        text = source[start:self.pos]
+
+        frame = self.stack[-1]
+        if self.quote or frame.kind == LIST_QUOTED:
+            self.add_atom(UnevaluatedSymbol(text))
+        elif is_number(text):
+            self.add_atom(self.number(text, start))
+        elif frame.kind == LIST_FORM and frame.count == 0:
+            frame.head = text
+            frame.count = 1
+        else:
+            self.add_atom(Variable(text))
+
+    def number(self, text, pos):
+        try:
+            for ch in text:
+                if ch == '.' or ch == 'e' or ch == 'E':
+                    return ConstantFloat(float(text))
+            return int_constant(text)
+        except (ValueError, ParseStringError):
+            raise ReaderError("invalid number %s" %text, pos)
+
+    def add_atom(self, node):
+        self.quote = False
+        self.add_item(node)
+
+    def add_item(self, node):
+        frame = self.stack[-1]
+        frame.items.append(node)
+        frame.count += 1
+
+    def build(self, frame):
+        """ Build the node of a list that just closed
+        """
+        from nolst import builtins
+        items = frame.items
+        if frame.kind == LIST_QUOTED:
+            return QuotedExpr(items)
+        elif frame.kind == LIST_ARGS:
+            args = []
+            for item in items:
+                if not isinstance(item, Variable):
+                    raise ReaderError("invalid argument name", frame.pos)
+                if is_reserved(item.varname):
+                    raise ReaderError("can't redefine %s" % item.varname, frame.pos)
+                args.append(Assignment(item.varname, None))
+            return Do(args)
+
+        head = frame.head
+        if head == '':
+            if not items:
+                # ()
+                return Sexpr([])
+            # the function is an expression, e.g. ((lambda (x) x) 1)
+            return FuncCall(items[0], items[1:])
+        elif head == 'def':
+            self.check_count(frame, 2)
+            name = items[0]
+            if not isinstance(name, Variable):
+                raise ReaderError("invalid variable name", frame.pos)
+            if is_reserved(name.varname):
+                raise ReaderError("can't redefine %s" % name.varname, frame.pos)
+            return Assignment(name.varname, items[1])
+        elif head == 'do':
+            return Do(items)
+        elif head == 'lambda':
+            self.check_count(frame, 2)
+            # the argument list is built as a Do
+            if not isinstance(items[0], Do):
+                raise ReaderError("lambda expects an argument list", frame.pos)
+            return Lambda(items[0], items[1])
+        elif head == 'add':
+            self.check_count(frame, 2)
+            return BinOp('+', items[0], items[1])
+        elif head == 'lt' or head == '<':
+            self.check_count(frame, 2)
+            return BinOp('<', items[0], items[1])
+        elif head == 'if':
+            self.check_count(frame, 2)
+            return If(items[0], items[1])
+        elif head == 'while':
+            self.check_count(frame, 2)
+            return While(items[0], items[1])
+        elif head == 'print':
+            self.check_count(frame, 1)
+            return Print(items[0])
+        index = builtins.lookup(head)
+        if index >= 0:
+            if builtins.arity(index) != builtins.VARIADIC:
+                self.check_count(frame, builtins.arity(index))
+            return BuiltinCall(index, items)
+        # this is a function call
+        return FuncCall(Variable(head), items)
+
+    def check_count(self, frame, count):
+        check_count(frame.head, frame.items, count, frame.pos)
+
+
+def check_count(head, items, count, pos):
+    '''
+    the arguments `items` of form `head` must be `count`
+    '''
+    if len(items) != count:
+        raise ReaderError("%s expects %d arguments" %(head, count), pos)
+
+
+def is_number(text):
+    i = 0
+    if text[0] == '-' or text[0] == '+':
+        if len(text) == 1:
+            return False
+        i = 1
+    return text[i].isdigit() or (text[i] == '.' and len(text) > i + 1)
+
+
+class FormScanner(object):
+    """ Split a character stream into complete top-level forms.
+
+    Input is fed by chunks of any size. The parentheses balance is
+    tracked incrementally, ignoring parentheses inside strings and
+    comments. Every chunk is scanned once and every form is joined
+    once, so the cost stays linear in the input size.
+
+    A top-level atom (`42`, `x`, a string) is a form of its own,
+    complete once its token ends.
+    """
+    def __init__(self):
+        # parts of the pending form, from previous chunks
+        self.pieces = []
+        self.depth = 0
+        self.in_string = False
+        self.in_comment = False
+        self.escape = False
+        # in a top-level atom, other than a string
+        self.in_atom = False
+
+    def feed(self, chunk):
+        """ return the list of forms completed by `chunk`.
+        An unbalanced ')' completes a form too:
+        the reader will report it.
+        """
+        forms = []
+        start = 0
+        for i in range(len(chunk)):
+            ch = chunk[i]
+            if self.in_atom:
+                if ch not in DELIMITERS:
+                    continue
+                # the delimiter is not part of the
+                # atom: it is scanned below
+                self.in_atom = False
+                forms.append(self.complete(chunk[start:i]))
+                start = i
+            if self.in_comment:
+                if ch == '\n':
+                    self.in_comment = False
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 0:
+                        forms.append(self.complete(chunk[start:i + 1]))
+                        start = i + 1
+            elif ch == '"':
+                self.in_string = True
+            elif ch == ';':
+                self.in_comment = True
+            elif ch == '(':
+                self.depth += 1
+            elif ch == ')':
+                self.depth -= 1
+                if self.depth <= 0:
+                    self.depth = 0
+                    forms.append(self.complete(chunk[start:i + 1]))
+                    start = i + 1
+            elif self.depth == 0 and ch not in DELIMITERS:
+                self.in_atom = True
+        if start < len(chunk):
+            self.pieces.append(chunk[start:])
+        return forms
+
+    def complete(self, piece):
+        """ the pending form, ending with `piece`
+        """
+        self.pieces.append(piece)
+        form = ''.join(self.pieces)
+        self.pieces = []
+        return form
+
+    def flush(self):
+        """ return what is left at the end of the input,
+        or '' if there is nothing but blanks and comments
+        """
+        rest = ''.join(self.pieces)
+        self.pieces = []
+        self.depth = 0
+        self.in_string = self.in_comment = self.escape = False
+        self.in_atom = False
+        if Reader(rest).is_blank():
+            return ''
+        return rest
+
+
 def parse(source):
     """ Parse the source code and produce an AST
     """
+    return Reader(source).read()
+
+
+def parse_generic(source):
+    """ Parse the source code with the generic EBNF
+    parser (grammar.txt), then transform it into an AST
+    """
+    _parse, ToAST = generic_parser()
     parsed = _parse(source)
     #print(parsed)
     #parsed.view()
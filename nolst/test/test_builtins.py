@@ -0,0 +1,152 @@
+import pytest
+
+from nolst.interpreter import (Session, InterpreterError, W_IntObject,
+                               W_BigIntObject, W_ListObject, W_StringObject)
+
+backends = pytest.mark.parametrize('registers', [False, True])
+
+
+def run(source, registers):
+    session = Session(registers=registers)
+    session.run(source)
+    return session
+
+
+def value(session, name):
+    '''
+    the value of global variable `name`
+    '''
+    if session.registers:
+        frame = session.register_frame
+    else:
+        frame = session.frame
+    return frame.vars[session.names.var_pos(name)]
+
+
+def output(source, registers, capsys):
+    run(source, registers)
+    return capsys.readouterr()[0].replace('(nolst) ', '').splitlines()
+
+
+def error(source, registers):
+    with pytest.raises(InterpreterError) as e:
+        run(source, registers)
+    return e.value.msg
+
+
+# lists
+
+@backends
+def test_list_operations(registers, capsys):
+    assert output("""
+    (def l (list 1 2 3))
+    (push l 4)
+    (print l) (print (len l)) (print (nth l 3))
+    (print (slice l 1 3)) (print (slice l -5 99)) (print (cons 0 l))
+    (print l)
+    """, registers, capsys) == [
+        '[1, 2, 3, 4]', '4', '4', '[2, 3]', '[1, 2, 3, 4]',
+        '[0, 1, 2, 3, 4]', '[1, 2, 3, 4]']
+
+
+@backends
+def test_list_strategy(registers, capsys):
+    # ints unboxed until the first other item
+    session = run("(def l (list 1 2)) (def m (list 1 \"a\"))", registers)
+    w_l = value(session, 'l')
+    assert isinstance(w_l, W_ListObject)
+    assert w_l.ints == [1, 2] and w_l.items is None
+    assert value(session, 'm').ints is None
+    session.run("(push l \"b\") (print l) (print (nth l 0))")
+    assert w_l.ints is None and len(w_l.items) == 3
+    assert capsys.readouterr()[0] == "(nolst) [1, 2, b]\n(nolst) 1\n"
+
+
+@backends
+def test_list_push_many(registers, capsys):
+    assert output("""
+    (def l (list))
+    (def i 0)
+    (while (< i 1000) (do (push l i) (def i (add i 1))))
+    (print (len l)) (print (nth l 999))
+    """, registers, capsys) == ['1000', '999']
+
+
+@backends
+def test_list_errors(registers):
+    assert error("(nth (list 1) 1)", registers) == "nth: index 1 out of range"
+    assert error("(nth (list 1) -1)", registers) == "nth: index -1 out of range"
+    assert error("(nth 1 0)", registers) == "nth: wrong type 1"
+
+
+# strings
+
+@backends
+def test_string_operations(registers, capsys):
+    assert output("""
+    (print (concat "ab" "cd")) (print (strlen "abc")) (print (len "abcd"))
+    (print (substr "hello" 1 3)) (print (substr "hello" -2 50))
+    (print (str 12)) (print (add "a" "b"))
+    """, registers, capsys) == ['abcd', '3', '4', 'el', 'hello', '12', 'ab']
+
+
+@backends
+def test_string_building(registers, capsys):
+    session = run("""
+    (def s "")
+    (def i 0)
+    (while (< i 200) (do (def s (concat s (str (mod i 10)))) (def i (add i 1))))
+    """, registers)
+    w_s = value(session, 's')
+    assert isinstance(w_s, W_StringObject)
+    # a single buffer, extended in place
+    assert w_s.strval is None and len(w_s.buffer.pieces) == 201
+    assert w_s.length == 200
+    session.run('(def t (concat s "!")) (def u (concat s "?"))')
+    assert value(session, 't').value() == '0123456789' * 20 + '!'
+    # s was extended already: u copies it
+    assert value(session, 'u').value() == '0123456789' * 20 + '?'
+    assert value(session, 't').value() == '0123456789' * 20 + '!'
+
+
+@backends
+def test_symbols_interned(registers, capsys):
+    # symbols are equal by identity: the same one, from
+    # another input (constant pool); strings by value
+    session = run("(def a 'abc)", registers)
+    session.run("(print (= a 'abc)) (print (= \"ab\" (concat \"a\" \"b\")))")
+    bc = Session(registers=registers).compile("'abc")
+    assert value(session, 'a') is bc.constants[0]
+    assert capsys.readouterr()[0] == "(nolst) 1\n(nolst) 1\n"
+
+
+# big ints
+
+MAXINT = 9223372036854775807
+
+
+@backends
+@pytest.mark.parametrize('expr, result', [
+    ("(add %d 1)" % MAXINT, MAXINT + 1),
+    ("(sub -%d 10)" % MAXINT, -MAXINT - 10),
+    ("(mul %d 2)" % MAXINT, MAXINT * 2),
+    ("(mul 4294967296 4294967296)", 1 << 64),
+])
+def test_int_overflow(expr, result, registers, capsys):
+    session = run("(def r %s) (print r)" % expr, registers)
+    assert isinstance(value(session, 'r'), W_BigIntObject)
+    assert capsys.readouterr()[0] == "(nolst) %d\n" % result
+
+
+@backends
+def test_bigint_back_to_int(registers):
+    # a result fitting in a machine word is an int again
+    session = run("(def r (sub (add %d 1) 1))" % MAXINT, registers)
+    w_r = value(session, 'r')
+    assert isinstance(w_r, W_IntObject) and w_r.intval == MAXINT
+
+
+@backends
+def test_no_overflow(registers):
+    session = run("(def r (add %d -1))" % MAXINT, registers)
+    assert isinstance(value(session, 'r'), W_IntObject)
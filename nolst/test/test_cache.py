@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from nolst import cache
+from nolst.bytecode import compile_ast
+from nolst.interpreter import Session
+from nolst.sourceparser import parse
+
+SOURCE = """
+(def count (lambda (n acc)
+  (do (while (< 0 n)
+        (do (def acc (add acc 1.5))
+            (def n (- n 1))))
+      acc)))
+(print (count 300 0))
+(print (list "a" 'b -0.0 123456789012345678901234567890))
+"""
+
+
+def cached_script(tmpdir):
+    path = str(tmpdir.join('script.nls'))
+    Session().run_file(path, SOURCE)
+    return path, cache.read_file(cache.cache_path(path))
+
+
+def test_store_and_load(tmpdir, capsys):
+    path, data = cached_script(tmpdir)
+    assert cache.load(path, SOURCE) is not None
+    # no temporary file left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['script.nlc']
+    capsys.readouterr()
+    Session().run_file(path, SOURCE)
+    assert capsys.readouterr()[0] == (
+        '(nolst) 450.0\n'
+        '(nolst) [a, b, -0.0, 123456789012345678901234567890]\n')
+
+
+def invalid(data):
+    with pytest.raises(cache.CacheError):
+        cache.load_bytecode(data, cache.source_hash(SOURCE))
+
+
+def test_truncated(tmpdir):
+    path, data = cached_script(tmpdir)
+    for end in range(len(data)):
+        invalid(data[:end])
+
+
+def test_corrupted(tmpdir):
+    path, data = cached_script(tmpdir)
+    for i in range(len(data)):
+        invalid(data[:i] + chr(ord(data[i]) ^ 0xff) + data[i + 1:])
+
+
+def test_corrupted_cache_is_recompiled(tmpdir, capsys):
+    path, data = cached_script(tmpdir)
+    cache.write_file(cache.cache_path(path), data[:-1] + '\xff')
+    capsys.readouterr()
+    Session().run_file(path, SOURCE)
+    assert capsys.readouterr()[0].startswith('(nolst) 450.0\n')
+    # and the cache is valid again
+    assert cache.read_file(cache.cache_path(path)) == data
+
+
+def test_truncated_varint():
+    with pytest.raises(cache.CacheError) as e:
+        cache.Loader('\x81\x81').read_arg()
+    assert e.value.msg == 'truncated'
+    with pytest.raises(cache.CacheError) as e:
+        cache.Loader('\xff' * 10 + '\x01').read_arg()
+    assert e.value.msg == 'varint too long'
+
+
+def test_bad_code():
+    # not caught by the payload hash: an unknown opcode
+    bc = compile_ast(parse("(print 1)"))
+    bc.code += '\xff'
+    data = cache.dump_bytecode(bc, [], 'hash')
+    with pytest.raises(cache.CacheError) as e:
+        cache.load_bytecode(data, 'hash')
+    assert e.value.msg == 'unknown opcode'
+
+
+@pytest.mark.parametrize('optimized', [False, True])
+def test_check_code(optimized):
+    bc = compile_ast(parse(SOURCE), optimize=optimized)
+    cache.check_code(bc.code, bc.lambdas)
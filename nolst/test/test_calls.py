@@ -0,0 +1,80 @@
+import pytest
+
+from nolst import register
+from nolst.interpreter import Session, InterpreterError, check_call
+from nolst.tracing import Tracer
+
+
+def run(source, registers=False):
+    Session(registers=registers).run(source)
+
+
+def test_check_call_undefined():
+    with pytest.raises(InterpreterError) as e:
+        check_call(None, 0)
+    assert e.value.msg == "not a function: <undefined>"
+
+
+@pytest.mark.parametrize('registers', [False, True])
+def test_call_undefined_name(registers):
+    with pytest.raises(InterpreterError):
+        run("(print (f))", registers)
+
+
+@pytest.mark.parametrize('registers', [False, True])
+def test_call_not_a_function(registers):
+    with pytest.raises(InterpreterError) as e:
+        run("(def f 1) (f)", registers)
+    assert e.value.msg == "not a function: 1"
+
+
+@pytest.mark.parametrize('registers', [False, True])
+def test_call_wrong_arity(registers):
+    with pytest.raises(InterpreterError) as e:
+        run("(def f (lambda (x) x)) (f 1 2)", registers)
+    assert e.value.msg == "function expects 1 arguments, got 2"
+
+
+class DepthTracer(Tracer):
+    '''
+    the deepest call depth reached
+    '''
+    def __init__(self):
+        Tracer.__init__(self, -1)
+        self.depth = 0
+
+    def bytecode(self, bc):
+        pass
+
+    def instruction(self, bc, pc, opcode, arg, frame, calls):
+        self.depth = max(self.depth, calls)
+
+
+def call_depth(source, registers):
+    tracer = DepthTracer()
+    if registers:
+        bc = Session(registers=True).compile(source)
+        register.execute_traced(register.toplevel_frame(bc), bc, tracer)
+    else:
+        Session(tracer).run(source)
+    return tracer.depth
+
+
+TAIL_COUNT = """
+(def count (lambda (n acc) (if (< 0 n) (count (add n -1) (add acc n)))))
+(count 20000 0)
+"""
+
+NOT_TAIL_COUNT = """
+(def count (lambda (n) (do (if (< 0 n) (count (add n -1))) n)))
+(count 2000)
+"""
+
+
+@pytest.mark.parametrize('registers', [False, True])
+def test_tail_calls_constant_frames(registers):
+    # a tail call reuses the frame of its caller: a single
+    # frame for the whole loop, whatever its length
+    assert call_depth(TAIL_COUNT, registers) == 1
+    assert call_depth(NOT_TAIL_COUNT, registers) == 2001
+
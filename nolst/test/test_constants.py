@@ -0,0 +1,77 @@
+import pytest
+
+from nolst import bytecode
+from nolst.bytecode import CompilerContext, WIDE_FLAG
+from nolst.interpreter import Session
+
+
+def test_float_constants_dedup():
+    ctx = CompilerContext()
+    assert ctx.register_float_constant(1.5) == ctx.register_float_constant(1.5)
+    assert len(ctx.constants) == 1
+    assert ctx.constants_requested == 2
+
+
+def test_negative_zero_constant():
+    ctx = CompilerContext()
+    assert ctx.register_float_constant(0.0) != ctx.register_float_constant(-0.0)
+
+
+@pytest.mark.parametrize('registers', [False, True])
+def test_print_negative_zero(registers, capsys):
+    Session(registers=registers).run("(print (list 0.0 -0.0))")
+    assert capsys.readouterr()[0] == "(nolst) [0.0, -0.0]\n"
+
+
+@pytest.mark.parametrize('arg', [0, 1, 127, 128, 255, 256, 16383, 16384,
+                                 1 << 40])
+def test_operand_encoding(arg):
+    chars = bytecode.encode_arg(arg)
+    assert len(chars) == bytecode.arg_size(arg)
+    # one byte up to 127, WIDE_FLAG set on all bytes but the last
+    assert (len(chars) == 1) == (arg < WIDE_FLAG)
+    for c in chars[:-1]:
+        assert ord(c) >= WIDE_FLAG
+    code = 'x' + ''.join(chars) + 'y'
+    assert bytecode.decode_arg(code, 1) == (arg, len(code) - 1)
+
+
+def wide_operands(bc):
+    '''
+    the operands of stack bytecode `bc` not fitting in a byte
+    '''
+    code = bc.code
+    wide = []
+    pc = 0
+    while pc < len(code):
+        following = bytecode.next_pc(code, pc)
+        arg, _ = bytecode.decode_arg(code, pc + 1)
+        if arg >= WIDE_FLAG:
+            wide.append(arg)
+        pc = following
+    return wide
+
+
+N = 300
+# constants, globals and locals indexed up to N - 1, a list built
+# from N arguments, jumps over a long lambda body
+WIDE_SOURCE = (
+    "(def f (lambda (c) (do %s (if c (list %s)))))"
+    "%s (print (nth (f 1) %d)) (print v%d)" % (
+        ' '.join(['(def a%d %d)' % (i, 1000 + i) for i in range(N)]),
+        ' '.join(['a%d' % i for i in range(N)]),
+        ' '.join(['(def v%d %d)' % (i, 5000 + i) for i in range(N)]),
+        N - 1, N - 1))
+
+
+@pytest.mark.parametrize('registers, optimize', [
+    (False, False), (False, True), (True, False)])
+def test_wide_operands(registers, optimize, capsys):
+    session = Session(registers=registers, optimize=optimize)
+    bc = session.compile(WIDE_SOURCE)
+    assert len(bc.constants) > 2 * N
+    if not registers:
+        assert max(wide_operands(bc)) > 255
+    session.execute(bc)
+    assert capsys.readouterr()[0] == "(nolst) %d\n(nolst) %d\n" % (
+        1000 + N - 1, 5000 + N - 1)
@@ -0,0 +1,88 @@
+import os
+
+from nolst import bytecode
+from nolst.interpreter import Session
+from nolst.tracing import Profiler, Tracer
+
+SOURCE = """
+(def count (lambda (n) (if (< 0 n) (count (add n -1)))))
+(def twice (lambda (f) (do (f 3) (f 4))))
+(twice count)
+"""
+
+
+def profile(source, folded=False, interval=1000):
+    read, write = os.pipe()
+    profiler = Profiler(write, folded, interval)
+    session = Session(profiler=profiler)
+    session.run(source)
+    profiler.finish()
+    os.close(write)
+    output = os.read(read, 1 << 20)
+    os.close(read)
+    return profiler, output
+
+
+def test_calls():
+    profiler, output = profile(SOURCE)
+    functions = {}
+    for function in profiler.functions():
+        functions[function.label.split('@')[0]] = function
+    # CALLs and TAIL_CALLs
+    assert functions['count'].calls == 2 + 7
+    assert functions['twice'].calls == 1
+    assert functions['toplevel'].calls == 1
+    total = 0
+    for function in functions.values():
+        total += function.instructions
+    assert output.startswith('instructions: %d\n' % total)
+
+
+def test_samples():
+    profiler, output = profile(SOURCE, folded=True, interval=1)
+    samples = {}
+    for line in output.splitlines():
+        stack, count = line.rsplit(' ', 1)
+        samples[stack] = int(count)
+    # one sample by instruction
+    assert sum(samples.values()) == sum(
+        [sum(unit.instruction_counts()) for unit in profiler.units])
+    assert [stack for stack in samples if stack.endswith(';count@0:%d' % (
+        profiler.units[0].bc.lambdas[0].args))] != []
+    for stack in samples:
+        assert stack.startswith('toplevel')
+
+
+class CountingTracer(Tracer):
+    def __init__(self):
+        Tracer.__init__(self, -1)
+        self.counts = {}
+
+    def bytecode(self, bc):
+        pass
+
+    def instruction(self, bc, pc, opcode, arg, frame, calls):
+        self.counts[pc] = self.counts.get(pc, 0) + 1
+
+
+def test_block_counts():
+    # counting blocks gives the count of every instruction
+    tracer = CountingTracer()
+    profiler = Profiler(-1)
+    Session(tracer, profiler=profiler).run(SOURCE)
+    unit, = profiler.units
+    counts = unit.instruction_counts()
+    for pc in range(len(counts)):
+        assert counts[pc] == tracer.counts.get(pc, 0)
+    # the blocks cover the code
+    code = unit.bc.code
+    pc = instructions = 0
+    while pc < len(code):
+        instructions += 1
+        pc = bytecode.next_pc(code, pc)
+    assert sum(unit.blocks) == instructions
+
+
+def test_no_profile():
+    bc = Session().compile(SOURCE)
+    assert bc.profile is None
@@ -0,0 +1,69 @@
+import pytest
+
+from nolst import sourceparser
+from nolst.interpreter import Session
+from nolst.sourceparser import parse, ReaderError, Lambda
+
+
+def reader_error(source):
+    with pytest.raises(ReaderError) as e:
+        parse(source)
+    return e.value.msg
+
+
+def test_lambda():
+    node = parse("(lambda (x y) x)").stmts[0]
+    assert isinstance(node, Lambda)
+    assert [arg.varname for arg in node.args.stmts] == ['x', 'y']
+
+
+@pytest.mark.parametrize('source', [
+    "(lambda x x)", "(lambda 1 x)", "(lambda \"x\" x)", "(lambda '(x) x)"])
+def test_lambda_without_argument_list(source):
+    assert reader_error(source) == "lambda expects an argument list"
+
+
+def test_lambda_invalid_argument_name():
+    assert reader_error("(lambda (1) 1)") == "invalid argument name"
+
+
+@pytest.mark.parametrize('name', ['sub', '-', 'print', 'add', 'if', 'list'])
+def test_def_reserved_name(name):
+    assert reader_error("(def %s 3)" % name) == "can't redefine %s" % name
+
+
+def test_reserved_argument_name():
+    assert reader_error("(lambda (sub) (sub 5 1))") == "can't redefine sub"
+
+
+def test_parse_without_generic_parser():
+    # the generic parser tables are only loaded by parse_generic
+    parse("(def x (lambda (y) (add y 1)))")
+    assert not sourceparser._generic_parser
+
+
+@pytest.mark.parametrize('source', ["(len (list 1 2) 3)", "(len)"])
+def test_generic_parser_builtin_arity(source):
+    # (after the test above: loads the generic parser)
+    with pytest.raises(ReaderError) as e:
+        parse(source)
+    assert e.value.msg == "len expects 1 arguments"
+    with pytest.raises(ReaderError) as e:
+        sourceparser.parse_generic(source)
+    assert e.value.msg == "len expects 1 arguments"
+
+
+@pytest.mark.parametrize('registers', [False, True])
+@pytest.mark.parametrize('head', ['(do ', '(add 1 ', '(f ', "'("])
+def test_deep_nesting(head, registers, capsys):
+    # compiled through a session: the passes after the reader recurse
+    depth = sourceparser.MAX_NESTING
+    source = "(def f (lambda (x) x)) %s1%s" % (head * (depth - 1), ')' * (depth - 1))
+    Session(registers=registers).run(source + " (print 2)")
+    assert capsys.readouterr()[0] == "(nolst) 2\n"
+    source = "%s1%s" % (head * 5000, ')' * 5000)
+    with pytest.raises(ReaderError) as e:
+        Session(registers=registers).run(source)
+    assert e.value.msg == "too deeply nested"
+    # at the first list too many
+    assert e.value.pos == depth * len(head) + head.index('(')
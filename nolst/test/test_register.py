@@ -0,0 +1,39 @@
+import pytest
+
+from nolst import bytecode, interpreter, register
+from nolst.interpreter import InterpreterError
+from nolst.sourceparser import BinOp, ConstantInt, Print, Sexpr, Stmt
+
+
+def run(node, capsys, registers=True, optimize=False):
+    if registers:
+        bc = register.compile_ast(Sexpr([node]))
+        register.execute(register.toplevel_frame(bc), bc)
+    else:
+        bc = bytecode.compile_ast(Sexpr([node]), optimize=optimize)
+        interpreter.execute(interpreter.toplevel_frame(bc), bc)
+    return capsys.readouterr()[0]
+
+
+@pytest.mark.parametrize('registers, optimize', [
+    (False, False), (False, True), (True, False)])
+@pytest.mark.parametrize('op, left, right, result', [
+    ('+', 5, 2, '7'), ('<', 5, 2, '0'), ('-', 5, 2, '3'), ('==', 5, 2, '0'),
+    ('==', 2, 2, '1'), ('-', 2, 5, '-3')])
+def test_binop(op, left, right, result, registers, optimize, capsys):
+    # the same result on both backends
+    node = Print(BinOp(op, ConstantInt(left), ConstantInt(right)))
+    output = run(node, capsys, registers, optimize)
+    assert output == "(nolst) %s\n" % result
+
+
+def test_binop_unknown_operator():
+    with pytest.raises(register.CompileError) as e:
+        register.compile_ast(Sexpr([BinOp('*', ConstantInt(5), ConstantInt(2))]))
+    assert e.value.msg == "can't compile operator *"
+
+
+def test_unknown_node():
+    with pytest.raises(InterpreterError) as e:
+        register.compile_ast(Sexpr([Stmt(ConstantInt(1))]))
+    assert e.value.msg == "can't compile Stmt"
@@ -0,0 +1,37 @@
+from nolst.sourceparser import FormScanner
+
+
+def test_forms():
+    scanner = FormScanner()
+    assert scanner.feed("(print 1) (print") == ["(print 1)"]
+    assert scanner.feed(" \")\") ; (\n") == [" (print \")\")"]
+    assert scanner.flush() == ""
+
+
+def test_toplevel_atom():
+    scanner = FormScanner()
+    assert scanner.feed("42") == []
+    assert scanner.feed("\n") == ["42"]
+    assert scanner.feed("x\n") == ["\nx"]
+    assert scanner.flush() == ""
+
+
+def test_toplevel_atom_before_a_list():
+    scanner = FormScanner()
+    assert scanner.feed("x(print x)") == ["x", "(print x)"]
+
+
+def test_toplevel_string():
+    scanner = FormScanner()
+    assert scanner.feed("\"a (b\" 1 ") == ["\"a (b\"", " 1"]
+
+
+def test_toplevel_quoted():
+    scanner = FormScanner()
+    assert scanner.feed("'x '(a b) ") == ["'x", " '(a b)"]
+
+
+def test_atom_at_end_of_input():
+    scanner = FormScanner()
+    assert scanner.feed("(def x 1) x") == ["(def x 1)"]
+    assert scanner.flush() == " x"
@@ -0,0 +1,36 @@
+import pytest
+
+from nolst.interpreter import Session
+from nolst.sourceparser import FormScanner
+
+
+def toplevel_frame(session):
+    if session.registers:
+        return session.register_frame
+    return session.frame
+
+
+@pytest.mark.parametrize('registers', [False, True])
+def test_many_defs(registers, capsys):
+    # a REPL fed N defs form by form: the work done for a form
+    # must not depend on the number of globals already defined
+    n = 2000
+    session = Session(registers=registers)
+    source = ''.join(['(def v%d %d)\n' % (i, i) for i in range(n)])
+    frame = None
+    sizes = []
+    for form in FormScanner().feed(source + '(print v%d)\n' % (n - 1)):
+        bc = session.compile(form)
+        # the global names are shared, not copied
+        assert bc.names is session.names.names
+        session.execute(bc)
+        # a single top-level frame...
+        if frame is None:
+            frame = toplevel_frame(session)
+        assert toplevel_frame(session) is frame
+        if not sizes or sizes[-1] != len(frame.vars):
+            sizes.append(len(frame.vars))
+    # ...whose globals grow by doubling
+    assert len(sizes) <= 12
+    assert len(frame.vars) < 2 * n
+    assert capsys.readouterr()[0] == "(nolst) %d\n" % (n - 1)
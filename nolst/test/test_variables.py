@@ -0,0 +1,87 @@
+import pytest
+
+from nolst.interpreter import Session, InterpreterError
+
+
+def run(source, registers=False, optimize=False):
+    Session(optimize=optimize, registers=registers).run(source)
+
+
+backends = pytest.mark.parametrize('registers, optimize', [
+    (False, False), (False, True), (True, False)])
+
+
+def undefined(source, registers, optimize):
+    with pytest.raises(InterpreterError) as e:
+        run(source, registers, optimize)
+    return e.value.msg
+
+
+@backends
+def test_undefined_global(registers, optimize):
+    assert undefined("(print x)", registers, optimize) == "undefined variable x"
+
+
+@backends
+def test_call_undefined_global(registers, optimize):
+    assert undefined("(print (f))", registers, optimize) == "undefined variable f"
+
+
+@backends
+def test_local_read_before_def(registers, optimize):
+    # the def makes x local to the whole body, global x included
+    source = """
+    (def x 5)
+    (def f (lambda () (while (< x 8) (def x (add x 1)))))
+    (f)
+    """
+    assert undefined(source, registers, optimize) == "undefined variable x"
+
+
+@backends
+def test_local_read_before_def_in_arithmetic(registers, optimize):
+    source = "(def f (lambda () (do (print (add y 1)) (def y 1)))) (f)"
+    assert undefined(source, registers, optimize) == "undefined variable y"
+
+
+@backends
+def test_cell_read_before_def(registers, optimize):
+    source = """
+    (def f (lambda ()
+      (do (def g (lambda () z))
+          (print (g))
+          (def z 1))))
+    (f)
+    """
+    assert undefined(source, registers, optimize) == "undefined variable z"
+
+
+@backends
+def test_cell_read_after_def(registers, optimize, capsys):
+    run("""
+    (def f (lambda ()
+      (do (def g (lambda () z))
+          (def z 1)
+          (print (g)))))
+    (f)
+    """, registers, optimize)
+    assert capsys.readouterr()[0] == "(nolst) 1\n"
+
+
+@pytest.mark.parametrize('source, name', [
+    ("(do nosuch (print 1))", "nosuch"),
+    ("(def f (lambda () (do y (def y 1)))) (f)", "y"),
+    ("(def f (lambda () (do (do 1 y) (def y 1)))) (f)", "y"),
+    ("(def f (lambda () (do (def i 0) (while (< i 1) (do (def i 1) y))"
+     " (def y 1)))) (f)", "y"),
+    ("(def f (lambda () (do (def y y) 1))) (f)", "y"),
+    ("(def f (lambda () (do (def g (lambda () z)) z (def z 1)))) (f)", "z"),
+    ("(def f (lambda () (do (def g (lambda () (do z 1))) (g) (def z 1)))) (f)",
+     "z"),
+])
+@backends
+def test_unused_read_of_undefined(source, name, registers, optimize, capsys):
+    # a read whose value is discarded still fails, -O or
+    # not, on both backends
+    assert undefined(source, registers, optimize) == "undefined variable %s" % name
+    assert capsys.readouterr()[0] == ""
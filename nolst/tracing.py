@@ -0,0 +1,491 @@
+""" Opt-in execution tracing.
+
+The tracing interpreter emits one JSON object per line on a file
+descriptor: the bytecode of every compiled input, then an event for
+every executed instruction, e.g.
+
+    {"event": "op", "pc": 12, "op": "LOAD_VAR", "arg": 3,
+     "depth": 1, "calls": 0, "locals": [], "vars": ["1", null]}
+
+`depth` is the size of the value stack, `calls` the call depth.
+
+`PairProfiler` runs in the same mode, and counts the pairs of
+adjacent instructions executed one after the other: the most
+frequent ones are the candidates for new superinstructions.
+
+`Profiler` is the exception: it counts from a JIT-compiled loop,
+the production one specialized for profiling (see
+interpreter.dispatch). Instructions executed by opcode and by pc, calls
+and instructions of every lambda, and samples of the call stack.
+Lambdas are labelled name@input:pc, `input` numbering the compiled
+inputs in order of execution.
+"""
+import os
+from rpython.rlib import jit
+from rpython.rlib.objectmodel import specialize
+from nolst import bytecode
+
+HEX_DIGITS = '0123456789abcdef'
+
+
+def json_str(s):
+    chars = ['"']
+    for ch in s:
+        if ch == '"' or ch == '\\':
+            chars.append('\\' + ch)
+        elif ch == '\n':
+            chars.append('\\n')
+        elif ch == '\t':
+            chars.append('\\t')
+        elif ord(ch) < 0x20:
+            chars.append('\\u00' + HEX_DIGITS[ord(ch) >> 4] +
+                         HEX_DIGITS[ord(ch) & 0xf])
+        else:
+            chars.append(ch)
+    chars.append('"')
+    return ''.join(chars)
+
+
+def rjust(s, width):
+    if len(s) >= width:
+        return s
+    return ' ' * (width - len(s)) + s
+
+
+# the value stack is a fixed-size list, the global variables
+# grow in place (Frame.resize_vars): one version for each
+@specialize.call_location()
+def json_values(w_values, start, stop):
+    items = []
+    for i in range(start, stop):
+        w_value = w_values[i]
+        if w_value is None:
+            items.append('null')
+        else:
+            items.append(json_str(w_value.str()))
+    return '[' + ', '.join(items) + ']'
+
+
+class Tracer(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, line):
+        os.write(self.fd, line + '\n')
+
+    def bytecode(self, bc):
+        self.write('{"event": "bytecode", "code": %s, "stats": %s}' % (
+            json_str(bc.dump()), json_str(bc.stats())))
+
+    def instruction(self, bc, pc, opcode, arg, frame, calls):
+        self.write(
+            '{"event": "op", "pc": %d, "op": "%s", "arg": %d, '
+            '"depth": %d, "calls": %d, "locals": %s, "vars": %s}' % (
+                pc, bytecode.bytecodes_by_value[opcode], arg,
+                frame.valuestack_pos - frame.nlocals, calls,
+                json_values(frame.stack, 0, frame.nlocals),
+                json_values(frame.vars, 0, len(bc.names))))
+
+    def finish(self):
+        pass
+
+
+class PairProfiler(Tracer):
+    def __init__(self, fd, top=20):
+        Tracer.__init__(self, fd)
+        # number of pairs reported
+        self.top = top
+        # counts by first opcode * 256 + second opcode
+        self.counts = {}
+        # where the next instruction of the previous one was
+        self.expected_code = None
+        self.expected_pc = -1
+        self.previous = 0
+
+    def bytecode(self, bc):
+        pass
+
+    def instruction(self, bc, pc, opcode, arg, frame, calls):
+        code = bc.code
+        # pairs are only fusable if the second
+        # instruction follows the first one in the code
+        if code is self.expected_code and pc == self.expected_pc:
+            key = self.previous * 256 + opcode
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.expected_code = code
+        self.expected_pc = bytecode.next_pc(code, pc)
+        self.previous = opcode
+
+    def finish(self):
+        counts = self.counts.copy()
+        for i in range(self.top):
+            # most frequent remaining pair
+            best_key = -1
+            best_count = 0
+            for key, count in counts.items():
+                if count > best_count:
+                    best_key = key
+                    best_count = count
+            if best_key < 0:
+                break
+            del counts[best_key]
+            self.write('%s  %s %s' % (
+                rjust(str(best_count), 10),
+                bytecode.bytecodes_by_value[best_key >> 8],
+                bytecode.bytecodes_by_value[best_key & 0xff]))
+
+
+class FunctionProfile(object):
+    '''
+    a lambda (or the top-level code), in a report
+    '''
+    def __init__(self, label, calls):
+        self.label = label
+        self.calls = calls
+        # instructions executed by the lambda itself
+        self.instructions = 0
+        # samples taken while it was on the stack
+        self.samples = 0
+
+
+class CallNode(object):
+    '''
+    a call stack sampled, as a path from the top-level code:
+    the stacks share their common prefix
+    '''
+    def __init__(self, label):
+        self.label = label
+        # label -> CallNode
+        self.children = {}
+        # samples of this very stack
+        self.samples = 0
+
+    def child(self, label):
+        node = self.children.get(label, None)
+        if node is None:
+            node = CallNode(label)
+            self.children[label] = node
+        return node
+
+    def fold(self, prefix, folded):
+        '''
+        fill `folded`, folded stack -> number of samples
+        '''
+        if prefix:
+            prefix += ';' + self.label
+        else:
+            prefix = self.label
+        if self.samples > 0:
+            folded[prefix] = self.samples
+        for node in self.children.values():
+            node.fold(prefix, folded)
+
+
+# instructions after which a new basic block starts
+# (besides the jumps): execution goes on elsewhere
+BLOCK_ENDS = [bytecode.CALL, bytecode.TAIL_CALL, bytecode.BACK,
+              bytecode.RETURN]
+
+
+def block_sizes(bc):
+    '''
+    the number of instructions of the basic block starting at
+    every pc, 0 where none starts. Blocks start at the entry
+    points (top-level code, lambdas), at jump targets and after
+    jumps, calls and returns: the instructions of a block are
+    executed together.
+    '''
+    code = bc.code
+    leaders = [False] * (len(code) + 1)
+    leaders[0] = True
+    for w_lambda in bc.lambdas:
+        leaders[w_lambda.args] = True
+    pc = 0
+    while pc < len(code):
+        opcode = ord(code[pc])
+        arg, _ = bytecode.decode_arg(code, pc + 1)
+        following = bytecode.next_pc(code, pc)
+        if opcode in bytecode.ABSOLUTE_JUMPS:
+            leaders[arg] = True
+            leaders[following] = True
+        elif opcode in bytecode.RELATIVE_JUMPS:
+            leaders[following + arg] = True
+            leaders[following] = True
+        elif opcode in BLOCK_ENDS:
+            leaders[following] = True
+        pc = following
+    sizes = [0] * len(code)
+    leader = 0
+    pc = 0
+    while pc < len(code):
+        if leaders[pc]:
+            leader = pc
+        sizes[leader] += 1
+        pc = bytecode.next_pc(code, pc)
+    return sizes
+
+
+class UnitProfile(object):
+    '''
+    counters of a compiled input, incremented by the
+    profiling dispatch loop (see ByteCode.profile).
+
+    Only the first instruction of a basic block counts:
+    the others have the same count. The JIT folds the
+    test away for the others (the bytecode is a green).
+    An error in the middle of a block counts the whole
+    block as executed.
+    '''
+    _immutable_fields_ = ['profiler', 'index', 'blocks[*]', 'counts', 'calls']
+
+    def __init__(self, profiler, bc, index):
+        self.profiler = profiler
+        self.bc = bc
+        self.index = index
+        self.blocks = block_sizes(bc)
+        # times each basic block was executed, by pc
+        self.counts = [0] * len(bc.code)
+        # calls of each lambda, by entry point
+        self.calls = [0] * len(bc.code)
+        # times the input was run
+        self.runs = 0
+        # entry point -> label, built once: sampling
+        # labels every frame of the stack
+        self.labels = {}
+        for w_lambda in bc.lambdas:
+            self.labels[w_lambda.args] = '%s@%d:%d' % (
+                w_lambda.name, index, w_lambda.args)
+
+    def count(self, pc, frame):
+        # first instruction of the block at `pc`
+        size = self.blocks[pc]
+        self.counts[pc] += 1
+        profiler = self.profiler
+        profiler.until_sample -= size
+        if profiler.until_sample <= 0:
+            profiler.sample(frame)
+
+    def instruction_counts(self):
+        '''
+        times each instruction was executed, by pc
+        '''
+        code = self.bc.code
+        counts = [0] * len(code)
+        count = 0
+        pc = 0
+        while pc < len(code):
+            if self.blocks[pc] > 0:
+                count = self.counts[pc]
+            counts[pc] = count
+            pc = bytecode.next_pc(code, pc)
+        return counts
+
+    def label(self, pc):
+        '''
+        the label of the lambda whose entry point is `pc`
+        '''
+        label = self.labels.get(pc, None)
+        if label is None:
+            return 'lambda@%d:%d' % (self.index, pc)
+        return label
+
+    def owners(self):
+        '''
+        the entry point of the lambda every instruction belongs
+        to, -1 for the top-level code: the instructions reached
+        from there (nested lambdas are jumped over)
+        '''
+        code = self.bc.code
+        owners = [-1] * len(code)
+        for w_lambda in self.bc.lambdas:
+            todo = [w_lambda.args]
+            while todo:
+                pc = todo.pop()
+                while pc < len(code) and owners[pc] != w_lambda.args:
+                    owners[pc] = w_lambda.args
+                    opcode = ord(code[pc])
+                    if opcode in bytecode.TERMINATORS:
+                        break
+                    arg, _ = bytecode.decode_arg(code, pc + 1)
+                    following = bytecode.next_pc(code, pc)
+                    if opcode in bytecode.CONDITIONAL_JUMPS:
+                        todo.append(arg)
+                        pc = following
+                    elif opcode in bytecode.ABSOLUTE_JUMPS:
+                        pc = arg
+                    elif opcode in bytecode.RELATIVE_JUMPS:
+                        pc = following + arg
+                    else:
+                        pc = following
+        return owners
+
+
+class Profiler(object):
+    '''
+    counts executed instructions by pc (hence by opcode and by
+    lambda) and the calls of every lambda. Every `interval`
+    instructions, the stack of ongoing calls is sampled. When
+    we are done, it writes a report, or (`folded`) the samples
+    as folded stacks, for flamegraph.pl.
+
+    It doesn't trace: it attaches a UnitProfile to every
+    bytecode run, and the profiling dispatch loop, JIT-compiled
+    like the production one, counts there. Without --profile,
+    the production loop runs, without any counting.
+    '''
+    def __init__(self, fd, folded=False, interval=1000, top=20):
+        self.fd = fd
+        self.folded = folded
+        self.interval = interval
+        # number of pcs reported
+        self.top = top
+        self.units = []
+        self.until_sample = interval
+        # the stacks sampled
+        self.calls = CallNode('toplevel')
+
+    def write(self, line):
+        os.write(self.fd, line + '\n')
+
+    def attach(self, bc):
+        '''
+        count the executions of `bc`, about to run
+        '''
+        if bc.profile is None:
+            bc.profile = UnitProfile(self, bc, len(self.units))
+            self.units.append(bc.profile)
+        bc.profile.runs += 1
+
+    @jit.dont_look_inside
+    def sample(self, frame):
+        # a block may span several intervals
+        weight = 0
+        while self.until_sample <= 0:
+            self.until_sample += self.interval
+            weight += 1
+        # no string built per sample: with deep recursion,
+        # sampling is most of the profiling time
+        labels = []
+        while frame is not None:
+            function = frame.function
+            if function is None:
+                pass
+            elif function.bc.profile is None:
+                labels.append('lambda')
+            else:
+                labels.append(function.bc.profile.label(function.args))
+            frame = frame.back
+        node = self.calls
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.child(labels[i])
+        node.samples += weight
+
+    def folded_samples(self):
+        '''
+        folded stack -> number of samples
+        '''
+        folded = {}
+        self.calls.fold('', folded)
+        return folded
+
+    def functions(self):
+        '''
+        the top-level code and the lambdas called, most
+        instructions first
+        '''
+        toplevel = FunctionProfile('toplevel', 0)
+        functions = [toplevel]
+        by_label = {toplevel.label: toplevel}
+        for unit in self.units:
+            toplevel.calls += unit.runs
+            owners = unit.owners()
+            counts = unit.instruction_counts()
+            by_entry = {}
+            for pc in range(len(owners)):
+                entry = owners[pc]
+                if entry < 0:
+                    toplevel.instructions += counts[pc]
+                    continue
+                if unit.calls[entry] == 0:
+                    continue
+                function = by_entry.get(entry, None)
+                if function is None:
+                    function = FunctionProfile(unit.label(entry), unit.calls[entry])
+                    by_entry[entry] = function
+                    by_label[function.label] = function
+                    functions.append(function)
+                function.instructions += counts[pc]
+        for key, count in self.folded_samples().items():
+            # recursive calls are counted once
+            seen = {}
+            for label in key.split(';'):
+                if label in by_label and label not in seen:
+                    seen[label] = None
+                    by_label[label].samples += count
+        for i in range(len(functions)):
+            best = i
+            for j in range(i + 1, len(functions)):
+                if functions[j].instructions > functions[best].instructions:
+                    best = j
+            function = functions[best]
+            functions[best] = functions[i]
+            functions[i] = function
+        return functions
+
+    def finish(self):
+        if self.folded:
+            for key, count in self.folded_samples().items():
+                self.write('%s %d' % (key, count))
+            return
+        counts = [unit.instruction_counts() for unit in self.units]
+        total = 0
+        opcodes = [0] * 256
+        for index in range(len(counts)):
+            code = self.units[index].bc.code
+            unit_counts = counts[index]
+            for pc in range(len(unit_counts)):
+                if unit_counts[pc] > 0:
+                    total += unit_counts[pc]
+                    opcodes[ord(code[pc])] += unit_counts[pc]
+        self.write('instructions: %d' % total)
+        self.write('')
+        self.write('%10s  opcode' % 'count')
+        for i in range(self.top):
+            best = -1
+            for opcode in range(256):
+                if (opcodes[opcode] > 0 and
+                        (best < 0 or opcodes[opcode] > opcodes[best])):
+                    best = opcode
+            if best < 0:
+                break
+            self.write('%s  %s' % (rjust(str(opcodes[best]), 10),
+                                   bytecode.bytecodes_by_value[best]))
+            opcodes[best] = -opcodes[best]
+        self.write('')
+        self.write('%10s %10s %10s  lambda@input:pc' % ('calls', 'self', 'samples'))
+        for function in self.functions():
+            self.write('%s %s %s  %s' % (
+                rjust(str(function.calls), 10),
+                rjust(str(function.instructions), 10),
+                rjust(str(function.samples), 10),
+                function.label))
+        self.write('')
+        self.write('%10s  input:pc instruction' % 'count')
+        for i in range(self.top):
+            best_unit = -1
+            best_pc = -1
+            best_count = 0
+            for index in range(len(counts)):
+                unit_counts = counts[index]
+                for pc in range(len(unit_counts)):
+                    if unit_counts[pc] > best_count:
+                        best_unit = index
+                        best_pc = pc
+                        best_count = unit_counts[pc]
+            if best_unit < 0:
+                break
+            counts[best_unit][best_pc] = 0
+            code = self.units[best_unit].bc.code
+            self.write('%s  %d:%d %s' % (
+                rjust(str(best_count), 10), best_unit, best_pc,
+                bytecode.bytecodes_by_value[ord(code[best_pc])]))
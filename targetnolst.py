@@ -9,49 +9,145 @@
 
 from rpython.rlib.streamio import open_file_as_stream
 from rpython.jit.codewriter.policy import JitPolicy
-from nolst.interpreter import interpret
+from rpython.rlib import jit
+from nolst.interpreter import Session, InterpreterError
+from nolst import cache
+from nolst.tracing import Tracer, PairProfiler, Profiler
+from nolst.sourceparser import FormScanner, ReaderError
 import sys
 import os
 
-def main(argv):
-    #f = open_file_as_stream(argv[1])
+READ_SIZE = 65536
+
+
+def run(session, source):
+    try:
+        session.run(source)
+    except ReaderError as e:
+        print("Error, %s (at offset %d)" %(e.msg, e.pos))
+    except InterpreterError as e:
+        print("Error, %s" %e.msg)
+
 
+def main(argv):
     interactive = False
-    for a in argv:
+    optimize = False
+    registers = False
+    tracer = None
+    profiler = None
+    scripts = []
+    i = 1
+    while i < len(argv):
+        a = argv[i]
         if a in ('-i', '--interacive'):
             interactive = True
-
-    p_count = 0
-    content = ""
+        elif a == '-O':
+            # peephole optimizer (nolst.optimizer)
+            optimize = True
+        elif a == '--trace':
+            # JSON lines of every executed instruction, on
+            # the given file descriptor (see nolst.tracing)
+            i += 1
+            if i >= len(argv):
+                print("Error, --trace expects a file descriptor")
+                return 1
+            try:
+                tracer = Tracer(int(argv[i]))
+            except ValueError:
+                print("Error, --trace expects a file descriptor")
+                return 1
+        elif a == '--jit':
+            # JIT parameters, e.g. "off" or "threshold=200"
+            i += 1
+            if i >= len(argv):
+                print("Error, --jit expects parameters")
+                return 1
+            jit.set_user_param(None, argv[i])
+        elif a == '--backend':
+            # "stack" (the default) or "register" (nolst.register)
+            i += 1
+            if i >= len(argv) or argv[i] not in ('stack', 'register'):
+                print("Error, --backend expects stack or register")
+                return 1
+            registers = argv[i] == 'register'
+        elif a == '--profile-pairs':
+            # most frequent pairs of adjacent instructions,
+            # on stderr when we are done
+            tracer = PairProfiler(2)
+        elif a in ('--profile', '--profile-folded'):
+            # counts by opcode, by pc and by lambda, or the
+            # sampled call stacks (for flamegraph.pl), written
+            # on the given file descriptor when we are done.
+            # Not a tracer: the JIT stays on.
+            i += 1
+            if i >= len(argv):
+                print("Error, %s expects a file descriptor" % a)
+                return 1
+            try:
+                profiler = Profiler(int(argv[i]), a == '--profile-folded')
+            except ValueError:
+                print("Error, %s expects a file descriptor" % a)
+                return 1
+        else:
+            scripts.append(a)
+        i += 1
+
+    if registers and tracer is not None:
+        print("Error, the register backend can't be traced")
+        return 1
+    if registers and profiler is not None:
+        print("Error, the register backend can't be profiled")
+        return 1
+
+    # complete top-level forms are executed
+    # as soon as they are read
+    scanner = FormScanner()
     # save context upon sequencial
     # executions
-    frame = None
+    session = Session(tracer, optimize, registers, profiler)
+    status = run_all(session, scanner, scripts, interactive)
+    if tracer is not None:
+        tracer.finish()
+    if profiler is not None:
+        profiler.finish()
+    return status
+
+
+def run_all(session, scanner, scripts, interactive):
+    # scripts are compiled as a whole, and
+    # their bytecode is cached (.nlc files)
+    for path in scripts:
+        try:
+            source = cache.read_file(path)
+        except (IOError, OSError):
+            print("Error, can't read %s" %path)
+            return 1
+        try:
+            session.run_file(path, source)
+        except ReaderError as e:
+            print("Error, %s (at offset %d)" %(e.msg, e.pos))
+            return 1
+        except InterpreterError as e:
+            print("Error, %s" %e.msg)
+            return 1
+    if scripts and not interactive:
+        return 0
 
     while True:
         if interactive:
             os.write(1, '―→ ')
             #sys.stdout.flush()
-        readed = os.read(0, 4096)
+        readed = os.read(0, READ_SIZE)
 
         if not readed or not len(readed):
             break
 
-        for ch in readed:
-            if ch == '(':
-                p_count += 1
-            elif ch == ')':
-                p_count -= 1
-
-        content += readed
-
-        if p_count < 0:
-            print("Error, unexpected ')'")
-            content = ""
-            p_count = 0
+        for form in scanner.feed(readed):
+            run(session, form)
 
-        if len(content.strip('\n')) and p_count == 0:
-            frame = interpret(content, frame)
-            content = ""
+    rest = scanner.flush()
+    if rest:
+        run(session, rest)
     return 0
 
 def target(driver, args):